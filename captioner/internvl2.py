@@ -100,6 +100,23 @@ def load_image(image_file, input_size=448, max_num=12):
     pixel_values = torch.stack(pixel_values)
     return pixel_values
 
+# group image files by the tile count dynamic_preprocess would produce
+# images in the same group share the same pixel_values shape and prompt length
+# return {num_tiles: [(image_file, pixel_values), ...]}
+def group_images_by_tiles(image_files, input_size=448, max_num=12):
+    groups = {}
+    for image_file in image_files:
+        try:
+            pixel_values = load_image(image_file, input_size=input_size, max_num=max_num)
+        except Exception as e:
+            print(f"skip {image_file}: {e}")
+            continue
+        num_tiles = pixel_values.shape[0]
+        if num_tiles not in groups:
+            groups[num_tiles] = []
+        groups[num_tiles].append((image_file, pixel_values))
+    return groups
+
 class InternVL2ModelWrapper(ModelWrapper):
 
     def __init__(self,device=None,dtype=None,tokenizer_repo_id="lmsys/vicuna-7b-v1.5"):
@@ -145,6 +162,44 @@ class InternVL2ModelWrapper(ModelWrapper):
         
         del pixel_values
         return response
+
+    # batch_chat path: images grouped by tile count, refused outputs re-queued
+    # return {image_path: response}
+    def batch_execute(self, image_paths, prompt=None, batch_size=8, max_num=12,
+                      max_attempt_count=3, refused_text="I'm sorry, but I "):
+        model = self.model
+        tokenizer = self.tokenizer
+        if prompt != None:
+            self.prompt = prompt
+        generation_config = dict(max_new_tokens=1024, do_sample=True)
+
+        results = {}
+        groups = group_images_by_tiles(image_paths, max_num=max_num)
+        for num_tiles in sorted(groups.keys()):
+            queue = groups[num_tiles]
+            attempt_count = 0
+            while len(queue) > 0:
+                refused = []
+                for i in range(0, len(queue), batch_size):
+                    batch = queue[i:i + batch_size]
+                    pixel_values = torch.cat([item[1] for item in batch], dim=0).to(torch.bfloat16).cuda()
+                    num_patches_list = [num_tiles] * len(batch)
+                    questions = [self.prompt] * len(batch)
+                    responses = model.batch_chat(tokenizer, pixel_values,
+                                                 num_patches_list=num_patches_list,
+                                                 questions=questions,
+                                                 generation_config=generation_config)
+                    del pixel_values
+                    for (image_path, pixel_values), response in zip(batch, responses):
+                        results[image_path] = response
+                        if refused_text in response:
+                            refused.append((image_path, pixel_values))
+                # only re-queue refused outputs, keep the last response when attempts run out
+                attempt_count = attempt_count + 1
+                if attempt_count > max_attempt_count:
+                    break
+                queue = refused
+        return results
        
 if __name__ == "__main__":
     # F:\ImageSet\Rockman
@@ -159,17 +214,14 @@ if __name__ == "__main__":
     image_files = [f for f in files if os.path.splitext(f)[-1].lower() in image_exts]
     
     
-    for image_file in tqdm(image_files,position=2):
-        text_file = os.path.splitext(image_file)[0] + ".txt"
-        attempt_count = 0
-        result = model.execute(image_path=image_file)
-        if "I'm sorry, but I " in result:
-            while "I'm sorry, but I " in result and attempt_count < max_attempt_count:
-                result = model.execute(image_path=image_file)
-                attempt_count = attempt_count + 1
-        
-        new_content = f"{prefix}{character}, {result}"
-        # new caption
-        with open(text_file, "w", encoding="utf-8") as new_f:
-            new_f.write(new_content)
-            print("save new caption: ", text_file)
\ No newline at end of file
+    batch_size = 8
+    for i in tqdm(range(0, len(image_files), batch_size * 16),position=2):
+        chunk = image_files[i:i + batch_size * 16]
+        results = model.batch_execute(chunk, batch_size=batch_size, max_attempt_count=max_attempt_count)
+        for image_file, result in results.items():
+            text_file = os.path.splitext(image_file)[0] + ".txt"
+            new_content = f"{prefix}{character}, {result}"
+            # new caption
+            with open(text_file, "w", encoding="utf-8") as new_f:
+                new_f.write(new_content)
+                print("save new caption: ", text_file)
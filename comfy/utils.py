@@ -4,6 +4,7 @@
 
 import torch
 import math
+import functools
 import struct
 # import comfy.checkpoint_pickle
 import safetensors.torch
@@ -319,49 +320,49 @@ def get_attr(obj, attr):
         obj = getattr(obj, name)
     return obj
 
+# source indices and ratios of a bilinear resize along one axis, both neighbours in one index
+# so a pass needs a single index_select
+@functools.lru_cache(maxsize=32)
+def get_bislerp_coords(length_old, length_new, device):
+    coords_1 = torch.arange(length_old, dtype=torch.float32, device=device).reshape((1,1,1,-1))
+    coords_1 = torch.nn.functional.interpolate(coords_1, size=(1, length_new), mode="bilinear")
+    ratios = coords_1 - coords_1.floor()
+    coords_1 = coords_1.to(torch.int64)
+    
+    coords_2 = torch.arange(length_old, dtype=torch.float32, device=device).reshape((1,1,1,-1)) + 1
+    coords_2[:,:,:,-1] -= 1
+    coords_2 = torch.nn.functional.interpolate(coords_2, size=(1, length_new), mode="bilinear")
+    coords_2 = coords_2.to(torch.int64)
+    return ratios.reshape(-1), torch.cat([coords_1.reshape(-1), coords_2.reshape(-1)])
+
 def bislerp(samples, width, height):
     def slerp(b1, b2, r):
-        '''slerps batches b1, b2 according to ratio r, batches should be flat e.g. NxC'''
-        
-        c = b1.shape[-1]
+        '''slerps b1, b2 along the channel dim 1 according to ratio r, r broadcasts to b1 with one channel'''
 
         #norms
-        b1_norms = torch.norm(b1, dim=-1, keepdim=True)
-        b2_norms = torch.norm(b2, dim=-1, keepdim=True)
+        b1_norms = torch.norm(b1, dim=1, keepdim=True)
+        b2_norms = torch.norm(b2, dim=1, keepdim=True)
 
-        #normalize
-        b1_normalized = b1 / b1_norms
-        b2_normalized = b2 / b2_norms
-
-        #zero when norms are zero
-        b1_normalized[b1_norms.expand(-1,c) == 0.0] = 0.0
-        b2_normalized[b2_norms.expand(-1,c) == 0.0] = 0.0
+        #normalize, zero when norms are zero
+        b1_normalized = (b1 / b1_norms).masked_fill_(b1_norms == 0.0, 0.0)
+        b2_normalized = (b2 / b2_norms).masked_fill_(b2_norms == 0.0, 0.0)
 
         #slerp
-        dot = (b1_normalized*b2_normalized).sum(1)
+        dot = (b1_normalized*b2_normalized).sum(1, keepdim=True)
         omega = torch.acos(dot)
         so = torch.sin(omega)
 
         #technically not mathematically correct, but more pleasing?
-        res = (torch.sin((1.0-r.squeeze(1))*omega)/so).unsqueeze(1)*b1_normalized + (torch.sin(r.squeeze(1)*omega)/so).unsqueeze(1) * b2_normalized
-        res *= (b1_norms * (1.0-r) + b2_norms * r).expand(-1,c)
+        res = (torch.sin((1.0-r)*omega)/so)*b1_normalized
+        res += (torch.sin(r*omega)/so)*b2_normalized
+        res *= b1_norms * (1.0-r) + b2_norms * r
 
         #edge cases for same or polar opposites
-        res[dot > 1 - 1e-5] = b1[dot > 1 - 1e-5] 
-        res[dot < 1e-5 - 1] = (b1 * (1.0-r) + b2 * r)[dot < 1e-5 - 1]
+        res = torch.where(dot > 1 - 1e-5, b1, res)
+        opposite = dot < 1e-5 - 1
+        if opposite.any():
+            res = torch.where(opposite, b1 * (1.0-r) + b2 * r, res)
         return res
-    
-    def generate_bilinear_data(length_old, length_new, device):
-        coords_1 = torch.arange(length_old, dtype=torch.float32, device=device).reshape((1,1,1,-1))
-        coords_1 = torch.nn.functional.interpolate(coords_1, size=(1, length_new), mode="bilinear")
-        ratios = coords_1 - coords_1.floor()
-        coords_1 = coords_1.to(torch.int64)
-        
-        coords_2 = torch.arange(length_old, dtype=torch.float32, device=device).reshape((1,1,1,-1)) + 1
-        coords_2[:,:,:,-1] -= 1
-        coords_2 = torch.nn.functional.interpolate(coords_2, size=(1, length_new), mode="bilinear")
-        coords_2 = coords_2.to(torch.int64)
-        return ratios, coords_1, coords_2
 
     orig_dtype = samples.dtype
     samples = samples.float()
@@ -369,30 +370,15 @@ def bislerp(samples, width, height):
     h_new, w_new = (height, width)
     
     #linear w
-    ratios, coords_1, coords_2 = generate_bilinear_data(w, w_new, samples.device)
-    coords_1 = coords_1.expand((n, c, h, -1))
-    coords_2 = coords_2.expand((n, c, h, -1))
-    ratios = ratios.expand((n, 1, h, -1))
-
-    pass_1 = samples.gather(-1,coords_1).movedim(1, -1).reshape((-1,c))
-    pass_2 = samples.gather(-1,coords_2).movedim(1, -1).reshape((-1,c))
-    ratios = ratios.movedim(1, -1).reshape((-1,1))
-
-    result = slerp(pass_1, pass_2, ratios)
-    result = result.reshape(n, h, w_new, c).movedim(-1, 1)
+    ratios, coords = get_bislerp_coords(w, w_new, samples.device)
+    pairs = samples.index_select(-1, coords)
+    result = slerp(pairs[:,:,:,:w_new], pairs[:,:,:,w_new:], ratios.reshape((1,1,1,-1)))
+    del pairs
 
     #linear h
-    ratios, coords_1, coords_2 = generate_bilinear_data(h, h_new, samples.device)
-    coords_1 = coords_1.reshape((1,1,-1,1)).expand((n, c, -1, w_new))
-    coords_2 = coords_2.reshape((1,1,-1,1)).expand((n, c, -1, w_new))
-    ratios = ratios.reshape((1,1,-1,1)).expand((n, 1, -1, w_new))
-
-    pass_1 = result.gather(-2,coords_1).movedim(1, -1).reshape((-1,c))
-    pass_2 = result.gather(-2,coords_2).movedim(1, -1).reshape((-1,c))
-    ratios = ratios.movedim(1, -1).reshape((-1,1))
-
-    result = slerp(pass_1, pass_2, ratios)
-    result = result.reshape(n, h_new, w_new, c).movedim(-1, 1)
+    ratios, coords = get_bislerp_coords(h, h_new, samples.device)
+    pairs = result.index_select(-2, coords)
+    result = slerp(pairs[:,:,:h_new], pairs[:,:,h_new:], ratios.reshape((1,1,-1,1)))
     return result.to(orig_dtype)
 
 def lanczos(samples, width, height):
@@ -428,33 +414,66 @@ def common_upscale(samples, width, height, upscale_method, crop):
 def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
     return math.ceil((height / (tile_y - overlap))) * math.ceil((width / (tile_x - overlap)))
 
+# blend weights of a tile along one axis, the same rows / columns the per tile mask loop used to scale
+@functools.lru_cache(maxsize=64)
+def get_feather_weights(length, feather):
+    weights = torch.ones(length)
+    for t in range(feather):
+        weights[t:1+t] *= ((1.0/feather) * (t + 1))
+        weights[length -1 -t: length-t] *= ((1.0/feather) * (t + 1))
+    return weights
+
+@functools.lru_cache(maxsize=64)
+def get_feather_mask(height, width, feather, device, dtype):
+    mask = get_feather_weights(height, feather).reshape(-1, 1) * get_feather_weights(width, feather).reshape(1, -1)
+    return mask.to(device, dtype)
+
+# top left corners of the tiles, tiles at the border are shifted inside
+def get_tile_positions(height, width, tile_x, tile_y, overlap):
+    positions = []
+    for y in range(0, height, tile_y - overlap):
+        for x in range(0, width, tile_x - overlap):
+            x = max(0, min(width - overlap, x))
+            y = max(0, min(height - overlap, y))
+            positions.append((y, x))
+    return positions
+
+# tiles of the same size from all samples go through function together, up to tile_batch_size at a time
+# tile_batch_size=1 runs one tile at a time with the lowest memory
 @torch.inference_mode()
-def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None):
-    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
-    for b in range(samples.shape[0]):
-        s = samples[b:b+1]
-        out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
-        out_div = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
-        for y in range(0, s.shape[2], tile_y - overlap):
-            for x in range(0, s.shape[3], tile_x - overlap):
-                x = max(0, min(s.shape[-1] - overlap, x))
-                y = max(0, min(s.shape[-2] - overlap, y))
-                s_in = s[:,:,y:y+tile_y,x:x+tile_x]
-
-                ps = function(s_in).to(output_device)
-                mask = torch.ones_like(ps)
-                feather = round(overlap * upscale_amount)
-                for t in range(feather):
-                        mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
-                out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
-                out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
-                if pbar is not None:
-                    pbar.update(1)
-
-        output[b:b+1] = out/out_div
+def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None, tile_batch_size = 8):
+    n, _, h, w = samples.shape
+    out_h = round(h * upscale_amount)
+    out_w = round(w * upscale_amount)
+    output = torch.zeros((n, out_channels, out_h, out_w), device=output_device)
+    # the blend weights are the same for every sample
+    out_div = torch.zeros((1, 1, out_h, out_w), device=output_device)
+    feather = round(overlap * upscale_amount)
+
+    # (sample, y, x) grouped by the tile size, edge tiles can be smaller
+    groups = {}
+    for b in range(n):
+        for y, x in get_tile_positions(h, w, tile_x, tile_y, overlap):
+            tile_size = (min(tile_y, h - y), min(tile_x, w - x))
+            groups.setdefault(tile_size, []).append((b, y, x))
+
+    for (th, tw), tiles in groups.items():
+        for batch_start in range(0, len(tiles), max(1, tile_batch_size)):
+            batch_tiles = tiles[batch_start:batch_start + max(1, tile_batch_size)]
+            s_in = torch.cat([samples[b:b+1,:,y:y+th,x:x+tw] for b, y, x in batch_tiles])
+            ps = function(s_in).to(output_device)
+            mask = get_feather_mask(ps.shape[2], ps.shape[3], feather, ps.device, ps.dtype)
+            for k, (b, y, x) in enumerate(batch_tiles):
+                y_slice = slice(round(y*upscale_amount), round((y+tile_y)*upscale_amount))
+                x_slice = slice(round(x*upscale_amount), round((x+tile_x)*upscale_amount))
+                output[b,:,y_slice,x_slice] += ps[k] * mask
+                if b == 0:
+                    out_div[0,:,y_slice,x_slice] += mask
+            if pbar is not None:
+                pbar.update(len(batch_tiles))
+            del ps
+
+    output /= out_div
     return output
 
 PROGRESS_BAR_ENABLED = True
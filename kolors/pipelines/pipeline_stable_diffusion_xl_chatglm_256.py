@@ -17,6 +17,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from kolors.models.modeling_chatglm import ChatGLMModel
 from kolors.models.tokenization_chatglm import ChatGLMTokenizer
 import inspect
+from collections import OrderedDict
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import torch
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
@@ -51,6 +52,9 @@ from diffusers.pipelines.stable_diffusion_xl import StableDiffusionXLPipelineOut
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+# entries of the prompt embedding lru cache, 256x4096 + 4096 values each
+PROMPT_CACHE_SIZE = 32
+
 EXAMPLE_DOC_STRING = """
     Examples:
         ```py
@@ -138,6 +142,9 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
         self.image_processor = VaeImageProcessor(vae_scale_factor=self.vae_scale_factor)
         self.default_sample_size = self.unet.config.sample_size
+        # prompt embeddings of recent prompts, e.g. the negative prompt of repeated calls
+        self.prompt_cache_size = PROMPT_CACHE_SIZE
+        self.prompt_embedding_cache = OrderedDict()
 
         # self.watermark = StableDiffusionXLWatermarker()
 
@@ -309,52 +316,18 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
         else:
             batch_size = prompt_embeds.shape[0]
 
-        # Define tokenizers and text encoders
-        tokenizers = [self.tokenizer]
-        text_encoders = [self.text_encoder]
-
+        prompts = None
         if prompt_embeds is None:
             # textual inversion: procecss multi-vector tokens if necessary
-            prompt_embeds_list = []
-            for tokenizer, text_encoder in zip(tokenizers, text_encoders):
-                if isinstance(self, TextualInversionLoaderMixin):
-                    prompt = self.maybe_convert_prompt(prompt, tokenizer)
-
-                text_inputs = tokenizer(
-                    prompt,
-                    padding="max_length",
-                    max_length=256,
-                    truncation=True,
-                    return_tensors="pt",
-                ).to('cuda')
-                output = text_encoder(
-                        input_ids=text_inputs['input_ids'] ,
-                        attention_mask=text_inputs['attention_mask'],
-                        position_ids=text_inputs['position_ids'],
-                        output_hidden_states=True)
-                prompt_embeds = output.hidden_states[-2].permute(1, 0, 2).clone()
-                pooled_prompt_embeds = output.hidden_states[-1][-1, :, :].clone() # [batch_size, 4096]
-                bs_embed, seq_len, _ = prompt_embeds.shape
-                prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
-                prompt_embeds = prompt_embeds.view(bs_embed * num_images_per_prompt, seq_len, -1)
-
-                prompt_embeds_list.append(prompt_embeds)
-                bs_embed = pooled_prompt_embeds.shape[0]
-                pooled_prompt_embeds = pooled_prompt_embeds.repeat(1, num_images_per_prompt).view(
-                    bs_embed * num_images_per_prompt, -1
-                )
-
-            # prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
-            prompt_embeds = prompt_embeds_list[0]
+            if isinstance(self, TextualInversionLoaderMixin):
+                prompt = self.maybe_convert_prompt(prompt, self.tokenizer)
+            prompts = [prompt] if isinstance(prompt, str) else prompt
 
         # get unconditional embeddings for classifier free guidance
         zero_out_negative_prompt = negative_prompt is None and self.config.force_zeros_for_empty_prompt
-        if do_classifier_free_guidance and negative_prompt_embeds is None and zero_out_negative_prompt:
-            negative_prompt_embeds = torch.zeros_like(prompt_embeds)
-            negative_pooled_prompt_embeds = torch.zeros_like(pooled_prompt_embeds)
-        elif do_classifier_free_guidance and negative_prompt_embeds is None:
+        uncond_tokens = None
+        if do_classifier_free_guidance and negative_prompt_embeds is None and not zero_out_negative_prompt:
             # negative_prompt = negative_prompt or ""
-            uncond_tokens: List[str]
             if negative_prompt is None:
                 uncond_tokens = [""] * batch_size
             elif prompt is not None and type(prompt) is not type(negative_prompt):
@@ -363,7 +336,8 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
                     f" {type(prompt)}."
                 )
             elif isinstance(negative_prompt, str):
-                uncond_tokens = [negative_prompt]
+                # the same negative prompt for every prompt, it is encoded once
+                uncond_tokens = [negative_prompt] * batch_size
             elif batch_size != len(negative_prompt):
                 raise ValueError(
                     f"`negative_prompt`: {negative_prompt} has batch size {len(negative_prompt)}, but `prompt`:"
@@ -372,48 +346,49 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
                 )
             else:
                 uncond_tokens = negative_prompt
+            # textual inversion: procecss multi-vector tokens if necessary
+            if isinstance(self, TextualInversionLoaderMixin):
+                uncond_tokens = self.maybe_convert_prompt(uncond_tokens, self.tokenizer)
+
+        if prompts is not None:
+            # prompts and negative prompts in one text encoder forward
+            all_prompts = prompts + (uncond_tokens if uncond_tokens is not None else [])
+            all_prompt_embeds, all_pooled_prompt_embeds = self.encode_prompts(all_prompts, device=device, max_length=256)
+            prompt_embeds = all_prompt_embeds[:len(prompts)]
+            pooled_prompt_embeds = all_pooled_prompt_embeds[:len(prompts)]
+            if uncond_tokens is not None:
+                negative_prompt_embeds = all_prompt_embeds[len(prompts):]
+                negative_pooled_prompt_embeds = all_pooled_prompt_embeds[len(prompts):]
+
+            bs_embed, seq_len, _ = prompt_embeds.shape
+            prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
+            prompt_embeds = prompt_embeds.view(bs_embed * num_images_per_prompt, seq_len, -1)
+            bs_embed = pooled_prompt_embeds.shape[0]
+            pooled_prompt_embeds = pooled_prompt_embeds.repeat(1, num_images_per_prompt).view(
+                bs_embed * num_images_per_prompt, -1
+            )
+        elif uncond_tokens is not None:
+            negative_prompt_embeds, negative_pooled_prompt_embeds = self.encode_prompts(
+                uncond_tokens, device=device, max_length=prompt_embeds.shape[1]
+            )
 
-            negative_prompt_embeds_list = []
-            for tokenizer, text_encoder in zip(tokenizers, text_encoders):
-                # textual inversion: procecss multi-vector tokens if necessary
-                if isinstance(self, TextualInversionLoaderMixin):
-                    uncond_tokens = self.maybe_convert_prompt(uncond_tokens, tokenizer)
-
-                max_length = prompt_embeds.shape[1]
-                uncond_input = tokenizer(
-                    uncond_tokens,
-                    padding="max_length",
-                    max_length=max_length,
-                    truncation=True,
-                    return_tensors="pt",
-                ).to('cuda')
-                output = text_encoder(
-                        input_ids=uncond_input['input_ids'] ,
-                        attention_mask=uncond_input['attention_mask'],
-                        position_ids=uncond_input['position_ids'],
-                        output_hidden_states=True)
-                negative_prompt_embeds = output.hidden_states[-2].permute(1, 0, 2).clone()
-                negative_pooled_prompt_embeds = output.hidden_states[-1][-1, :, :].clone() # [batch_size, 4096]
-
-                if do_classifier_free_guidance:
-                    # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
-                    seq_len = negative_prompt_embeds.shape[1]
-
-                    negative_prompt_embeds = negative_prompt_embeds.to(dtype=text_encoder.dtype, device=device)
-
-                    negative_prompt_embeds = negative_prompt_embeds.repeat(1, num_images_per_prompt, 1)
-                    negative_prompt_embeds = negative_prompt_embeds.view(
-                        batch_size * num_images_per_prompt, seq_len, -1
-                    )
+        if do_classifier_free_guidance and negative_prompt_embeds is None and zero_out_negative_prompt:
+            negative_prompt_embeds = torch.zeros_like(prompt_embeds)
+            negative_pooled_prompt_embeds = torch.zeros_like(pooled_prompt_embeds)
+        elif uncond_tokens is not None:
+            # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
+            seq_len = negative_prompt_embeds.shape[1]
 
-                    # For classifier free guidance, we need to do two forward passes.
-                    # Here we concatenate the unconditional and text embeddings into a single batch
-                    # to avoid doing two forward passes
+            negative_prompt_embeds = negative_prompt_embeds.to(dtype=self.text_encoder.dtype, device=device)
 
-                negative_prompt_embeds_list.append(negative_prompt_embeds)
+            negative_prompt_embeds = negative_prompt_embeds.repeat(1, num_images_per_prompt, 1)
+            negative_prompt_embeds = negative_prompt_embeds.view(
+                batch_size * num_images_per_prompt, seq_len, -1
+            )
 
-            # negative_prompt_embeds = torch.concat(negative_prompt_embeds_list, dim=-1)
-            negative_prompt_embeds = negative_prompt_embeds_list[0]
+            # For classifier free guidance, we need to do two forward passes.
+            # Here we concatenate the unconditional and text embeddings into a single batch
+            # to avoid doing two forward passes
             bs_embed = negative_pooled_prompt_embeds.shape[0]
             negative_pooled_prompt_embeds = negative_pooled_prompt_embeds.repeat(1, num_images_per_prompt).view(
                 bs_embed * num_images_per_prompt, -1
@@ -421,6 +396,72 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
 
         return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
 
+    # the same prompt encodes to the same embeddings as long as the tokenizer settings and text encoder don't change
+    def get_prompt_cache_key(self, prompt, max_length):
+        return (
+            prompt,
+            max_length,
+            self.tokenizer.name_or_path,
+            self.tokenizer.padding_side,
+            id(self.text_encoder),
+            getattr(self, "_lora_scale", None),
+        )
+
+    def clear_prompt_cache(self):
+        self.prompt_embedding_cache.clear()
+
+    @torch.no_grad()
+    def encode_prompts(self, prompts, device=None, max_length=256):
+        r"""
+        Encodes a list of prompts with an LRU cache of the embeddings, the prompts missing from the cache are
+        encoded in one text encoder forward.
+
+        Args:
+            prompts (`List[str]`):
+                prompts to be encoded, repeated prompts are encoded once
+            device: (`torch.device`, *optional*):
+                torch device
+            max_length (`int`):
+                token length the prompts are padded and truncated to
+
+        Returns:
+            `tuple`: prompt_embeds `[len(prompts), max_length, 4096]` and pooled_prompt_embeds `[len(prompts), 4096]`
+        """
+        device = device or self._execution_device
+        keys = [self.get_prompt_cache_key(prompt, max_length) for prompt in prompts]
+        # entries of this call, the cache may evict them when it is smaller than the batch
+        entries = {}
+        for key in keys:
+            if key in self.prompt_embedding_cache and key not in entries:
+                self.prompt_embedding_cache.move_to_end(key)
+                entries[key] = self.prompt_embedding_cache[key]
+        missing = list(dict.fromkeys(prompt for prompt, key in zip(prompts, keys) if key not in entries))
+        if len(missing) > 0:
+            text_inputs = self.tokenizer(
+                missing,
+                padding="max_length",
+                max_length=max_length,
+                truncation=True,
+                return_tensors="pt",
+            ).to(device)
+            output = self.text_encoder(
+                    input_ids=text_inputs['input_ids'] ,
+                    attention_mask=text_inputs['attention_mask'],
+                    position_ids=text_inputs['position_ids'],
+                    output_hidden_states=True)
+            prompt_embeds = output.hidden_states[-2].permute(1, 0, 2)
+            pooled_prompt_embeds = output.hidden_states[-1][-1, :, :] # [batch_size, 4096]
+            for i, prompt in enumerate(missing):
+                key = self.get_prompt_cache_key(prompt, max_length)
+                entries[key] = (prompt_embeds[i].clone(), pooled_prompt_embeds[i].clone())
+                self.prompt_embedding_cache[key] = entries[key]
+                if len(self.prompt_embedding_cache) > self.prompt_cache_size:
+                    self.prompt_embedding_cache.popitem(last=False)
+            del output, prompt_embeds, pooled_prompt_embeds
+        prompt_embeds = torch.stack([entries[key][0] for key in keys]).to(device)
+        pooled_prompt_embeds = torch.stack([entries[key][1] for key in keys]).to(device)
+        return prompt_embeds, pooled_prompt_embeds
+
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.prepare_extra_step_kwargs
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
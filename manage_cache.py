@@ -0,0 +1,49 @@
+# list, verify and garbage collect the shared embedding / latent cache registry
+# usage:
+#   python manage_cache.py list
+#   python manage_cache.py verify [--cache_key KEY] [--check_md5]
+#   python manage_cache.py gc [--max_age_days 30] [--delete_files]
+import argparse
+import time
+
+from utils.cache_registry import CacheRegistry, CACHE_REGISTRY_PATH
+
+def main():
+    parser = argparse.ArgumentParser(description="cache registry")
+    parser.add_argument("--registry", type=str, default=CACHE_REGISTRY_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list caches")
+    verify_parser = subparsers.add_parser("verify", help="check registered files exist and are unchanged")
+    verify_parser.add_argument("--cache_key", type=str, default=None)
+    verify_parser.add_argument("--check_md5", action="store_true", help="rehash files which have a stored md5")
+    gc_parser = subparsers.add_parser("gc", help="remove stale entries and unused caches")
+    gc_parser.add_argument("--max_age_days", type=float, default=None, help="forget caches not used for this many days")
+    gc_parser.add_argument("--delete_files", action="store_true", help="also delete the files of forgotten caches")
+    args = parser.parse_args()
+
+    with CacheRegistry(args.registry) as registry:
+        if args.command == "list":
+            for cache in registry.list_caches():
+                last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(cache["last_used_at"]))
+                print(f"{cache['cache_key']}  last used {last_used}")
+                print(f"  encoder: {cache['encoder_fingerprint']}  vae: {cache['vae_fingerprint']}  crop: {cache['crop_policy']}")
+                print(f"  buckets: {cache['bucket_config']}")
+                print(f"  text embeddings: {cache['text_artifacts']}  latents: {cache['latent_artifacts']}")
+                for source in cache["sources"]:
+                    print(f"  used by {source['trainer']}: {source['source']}")
+        elif args.command == "verify":
+            report = registry.verify(args.cache_key, check_md5=args.check_md5)
+            if report is None:
+                print(f"cache {args.cache_key} not found")
+                return
+            print(f"ok: {report['ok']}, missing: {len(report['missing'])}, modified: {len(report['modified'])}")
+            for path in report["missing"]:
+                print(f"  missing: {path}")
+            for path in report["modified"]:
+                print(f"  modified: {path}")
+        elif args.command == "gc":
+            stats = registry.gc(args.max_age_days, delete_files=args.delete_files)
+            print(f"removed {stats['stale_rows']} stale entries, {stats['caches']} caches, deleted {stats['deleted_files']} files")
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,8 @@ from tqdm import tqdm
 
 import numpy as np
 import shutil
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 class MPSModel():
     def __init__(self, model_name_or_path="F:/MPS/outputs/MPS_overall_checkpoint.pth", processor_name_or_path="laion/CLIP-ViT-H-14-laion2B-s32B-b79K", device="cuda"):
@@ -24,6 +26,8 @@ class MPSModel():
         self.model.model.text_model.bos_token_id = 49406
         self.model.model.text_model.eos_token_id = 49407
         self.condition = "light, color, clarity, tone, style, ambiance, artistry, shape, face, hair, hands, limbs, structure, instance, texture, quantity, attributes, position, number, location, word, things."
+        # condition text features are constant, cache them by condition string
+        self.condition_cache = {}
     def _process_image(self, image):
         if isinstance(image, dict):
             image = image["bytes"]
@@ -44,30 +48,58 @@ class MPSModel():
                 return_tensors="pt"
             ).input_ids
             return input_ids
-    def score(self, image, prompt, condition=None):
-        device = self.device
-        image_input = self._process_image(image).to(device)
-        text_input = self._tokenize(prompt).to(device)
+    def _process_images(self, images, num_workers=4):
+        if num_workers <= 1 or len(images) <= 1:
+            pixel_values = [self._process_image(image) for image in images]
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                pixel_values = list(executor.map(self._process_image, images))
+        return torch.cat(pixel_values, dim=0)
+
+    def _condition_features(self, condition):
+        if condition not in self.condition_cache:
+            condition_input = self._tokenize(condition).to(self.device)
+            with torch.no_grad():
+                condition_f, _ = self.model.model.get_text_features(condition_input)
+            self.condition_cache[condition] = condition_f
+        return self.condition_cache[condition]
+
+    def _score_tensors(self, image_input, text_input, condition):
         clip_model = self.model
-        if condition is None:
-            condition = "light, color, clarity, tone, style, ambiance, artistry, shape, face, hair, hands, limbs, structure, instance, texture, quantity, attributes, position, number, location, word, things."
-        condition_batch = self._tokenize(condition).repeat(text_input.shape[0],1).to(device)
-
         with torch.no_grad():
             text_f, text_features = clip_model.model.get_text_features(text_input)
             image_f = clip_model.model.get_image_features(image_input.half())
-            condition_f, _ = clip_model.model.get_text_features(condition_batch)
+            condition_f = self._condition_features(condition).expand(text_f.shape[0], -1, -1)
             sim_text_condition = torch.einsum('b i d, b j d -> b j i', text_f, condition_f)
             sim_text_condition = torch.max(sim_text_condition, dim=1, keepdim=True)[0]
-            sim_text_condition = sim_text_condition / sim_text_condition.max()
+            # normalize per sample so batched scores match single image scores
+            sim_text_condition = sim_text_condition / sim_text_condition.amax(dim=(1,2), keepdim=True)
             mask = torch.where(sim_text_condition > 0.3, 0, float('-inf'))
             mask = mask.repeat(1,image_f.shape[1],1)
             image_features = clip_model.cross_model(image_f, text_f,mask.half())[:,0,:]
 
             image_features = image_features / image_features.norm(dim=-1, keepdim=True)
             text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-            image_score = clip_model.logit_scale.exp() * text_features @ image_features.T
-        return image_score[0]
+            image_score = clip_model.logit_scale.exp() * (text_features * image_features).sum(dim=-1)
+        return image_score
+
+    def score(self, image, prompt, condition=None):
+        return self.score_batch([image], [prompt], condition=condition, num_workers=1)
+
+    # score lists of images and prompts, return tensor of scores with shape (len(images),)
+    def score_batch(self, images, prompts, condition=None, batch_size=16, num_workers=4):
+        device = self.device
+        if isinstance(prompts, str):
+            prompts = [prompts] * len(images)
+        assert len(images) == len(prompts), "images and prompts must have the same length"
+        if condition is None:
+            condition = self.condition
+        scores = []
+        for i in range(0, len(images), batch_size):
+            image_input = self._process_images(images[i:i + batch_size], num_workers=num_workers).to(device)
+            text_input = self._tokenize(prompts[i:i + batch_size]).to(device)
+            scores.append(self._score_tensors(image_input, text_input, condition))
+        return torch.cat(scores, dim=0)
 
 # function return list, if single image, return list with one element. if two images, return list with two elements.
 def calc_mps_multiple(images, prompt, condition, clip_model, clip_processor, tokenizer, device):
@@ -174,6 +206,8 @@ if __name__ == "__main__":
     image_files = [f for f in files if os.path.splitext(f)[-1].lower() in supported_image_types]
 
     image_files = ["F:/ImageSet/SA1B_caption_selected/female/sa_1001.webp"]
+    score_images = []
+    prompts = []
     for image_file in tqdm(image_files):
         text_file = ""
         for image_type in supported_image_types:
@@ -184,15 +218,10 @@ if __name__ == "__main__":
             continue
         
         prompt = open(text_file, "r", encoding="utf-8").read()
-        mps_score = mps_model.score(image_file, prompt)
-        print(mps_score)
-        # mps_score_1 = calc_mps(image_file, prompt, condition, model, image_processor, tokenizer, device)[0]
-        
-        # print("\n")
-        # print(mps_score_1)
-        
-        # mps_score_2 = infer_one_sample(image_file, prompt, condition, model, image_processor, tokenizer, device)
-        # print(mps_score_2)
+        score_images.append(image_file)
+        prompts.append(prompt)
+    mps_scores = mps_model.score_batch(score_images, prompts)
+    print(mps_scores)
 
     # if os.path.exists(result_path):
     #     mps_score_list = json.load(open(result_path, "r", encoding='utf-8'))
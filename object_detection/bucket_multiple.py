@@ -9,6 +9,9 @@ import numpy
 import aesthetic.aesthetic_predict as aesthetic_predict
 
 import glob
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from utils.score_store import ScoreStore
 
 
 BASE_RESOLUTION = 1024
@@ -163,7 +166,7 @@ def simple_center_crop(image,scale_with_height,closest_resolution):
     # return cv2.resize(cropped_image, closest_resolution)
     return resize(cropped_image,closest_resolution)
 
-def pixel_preserved_crop(image,scale_with_height,closest_resolution,model,processor):
+def pixel_preserved_crop(image,scale_with_height,closest_resolution,model,processor,bbox=None):
     height, width, _ = image.shape
     # print("ori size:",width,height)
     if scale_with_height: 
@@ -176,7 +179,9 @@ def pixel_preserved_crop(image,scale_with_height,closest_resolution,model,proces
     diff_x = abs(expanded_closest_size[0] - width)
     diff_y = abs(expanded_closest_size[1] - height)
 
-    min_x,min_y,max_x,max_y = get_biggest_features_bbox(model,processor,image)
+    if bbox is None:
+        bbox = get_biggest_features_bbox(model,processor,image)
+    min_x,min_y,max_x,max_y = bbox
 
     # handle features using full width and height
     try:
@@ -207,10 +212,12 @@ def pixel_preserved_crop(image,scale_with_height,closest_resolution,model,proces
     # return cv2.resize(cropped_image, closest_resolution)
     return resize(cropped_image,closest_resolution)
 
-def features_centered_crop(image,scale_with_height,closest_resolution,model,processor,draw=False):
+def features_centered_crop(image,scale_with_height,closest_resolution,model,processor,draw=False,bbox=None):
     height, width, _ = image.shape
 
-    min_x,min_y,max_x,max_y = get_biggest_features_bbox(model,processor,image)
+    if bbox is None:
+        bbox = get_biggest_features_bbox(model,processor,image)
+    min_x,min_y,max_x,max_y = bbox
 
     ori_center = (int(width / 2), int(height / 2))
     new_center = (int((max_x + min_x) / 2), int((max_y + min_y) / 2))
@@ -316,24 +323,48 @@ def features_centered_crop(image,scale_with_height,closest_resolution,model,proc
     # resize image to target resolution
     return resized_image
 
-def apply_crop(model,processor,image_path,output_dir,highest_count,ae_model,image_encoder,preprocess,device):
+# read image as BGR array, used by the decode pool
+def decode_image(image_path):
+    image = Image.open(image_path).convert('RGB')
+    open_cv_image = numpy.array(image)
+    # Convert RGB to BGR
+    return open_cv_image[:, :, ::-1].copy()
+
+# yield (image_path, image) with at most window images decoded ahead
+def prefetch_decode(decode_pool,image_paths,window=16):
+    def safe_decode_image(image_path):
+        try:
+            return decode_image(image_path)
+        except Exception as e:
+            print(e)
+            return None
+    futures = []
+    for image_path in image_paths:
+        futures.append((image_path, decode_pool.submit(safe_decode_image, image_path)))
+        if len(futures) >= window:
+            image_path, future = futures.pop(0)
+            yield image_path, future.result()
+    for image_path, future in futures:
+        yield image_path, future.result()
+
+# score all candidate crops in one forward
+# same steps as aesthetic_predict.predict: clip preprocess, encode_image, l2 normalize, mlp
+def predict_batch(ae_model,image_encoder,preprocess,images,device):
+    pixel_values = torch.stack([preprocess(Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))) for image in images]).to(device)
+    with torch.no_grad():
+        image_features = image_encoder.encode_image(pixel_values).float()
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        prediction = ae_model(image_features)
+    return [score.item() for score in prediction.flatten()]
+
+def apply_crop(model,processor,image_path,output_dir,highest_count,ae_model,image_encoder,preprocess,device,image=None):
     os.makedirs(output_dir, exist_ok=True)
 
     filename, ext = os.path.splitext(os.path.basename(image_path))
 
-    # pil_image = Image.open(image_path).convert('RGB')
-    # open_cv_image = numpy.array(pil_image)
-    # # Convert RGB to BGR
-    # image = open_cv_image[:, :, ::-1].copy()
-
-    # read image
-    image = Image.open(image_path)
-    # image_ori = image.copy()
-
-    # pil_image = Image.open(image_path).convert('RGB')
-    open_cv_image = numpy.array(image)
-    # # Convert RGB to BGR
-    image = open_cv_image[:, :, ::-1].copy()
+    # read image, skipped when decoded ahead by the decode pool
+    if image is None:
+        image = decode_image(image_path)
 
     # image = cv2.imread(image_path)  # Replace with your image path
     if image is None:
@@ -363,15 +394,18 @@ def apply_crop(model,processor,image_path,output_dir,highest_count,ae_model,imag
         raise e
     
     
+    # run detection once and share the bbox across crop strategies
+    bbox = get_biggest_features_bbox(model,processor,image)
+
     try:
-        pixel_preserved_crop_image = pixel_preserved_crop(image,scale_with_height,closest_resolution,model,processor)
+        pixel_preserved_crop_image = pixel_preserved_crop(image,scale_with_height,closest_resolution,model,processor,bbox=bbox)
         # save_webp(pixel_preserved_crop_image,filename,'preserved',os.path.join(output_dir,"preserved"))
     except Exception as e:
         print(e)
         raise e
 
     try:
-        features_centered_crop_image = features_centered_crop(image,scale_with_height,closest_resolution,model,processor)
+        features_centered_crop_image = features_centered_crop(image,scale_with_height,closest_resolution,model,processor,bbox=bbox)
         # save_webp(features_centered_crop_image,filename,'centered',os.path.join(output_dir,"centered"))
     except Exception as e:
         print(e)
@@ -379,9 +413,8 @@ def apply_crop(model,processor,image_path,output_dir,highest_count,ae_model,imag
 
 
 
-    simple_score = aesthetic_predict.predict(ae_model,image_encoder,preprocess,simple_crop_image,device)
-    preserved_score = aesthetic_predict.predict(ae_model,image_encoder,preprocess,pixel_preserved_crop_image,device)
-    centered_score = aesthetic_predict.predict(ae_model,image_encoder,preprocess,features_centered_crop_image,device)
+    simple_score,preserved_score,centered_score = predict_batch(ae_model,image_encoder,preprocess,
+        [simple_crop_image,pixel_preserved_crop_image,features_centered_crop_image],device)
 
     print('filename',filename)
     print('simple_score',simple_score)
@@ -431,6 +464,7 @@ def main():
     # output_dir = "F:/ImageSet/8k_images_captioned_cropped"
     input_dir = "F:/ImageSet/kolors_cosplay/train"
     output_dir = "F:/ImageSet/kolors_cosplay/cropped"
+    num_decode_workers = 8
     os.path.makedirs(output_dir, exist_ok=True)
 
     simple_score_list = []
@@ -456,23 +490,34 @@ def main():
 
     crop_methods = ["centered","preserved","simple"]
 
+    decode_pool = ThreadPoolExecutor(max_workers=num_decode_workers)
+
+    # crop scores keyed by source image content, scorer id per crop method
+    score_store = ScoreStore(os.path.join(output_dir, "scores.db"))
+
     for coser_name in os.listdir(input_dir):
         coser_dir = os.path.join(input_dir, coser_name)
         files = glob.glob(f"{coser_dir}/**", recursive=True)
         image_exts = [".png",".jpg",".jpeg",".webp"]
         image_files = [f for f in files if os.path.splitext(f)[-1].lower() in image_exts]
         output_subdir = os.path.join(output_dir, coser_name)
-        for file_path in tqdm(image_files):
+        # decode images ahead in a thread pool while the gpu runs detection and scoring
+        for file_path, image in tqdm(prefetch_decode(decode_pool, image_files, num_decode_workers * 2), total=len(image_files)):
             try:
+                if image is None:
+                    raise Exception(f"Error: Could not read image from {file_path}")
                 simple_score,preserved_score,centered_score,highest_score = apply_crop(model,
                     processor,file_path,output_subdir,
                     highest_count,ae_model,image_encoder,
-                    preprocess,device)    
+                    preprocess,device,image=image)    
                 
                 simple_score_list.append(simple_score)
                 preserved_score_list.append(preserved_score)
                 centered_score_list.append(centered_score)
                 highest_score_list.append(highest_score)
+                image_hash = score_store.hash(file_path)
+                for crop_method, score in zip(["simple","preserved","centered"], [simple_score,preserved_score,centered_score]):
+                    score_store.upsert(f"aesthetic_{crop_method}", [(image_hash, score, file_path)])
             except Exception as e: 
                 print(e)
 
@@ -518,6 +563,7 @@ def main():
     print(f'len:{len(centered_score_list)} centered_average:{centered_average}')
     print(f'len:{len(highest_score_list)} highest_average:{highest_average}')
 
+    decode_pool.shutdown()
     print('highest_count',highest_count)
     print('done')
 
@@ -112,6 +112,7 @@ if is_wandb_available():
 from safetensors.torch import save_file
 
 from utils.dist_utils import flush
+from utils.safetensors_utils import LazyStateDict
 
 from hashlib import md5
 import glob
@@ -126,6 +127,13 @@ from utils.image_utils_kolors import compute_text_embeddings
 from utils.dist_utils import flush
 
 from utils.utils import get_md5_by_path
+from utils.cache_registry import (
+    CacheRegistry, TEXT, LATENT, CENTER_CROP_POLICY,
+    hash_text, get_bucket_config, get_text_key, get_latent_key
+)
+from utils.model_fingerprint import get_encoder_fingerprint, get_vae_fingerprint
+from utils.image_utils_kolors import RESOLUTION_CONFIG
+from utils.generation_journal import GenerationJournal
 from compel import Compel, ReturnedEmbeddingsType
 import shutil
 import re
@@ -235,6 +243,18 @@ def parse_args(input_args=None):
         default=None,
         help=("seperate vae path"),
     )
+    parser.add_argument(
+        "--encode_batch_size",
+        type=int,
+        default=16,
+        help=("prompts per text encoder call"),
+    )
+    parser.add_argument(
+        "--render_batch_size",
+        type=int,
+        default=4,
+        help=("images of the same resolution per pipeline call"),
+    )
     parser.add_argument(
         "--is_kolors",
         default=True,
@@ -477,18 +497,20 @@ def main(args):
     
         if not (args.model_path is None or args.model_path == ""):
             # load from file
-            state_dict = safetensors.torch.load_file(args.model_path, device="cpu")
+            # lazy view over the file, tensors are read one at a time directly in weight_dtype
+            state_dict = LazyStateDict(args.model_path, dtype=weight_dtype)
             unexpected_keys = load_model_dict_into_meta(
                 unet,
                 state_dict,
                 device=device,
-                dtype=torch.float32,
+                dtype=weight_dtype,
                 model_name_or_path=args.model_path,
             )
             # updated_state_dict = unet.state_dict()
             if len(unexpected_keys) > 0:
                 print(f"Unexpected keys in state_dict: {unexpected_keys}")
             unet.to(device, dtype=weight_dtype)
+            state_dict.close()
             del state_dict,unexpected_keys
             flush()
     # pipe = OriStableDiffusionXLPipeline.from_pretrained(
@@ -503,11 +525,6 @@ def main(args):
             scheduler=scheduler,
             force_zeros_for_empty_prompt=False
         ).to("cuda")
-        pipe.enable_model_cpu_offload()
-        
-        text_encoder.to("cpu")
-        # tokenizer.to("cpu")
-        del text_encoder, tokenizer
         
         # cache negative prompt to train_data_dir
         # for negative
@@ -535,15 +552,28 @@ def main(args):
 
         pipe.scheduler = scheduler
     
+    # prompts of a batch are encoded in one text encoder call
+    def encode_captions(captions):
+        if args.is_kolors:
+            return compute_text_embeddings([text_encoder],[tokenizer],captions,device=text_encoder.device)
+        return compel(captions)
+    
+    # register the kolors embeddings, so the trainers find them by prompt instead of by file name
+    # the kolors embeddings are stamped with the text encoder fingerprint
+    registry = None
+    encoder_fingerprint = None
+    vae_fingerprint = None
+    if args.is_kolors:
+        registry = CacheRegistry()
+        encoder_fingerprint = get_encoder_fingerprint(args.pretrained_model_name_or_path)
+        vae_fingerprint = get_vae_fingerprint(args.pretrained_model_name_or_path, args.vae_path)
+        text_key = get_text_key(encoder_fingerprint)
     neg_npz_path = f"{output_dir}/negative.npkolors"
     if os.path.exists(neg_npz_path):
         # load file
         neg_npz_dict = torch.load(neg_npz_path)
     else:
-        if args.is_kolors:
-            prompt_embeds, pooled_prompt_embeds = compute_text_embeddings([text_encoder],[tokenizer],neg_prompt,device=text_encoder.device)
-        else:
-            prompt_embeds, pooled_prompt_embeds = compel(neg_prompt)
+        prompt_embeds, pooled_prompt_embeds = encode_captions(neg_prompt)
         prompt_embed = prompt_embeds.squeeze(0)
         pooled_prompt_embed = pooled_prompt_embeds.squeeze(0)
         # save embeddings
@@ -551,62 +581,93 @@ def main(args):
             "prompt_embed": prompt_embed.cpu(), 
             "pooled_prompt_embed": pooled_prompt_embed.cpu(),
         }
+        if encoder_fingerprint is not None:
+            neg_npz_dict["encoder_fingerprint"] = encoder_fingerprint
         # save latent to cache file
         torch.save(neg_npz_dict, neg_npz_path)
+    if registry is not None and neg_npz_dict.get("encoder_fingerprint", encoder_fingerprint) == encoder_fingerprint:
+        registry.register(text_key, TEXT, hash_text(neg_prompt), neg_npz_path)
+        registry.commit()
     
     # random_drop some image to avoid too many output
     resolutions = [(1024,1024)]
     # print(f"total_character: {total_character}")
-    # read file agains
-    supported_image_types = ['.txt']
     # read text file by lines
     prompt_file = "F:/CoMat/collected_data/abc5k_2.txt"
     constant = 0
+    # progress of the job, a rerun continues where the last one stopped
+    journal = GenerationJournal(os.path.join(output_dir, "generation_journal.jsonl"))
+    items = []
     with open(prompt_file, 'r', encoding="utf-8") as f:
         prompts = f.readlines()
-        for i,prompt in enumerate(prompts):
-            index = i+constant
-            text_file = os.path.join(args.output_dir, f"{index}.txt")
-            npz_path = text_file.replace(".txt",".npkolors")
-            if os.path.exists(text_file):
-                metadata["images"].append({
-                    "prompt":prompt,
-                    'npz_path_md5':get_md5_by_path(npz_path),
-                    "npz_path":npz_path,
-                    "txt_path":text_file
-                })
+    for i,prompt in enumerate(prompts):
+        index = i+constant
+        # encode the caption exactly as it is written to the txt file, the trainers encode the file content
+        caption = prompt.replace("\n","").strip()
+        text_file = os.path.join(args.output_dir, f"{index}.txt")
+        items.append({
+            # a changed prompt at the same index is generated again
+            "key": f"{index}:{hash_text(caption)}",
+            "prompt": prompt,
+            "caption": caption,
+            "txt_path": text_file,
+            "npz_path": text_file.replace(".txt",".npkolors"),
+            "resolution": resolutions[index % len(resolutions)],
+        })
+    
+    # outputs of runs from before the journal are adopted once, when the caption still matches
+    for item in items:
+        if item["key"] in journal.records or not os.path.exists(item["txt_path"]) or not os.path.exists(item["npz_path"]):
+            continue
+        with open(item["txt_path"], 'r', encoding="utf-8") as f:
+            if f.read() != item["caption"]:
                 continue
-            else:
-                print('text_file not exist, ', text_file)
-            if args.is_kolors:
-                # for positive images generation
-                prompt_embeds, pooled_prompt_embeds = compute_text_embeddings([text_encoder],[tokenizer],prompt,device=text_encoder.device)
-            else:
-                prompt_embeds, pooled_prompt_embeds = compel(prompt)
-            prompt_embed = prompt_embeds.squeeze(0)
-            pooled_prompt_embed = pooled_prompt_embeds.squeeze(0)
-            # save embeddings
+        journal.mark(item["key"], "encoded", npz_path_md5=get_md5_by_path(item["npz_path"]))
+        image_path = item["txt_path"].replace(".txt",f".webp")
+        if os.path.exists(image_path):
+            journal.mark(item["key"], "rendered", image_path=image_path)
+    journal.sync()
+    
+    # encode prompts in batches
+    pending = [item for item in items if not journal.is_done(item["key"], "encoded")]
+    print(f"prompts to encode: {len(pending)} / {len(items)}")
+    for batch_start in tqdm(range(0, len(pending), args.encode_batch_size)):
+        batch_items = pending[batch_start:batch_start + args.encode_batch_size]
+        prompt_embeds, pooled_prompt_embeds = encode_captions([item["caption"] for item in batch_items])
+        for k, item in enumerate(batch_items):
+            width, height = item["resolution"]
             npz_dict = {
-                "prompt_embed": prompt_embed.cpu(), 
-                "pooled_prompt_embed": pooled_prompt_embed.cpu(),
+                "prompt_embed": prompt_embeds[k].cpu(), 
+                "pooled_prompt_embed": pooled_prompt_embeds[k].cpu(),
+                "time_id": torch.tensor([height, width, 0, 0, height, width]),
             }
+            if encoder_fingerprint is not None:
+                npz_dict["encoder_fingerprint"] = encoder_fingerprint
             # save latent to cache file
-            torch.save(npz_dict, npz_path)
-            metadata["images"].append({
-                "prompt":prompt,
-                'npz_path_md5':get_md5_by_path(npz_path),
-                "npz_path":npz_path,
-                "txt_path":text_file
-            })
-            
+            torch.save(npz_dict, item["npz_path"])
             # save prompt
-            with open(text_file, 'w', encoding="utf-8") as f:
-                f.write(prompt.replace("\n","").strip())
+            with open(item["txt_path"], 'w', encoding="utf-8") as f:
+                f.write(item["caption"])
+            if registry is not None:
+                registry.register(text_key, TEXT, hash_text(item["caption"]), item["npz_path"])
+            journal.mark(item["key"], "encoded", npz_path_md5=get_md5_by_path(item["npz_path"]))
+        if registry is not None:
+            registry.commit()
+        journal.sync()
+        del prompt_embeds, pooled_prompt_embeds
+    for item in items:
+        metadata["images"].append({
+            "prompt":item["prompt"],
+            'npz_path_md5':journal.get(item["key"], "encoded")["npz_path_md5"],
+            "npz_path":item["npz_path"],
+            "txt_path":item["txt_path"]
+        })
     
-    # if args.is_kolors:
-    #     text_encoder.to("cpu")
-    #     # tokenizer.to("cpu")
-    #     del text_encoder, tokenizer
+    if args.is_kolors:
+        text_encoder.to("cpu")
+        # tokenizer.to("cpu")
+        del text_encoder, tokenizer
+        pipe.enable_model_cpu_offload()
     # else:
     #     del pipe.tokenizer, pipe.tokenizer_2, pipe.text_encoder, pipe.text_encoder_2
     #     pipe.tokenizer = None
@@ -620,71 +681,86 @@ def main(args):
     torch.backends.cuda.matmul.allow_tf32 = True
     # pipe.enable_sequential_cpu_offload()
     pipe.enable_vae_tiling()
+    # render batches of prompts with the same resolution
+    pending = [item for item in items if not journal.is_done(item["key"], "rendered")]
+    print(f"images to render: {len(pending)} / {len(items)}")
+    batches = []
+    for resolution in resolutions:
+        resolution_items = [item for item in pending if item["resolution"] == resolution]
+        for batch_start in range(0, len(resolution_items), args.render_batch_size):
+            batches.append(resolution_items[batch_start:batch_start + args.render_batch_size])
+    # the generated latents are written in the training cache format, cache_file then skips the vae encode
+    latent_key = None
+    if registry is not None:
+        latent_key = get_latent_key(vae_fingerprint, get_bucket_config(1024, RESOLUTION_CONFIG[1024]), CENTER_CROP_POLICY)
     # mps_model = MPSModel()
     with torch.no_grad():
-        for config in tqdm(metadata["images"]):
-            prompt = config["prompt"]
-            # pure_prompt = prompt.replace(f"{pos_prompt}, ","")
-            # pure_prompt = remove_tag_prefix(pure_prompt)
-            text_file = config["txt_path"]
-            # latent_path = text_file.replace(".txt",".npkolors")
-            sample_seed = seed
-            # load npz_path
-            npz_dict = torch.load(config["npz_path"])
-            prompt_embeds = torch.stack([npz_dict['prompt_embed']])
-            pooled_prompt_embeds = torch.stack([npz_dict['pooled_prompt_embed']])
-            # for i in range(generation_batch):
-            # use opposite prompt as negative prompt 
-            image_path = text_file.replace(".txt",f".webp")
-            if not os.path.exists(image_path):
-                if args.is_kolors:
-                    output,latent = pipe(
-                        prompt_embeds=prompt_embeds.to(device), 
-                        pooled_prompt_embeds=pooled_prompt_embeds.to(device), 
-                        negative_prompt_embeds=uncondition_prompt_embeds.to(device),
-                        negative_pooled_prompt_embeds=uncondition_pooled_prompt_embeds.to(device),
-                        height=resolution,
-                        width=resolution,
-                        num_inference_steps=steps,
-                        guidance_scale=cfg,
-                        num_images_per_prompt=1,
-                        generator= torch.Generator(pipe.device).manual_seed(sample_seed),
-                        )
-                    # save latent
-                    # time_id = torch.tensor(list((resolution[0], resolution[1]) + 
-                    #                             (0,0) + 
-                    #                             (resolution[0], resolution[1]))).to(vae.device, dtype=vae.dtype)
-                    # latent_dict = {
-                    #     'latent': latent[0].cpu(),
-                    #     'time_id': time_id.cpu(),
-                    # }
-                    # torch.save(latent_dict, latent_path)
-                    # del latent
-                else:
-                    output = pipe(
-                        prompt_embeds=prompt_embeds.to(device), 
-                        pooled_prompt_embeds=pooled_prompt_embeds.to(device), 
-                        negative_prompt_embeds=uncondition_prompt_embeds.to(device),
-                        negative_pooled_prompt_embeds=uncondition_pooled_prompt_embeds.to(device),
-                        height=resolution,
-                        width=resolution,
-                        num_inference_steps=steps,
-                        guidance_scale=cfg,
-                        num_images_per_prompt=1,
-                        generator= torch.Generator(device=device).manual_seed(sample_seed),
+        for batch_items in tqdm(batches):
+            width, height = batch_items[0]["resolution"]
+            batch_size = len(batch_items)
+            npz_dicts = [torch.load(item["npz_path"]) for item in batch_items]
+            prompt_embeds = torch.stack([npz_dict['prompt_embed'] for npz_dict in npz_dicts])
+            pooled_prompt_embeds = torch.stack([npz_dict['pooled_prompt_embed'] for npz_dict in npz_dicts])
+            # every prompt is rendered with the same seed, one generator per image
+            generator_device = pipe.device if args.is_kolors else device
+            generators = [torch.Generator(generator_device).manual_seed(seed) for _ in batch_items]
+            latent = None
+            if args.is_kolors:
+                output,latent = pipe(
+                    prompt_embeds=prompt_embeds.to(device), 
+                    pooled_prompt_embeds=pooled_prompt_embeds.to(device), 
+                    negative_prompt_embeds=uncondition_prompt_embeds.repeat(batch_size, 1, 1).to(device),
+                    negative_pooled_prompt_embeds=uncondition_pooled_prompt_embeds.repeat(batch_size, 1).to(device),
+                    height=height,
+                    width=width,
+                    num_inference_steps=steps,
+                    guidance_scale=cfg,
+                    num_images_per_prompt=1,
+                    generator=generators,
                     )
+            else:
+                output = pipe(
+                    prompt_embeds=prompt_embeds.to(device), 
+                    pooled_prompt_embeds=pooled_prompt_embeds.to(device), 
+                    negative_prompt_embeds=uncondition_prompt_embeds.repeat(batch_size, 1, 1).to(device),
+                    negative_pooled_prompt_embeds=uncondition_pooled_prompt_embeds.repeat(batch_size, 1).to(device),
+                    height=height,
+                    width=width,
+                    num_inference_steps=steps,
+                    guidance_scale=cfg,
+                    num_images_per_prompt=1,
+                    generator=generators,
+                )
             
+            for k, item in enumerate(batch_items):
                 # save image
-                image = output.images[0]
+                image_path = item["txt_path"].replace(".txt",f".webp")
+                output.images[k].save(image_path)
+                fields = {"image_path": image_path}
+                if latent is not None:
+                    # same file and keys cache_file writes for the lora trainer
+                    latent_path = item["npz_path"].replace(".npkolors",".nplatent")
+                    latent_dict = {
+                        'latent': latent[k].cpu(),
+                        'vae_fingerprint': vae_fingerprint,
+                    }
+                    torch.save(latent_dict, latent_path)
+                    if registry is not None:
+                        registry.register(latent_key, LATENT, get_md5_by_path(image_path), latent_path)
+                    fields["latent_path"] = latent_path
+                journal.mark(item["key"], "rendered", **fields)
+            if registry is not None:
+                registry.commit()
+            journal.sync()
             
-                print("\n")
-                print(image_path)
-                image.save(image_path)
-                
-                del output
-                sample_seed += 1000
-                del image
-                flush()  
+            del output, latent
+            flush()  
+    journal.close()
+    if registry is not None:
+        registry.close()
+    # save metadata
+    with open(metadata_path, "w", encoding='utf-8') as writefile:
+        writefile.write(json.dumps(metadata, indent=4))
             
 
 if __name__ == "__main__":
@@ -8,6 +8,8 @@ from mps.calc_mps import MPSModel
 from PIL import Image
 
 from utils.dist_utils import flush
+from utils.score_store import ScoreStore, get_prompt_hash
+from utils.file_inventory import scan_files
 import torch
 
 output_dir = "F:/ImageSet/kolors_pony/female/one_piece"
@@ -18,12 +20,65 @@ def handle_replace(result):
     result = re.sub(r'An animated[a-zA-Z ]*?of ', '', result)
     return result
 
+def get_score_prompt(score):
+    # avoid double score
+    score_prompt = "below_score_2"
+    if score >= 2 and score < 5:
+        score_prompt = "below_score_5"
+    elif score >= 5 and score < 10:
+        score_prompt = "below_score_10"
+    elif score >= 13:
+        score_prompt = "score_13_up"
+    elif score >= 15:
+        score_prompt = "score_15_up"
+    elif score >= 10:
+        score_prompt = "score_10_up"
+    return score_prompt
+
+# score pending images in one batch and write the scored prompt to _ori.txt
+# images already in the score store are not scored again
+def score_pending(pending):
+    global mps_model
+    if len(pending) == 0:
+        return
+    # mps scores the image against its prompt, the stored score is keyed by both
+    prompt_hashes = [get_prompt_hash(text) for _, text, _ in pending]
+    # (image_path, prompt_hash) -> score
+    stored_scores = {}
+    for prompt_hash in set(prompt_hashes):
+        image_paths = [item[0] for item, item_prompt_hash in zip(pending, prompt_hashes) if item_prompt_hash == prompt_hash]
+        for image_path, score in score_store.get_paths(scorer_id, image_paths, prompt_hash=prompt_hash).items():
+            stored_scores[(image_path, prompt_hash)] = score
+    unscored = [i for i, item in enumerate(pending) if (item[0], prompt_hashes[i]) not in stored_scores]
+    if len(unscored) > 0:
+        if mps_model is None:
+            mps_model = MPSModel()
+        unscored_paths = [pending[i][0] for i in unscored]
+        unscored_texts = [pending[i][1] for i in unscored]
+        scores = mps_model.score_batch(unscored_paths, unscored_texts, batch_size=score_batch_size).cpu().tolist()
+        for prompt_hash in set(prompt_hashes[i] for i in unscored):
+            indices = [k for k, i in enumerate(unscored) if prompt_hashes[i] == prompt_hash]
+            score_store.upsert_paths(scorer_id, [unscored_paths[k] for k in indices], [scores[k] for k in indices], prompt_hash=prompt_hash)
+        for i, score in zip(unscored, scores):
+            stored_scores[(pending[i][0], prompt_hashes[i])] = score
+    for (image_file, text, old_text_file), prompt_hash in zip(pending, prompt_hashes):
+        text += f", {get_score_prompt(stored_scores[(image_file, prompt_hash)])}"
+        with open(old_text_file, "w", encoding='utf-8') as writefile:
+            # save file
+            writefile.write(text)
+    pending.clear()
+
 captioner = None
 enable_caption = True
 # captioner = FlorenceLargeFtModelWrapper()
 mps_model = None
+score_batch_size = 16
+pending = []
+# mps scores are keyed by image content and prompt, so reruns skip scored images
+scorer_id = "mps_overall"
+score_store = ScoreStore(os.path.join(output_dir, "scores.db"))
 
-files = glob.glob(f"{output_dir}/**", recursive=True)
+files = scan_files(output_dir)
 image_exts = [".png",".jpg",".jpeg",".webp"]
 image_files = [f for f in files if os.path.splitext(f)[-1].lower() in image_exts and "_ori" not in f]
 with torch.no_grad():
@@ -58,37 +113,10 @@ with torch.no_grad():
                 text = f.read()
             
             if "score_" not in text:
-                # image = cv2.imread(image_file)
-                image = Image.open(image_file)
-                if mps_model is None:
-                    mps_model = MPSModel()
-                # print("\n",text)
-                score = mps_model.score(image,text).item()
-                # print(score)
-                # avoid double score
-                score_prompt = "below_score_2"
-                if score >= 2 and score < 5:
-                    score_prompt = "below_score_5"
-                elif score >= 5 and score < 10:
-                    score_prompt = "below_score_10"
-                elif score >= 13:
-                    score_prompt = "score_13_up"
-                elif score >= 15:
-                    score_prompt = "score_15_up"
-                elif score >= 10:
-                    score_prompt = "score_10_up"
-                text += f", {score_prompt}"
-                # print(text)
-                # break
-                # write actual prompt to text path
-                # print("\n",old_text_file)
-                # print(text)
-                # if os.path.exists(old_text_file):
-                #     continue
-                with open(old_text_file, "w", encoding='utf-8') as writefile:
-                    # save file
-                    writefile.write(text)
-
+                # score the whole directory per batch
+                pending.append((image_file, text, old_text_file))
+                if len(pending) >= score_batch_size:
+                    score_pending(pending)
         
             # if os.path.exists(old_text_file):
             #     text = open(old_text_file, "r", encoding="utf-8").read()
@@ -108,4 +136,5 @@ with torch.no_grad():
             #     writefile.write(new_content)
             # del image
             # flush()
-            # break
\ No newline at end of file
+            # break
+    score_pending(pending)
\ No newline at end of file
@@ -8,6 +8,7 @@ from mps.calc_mps import MPSModel
 from PIL import Image
 
 from utils.dist_utils import flush
+from utils.file_inventory import scan_files
 import torch
 from pathlib import Path
 import shutil
@@ -31,7 +32,7 @@ captioner = None
 # captioner = FlorenceLargeFtModelWrapper()
 mps_model = None
 
-files = glob.glob(f"{input_dir}/**", recursive=True)
+files = scan_files(input_dir)
 image_exts = [".png",".jpg",".jpeg",".webp"]
 image_files = [f for f in files if os.path.splitext(f)[-1].lower() in image_exts and "_ori" not in f]
 for image_file in tqdm(image_files):
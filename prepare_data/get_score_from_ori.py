@@ -8,11 +8,12 @@ from mps.calc_mps import MPSModel
 from PIL import Image
 
 from utils.dist_utils import flush
+from utils.file_inventory import scan_files
 import torch
 
 output_dir = "F:/ImageSet/kolors_pony/female/blue_archive"
 
-files = glob.glob(f"{output_dir}/**", recursive=True)
+files = scan_files(output_dir)
 image_exts = [".png",".jpg",".jpeg",".webp"]
 image_files = [f for f in files if os.path.splitext(f)[-1].lower() in image_exts and "_ori" not in f]
 
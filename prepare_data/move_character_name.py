@@ -8,12 +8,13 @@ from mps.calc_mps import MPSModel
 from PIL import Image
 
 from utils.dist_utils import flush
+from utils.file_inventory import scan_files
 import torch
 import json
 
 image_dir = "F:/ImageSet/kolors_pony/male"
 
-files = glob.glob(f"{image_dir}/**", recursive=True)
+files = scan_files(image_dir)
 image_exts = [".png",".jpg",".jpeg",".webp"]
 image_files = [f for f in files if os.path.splitext(f)[-1].lower() in image_exts]
 
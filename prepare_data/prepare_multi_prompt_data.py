@@ -128,10 +128,10 @@ from utils.image_utils_kolors import compute_text_embeddings
 from utils.dist_utils import flush
 
 from utils.utils import get_md5_by_path
+from utils.prompt_plan import get_plan_signature, iter_prompt_plan, write_manifest, iter_manifest, iter_batches, count_combinations
 from compel import Compel, ReturnedEmbeddingsType
 import shutil
 
-import itertools
 import re
 
 from mps.calc_mps import MPSModel
@@ -249,6 +249,30 @@ def parse_args(input_args=None):
         action="store_true",
         help=("if pipeline is kolors"),
     )
+    parser.add_argument(
+        "--max_prompts_per_character",
+        type=int,
+        default=None,
+        help=(
+            "seeded sample of prompt combinations per character, all combinations when not set"
+        ),
+    )
+    parser.add_argument(
+        "--drop_probability",
+        type=float,
+        default=0.3,
+        help=(
+            "probability to drop each prompt token of a combination"
+        ),
+    )
+    parser.add_argument(
+        "--encode_batch_size",
+        type=int,
+        default=16,
+        help=(
+            "prompts per text encoder batch"
+        ),
+    )
     # parser.add_argument(
     #     "--batch_size",
     #     type=int,
@@ -383,7 +407,6 @@ def main(args):
         'steps':steps,
         'cfg':cfg,
         'seed':seed,
-        'images':[]
     }
     
     # male_character_list = []
@@ -609,18 +632,20 @@ def main(args):
     # height, width
     # resolutions = [(1024, 1024),(1344, 768),(1344,1344)]
     resolutions = [(1344, 768),(1344,1344)]
-    # random_drop some image to avoid too many output
-    random_skip = 0.1
-    def randomly_drop_tokens(tokens, drop_probability=0.3):
-        return tuple(token for token in tokens if random.random() > drop_probability)
-
+    # the plan is seeded by args.seed, a rerun finds the same prompts and skips what is done
+    plan_seed = args.seed
+    plan_config = {
+        "pos_prompt": pos_prompt,
+        "seed": plan_seed,
+        "max_prompts_per_character": args.max_prompts_per_character,
+        "drop_probability": args.drop_probability,
+        "configs": [],
+    }
+    plans = []
     total_character = 0
-    # enlarge text_files
     for generation_config in generation_configs:
         all_lists = []
         dir_name = generation_config["dir_name"]
-        output_subdir = f"{output_dir}/{dir_name}"
-        os.makedirs(output_subdir, exist_ok=True)
         prompt_list = generation_config["prompt_list"]
         
         for prompt_config in prompt_list:
@@ -630,70 +655,59 @@ def main(args):
             with open(path, "r", encoding='utf-8') as readfile:
                 items = json.loads(readfile.read())
             all_lists.append(items)
-        combinations = list(itertools.product(*all_lists))
             
         character_path = generation_config["character_path"]
         with open(character_path, "r", encoding='utf-8') as readfile:
             characters = json.loads(readfile.read())
         
-        print(f"{dir_name} has {len(characters)} characters")
+        total_combinations = count_combinations(all_lists)
+        if args.max_prompts_per_character is not None:
+            total_combinations = min(total_combinations, args.max_prompts_per_character)
+        print(f"{dir_name} has {len(characters)} characters, {total_combinations} prompts per character")
         total_character += len(characters)
-        for character in characters:
-            clear_character = handle_character_name(character)
-            output_character_dir = f"{output_subdir}/{clear_character}" 
-            os.makedirs(output_character_dir, exist_ok=True)
-            for i,combination in enumerate(combinations):
-                # if random.random() < random_skip:
-                #     continue
-                desc_prompt = ', '.join(randomly_drop_tokens(combination))
-                actual_prompt = f"{pos_prompt}, {character}, {desc_prompt}"
-                text_path = f"{output_character_dir}/{i}_prompt.txt"
-                if not os.path.exists(text_path):
-                    # write actual prompt to text path
-                    with open(text_path, "w", encoding='utf-8') as writefile:
-                        # save file
-                        writefile.write(actual_prompt)
-            
+        plan_config["configs"].append({"dir_name": dir_name, "characters": characters, "lists": all_lists})
+        plans.append((dir_name, characters, all_lists))
     print(f"total_character: {total_character}")
-    # read file agains
-    supported_image_types = ['.txt']
-    files = glob.glob(f"{output_dir}/**", recursive=True)
-    text_files = [f for f in files if os.path.splitext(f)[-1].lower() in supported_image_types and "_res_" not in f]
-    print(f"total prompt files: {len(text_files)}")
-    for text_file in tqdm(text_files):
-        npz_path = text_file.replace(".txt",".npkolors")
-        prompt = ""
-        with open(text_file, 'r', encoding="utf-8") as f:
-            prompt = f.read()
-        # prompt = pos_prompt.format(prompt = content)
-        if os.path.exists(npz_path):
-            metadata["images"].append({
-                "prompt":prompt,
-                'npz_path_md5':get_md5_by_path(npz_path),
-                "npz_path":npz_path,
-                "txt_path":text_file
-            })
-            continue
+    
+    def iter_plan():
+        for dir_name, characters, all_lists in plans:
+            yield from iter_prompt_plan(dir_name, characters, all_lists, pos_prompt, plan_seed,
+                                        max_per_character=args.max_prompts_per_character,
+                                        drop_probability=args.drop_probability)
+    # one manifest for all prompts instead of a .txt per prompt
+    manifest_path = os.path.join(output_dir, "prompts_manifest.jsonl")
+    metadata["manifest_path"] = manifest_path
+    prompt_count = write_manifest(manifest_path, get_plan_signature(plan_config), iter_plan())
+    if prompt_count is None:
+        print(f"reuse prompt manifest: {manifest_path}")
+    else:
+        print(f"total prompts: {prompt_count}")
+    
+    # output paths of a manifest item, the prompt hash keeps embeddings of an older plan from being reused
+    def get_base_path(item):
+        output_character_dir = f"{output_dir}/{item['dir_name']}/{handle_character_name(item['character'])}"
+        return f"{output_character_dir}/{item['index']}_{item['prompt_hash'][:8]}_prompt"
+    
+    def encode_prompts(prompts):
         if args.is_kolors:
-            # for positive images generation
-            prompt_embeds, pooled_prompt_embeds = compute_text_embeddings([text_encoder],[tokenizer],prompt,device=text_encoder.device)
-        else:
-            prompt_embeds, pooled_prompt_embeds = compel(prompt)
-        prompt_embed = prompt_embeds.squeeze(0)
-        pooled_prompt_embed = pooled_prompt_embeds.squeeze(0)
-        # save embeddings
-        npz_dict = {
-            "prompt_embed": prompt_embed.cpu(), 
-            "pooled_prompt_embed": pooled_prompt_embed.cpu(),
-        }
-        # save latent to cache file
-        torch.save(npz_dict, npz_path)
-        metadata["images"].append({
-            "prompt":prompt,
-            'npz_path_md5':get_md5_by_path(npz_path),
-            "npz_path":npz_path,
-            "txt_path":text_file
-        })
+            return compute_text_embeddings([text_encoder],[tokenizer],prompts,device=text_encoder.device)
+        return compel(prompts)
+    
+    # encode the prompts in batches straight from the manifest
+    pending_items = (item for item in iter_manifest(manifest_path) if not os.path.exists(f"{get_base_path(item)}.npkolors"))
+    for batch_items in tqdm(iter_batches(pending_items, args.encode_batch_size)):
+        prompt_embeds, pooled_prompt_embeds = encode_prompts([item["prompt"] for item in batch_items])
+        for k, item in enumerate(batch_items):
+            npz_path = f"{get_base_path(item)}.npkolors"
+            os.makedirs(os.path.dirname(npz_path), exist_ok=True)
+            # save embeddings
+            npz_dict = {
+                "prompt_embed": prompt_embeds[k].cpu(), 
+                "pooled_prompt_embed": pooled_prompt_embeds[k].cpu(),
+            }
+            # save latent to cache file
+            torch.save(npz_dict, npz_path)
+        del prompt_embeds, pooled_prompt_embeds
         
         
     if args.is_kolors:
@@ -715,22 +729,21 @@ def main(args):
     pipe.enable_vae_tiling()
     # mps_model = MPSModel()
     with torch.no_grad():
-        for config in tqdm(metadata["images"]):
+        for config in tqdm(iter_manifest(manifest_path)):
             prompt = config["prompt"]
             pure_prompt = prompt.replace(f"{pos_prompt}, ","")
             pure_prompt = remove_tag_prefix(pure_prompt)
-            text_file = config["txt_path"]
-            latent_path = text_file.replace(".txt",".npkolors")
+            base_path = get_base_path(config)
             sample_seed = seed
             # load npz_path
-            npz_dict = torch.load(config["npz_path"])
+            npz_dict = torch.load(f"{base_path}.npkolors")
             prompt_embeds = torch.stack([npz_dict['prompt_embed']])
             pooled_prompt_embeds = torch.stack([npz_dict['pooled_prompt_embed']])
             # for i in range(generation_batch):
             # use opposite prompt as negative prompt 
             
             for resolution in resolutions:
-                image_path = text_file.replace(".txt",f"_res_{resolution[0]}x{resolution[1]}.webp")
+                image_path = f"{base_path}_res_{resolution[0]}x{resolution[1]}.webp"
                 new_text_file = image_path.replace(".webp",f".txt")
                 if not os.path.exists(image_path):
                     if args.is_kolors:
@@ -754,7 +767,8 @@ def main(args):
                             'latent': latent[0].cpu(),
                             'time_id': time_id.cpu(),
                         }
-                        torch.save(latent_dict, latent_path)
+                        # next to the image, the prompt embeddings stay in .npkolors
+                        torch.save(latent_dict, image_path.replace(".webp",".nplatent"))
                         del latent
                     else:
                         output = pipe(
@@ -114,6 +114,7 @@ from utils.dist_utils import flush
 
 from hashlib import md5
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 import os, torch
@@ -134,6 +135,37 @@ from utils.utils import get_md5_by_path
 # check_min_version("0.30.0.dev0")
 
 logger = get_logger(__name__)
+
+# estimated gpu memory for one 1024px image in a batch, unet activations with cfg
+RESIDENT_MEMORY_PER_IMAGE_GB = 1.5
+RESIDENT_MEMORY_BASE_GB = 2
+
+def use_cpu_offload(offload, batch_size):
+    if offload != "auto":
+        return offload == "always"
+    # the pipeline models are on the gpu already, so free memory is what the batch can use
+    free_memory, _ = torch.cuda.mem_get_info()
+    required = RESIDENT_MEMORY_BASE_GB + RESIDENT_MEMORY_PER_IMAGE_GB * batch_size
+    return free_memory / 1024 ** 3 < required
+
+# runs on the writer thread
+def save_training_item(save_path, latent, time_id, image):
+    latent_path = f"{save_path}.nplatent"
+    torch.save({
+        'latent': latent,
+        'time_id': time_id,
+    }, latent_path)
+    # save image
+    image_path = f"{save_path}.webp"
+    image.save(image_path)
+    return {
+        'bucket': "1024x1024",
+        'latent_path':latent_path,
+        'latent_path_md5':get_md5_by_path(latent_path),
+        'image_path':image_path,
+        'image_path_md5':get_md5_by_path(image_path),
+    }
+
 def parse_args(input_args=None):
     parser = argparse.ArgumentParser(description="Simple example of a training script.")
     parser.add_argument(
@@ -236,6 +268,24 @@ def parse_args(input_args=None):
     #     ),
     # )
     
+    parser.add_argument(
+        "--generation_batch_size",
+        type=int,
+        default=1,
+        help=(
+            "images rendered per pipeline call, positive and negative seeds are batched together"
+        ),
+    )
+    parser.add_argument(
+        "--offload",
+        type=str,
+        default="auto",
+        choices=["auto", "always", "never"],
+        help=(
+            "cpu offload of the pipeline models, auto keeps the unet on the gpu when the batch fits"
+        ),
+    )
+    
     parser.add_argument("--seed", type=int, default=None, help="A seed for generation init.")
     
     if input_args is not None:
@@ -395,7 +445,6 @@ def main(args):
         scheduler=scheduler,
         force_zeros_for_empty_prompt=False
     ).to("cuda")
-    pipe.enable_model_cpu_offload()
     
     prompt_embeds_list = []
     metadata['generation_configs'] = [
@@ -438,66 +487,64 @@ def main(args):
     # tokenizer.to("cpu")
     del text_encoder, tokenizer
     flush()
+    
+    batch_size = max(1, args.generation_batch_size)
+    # cpu offload moves the unet and vae for every call, keep them on the gpu when the batch fits
+    if use_cpu_offload(args.offload, batch_size):
+        print("cpu offload enabled")
+        pipe.enable_model_cpu_offload()
+    if batch_size > 1:
+        # decode the batch one image at a time
+        pipe.vae.enable_slicing()
+    
     # align seed with positive and negative
     pos_set_name, pos_prompt_embeds, pos_pooled_prompt_embeds = prompt_embeds_list[0]
     neg_set_name, neg_prompt_embeds, neg_pooled_prompt_embeds = prompt_embeds_list[1]
-    flush()
-    with torch.no_grad():
+    # one job per image: (set index, seed), the opposite prompt is the negative prompt
+    # the sets of a seed are next to each other, so a batch renders matching positive and negative pairs
+    for set_name, _, _ in prompt_embeds_list:
+        os.makedirs(f"{args.train_data_dir}/{set_name}", exist_ok=True)
+    jobs = []
+    for i in range(generation_batch):
         for j in range(len(prompt_embeds_list)):
-            sample_seed = seed
-            set_name, prompt_embeds, pooled_prompt_embeds = prompt_embeds_list[j]
-            save_dir = f"{args.train_data_dir}/{set_name}"
-            metadata['generation_configs'][j]['item_list'] = []
-            os.makedirs(save_dir, exist_ok=True)
-            for i in range(generation_batch):
-                # use opposite prompt as negative prompt 
-                if set_name == pos_set_name:
-                    uncondition_prompt_embeds = neg_prompt_embeds
-                    uncondition_pooled_prompt_embeds = neg_pooled_prompt_embeds
-                else:
-                    uncondition_prompt_embeds = pos_prompt_embeds
-                    uncondition_pooled_prompt_embeds = pos_pooled_prompt_embeds
-                
-                output,latent = pipe(
-                    prompt_embeds=prompt_embeds.to(device), 
-                    pooled_prompt_embeds=pooled_prompt_embeds.to(device), 
-                    negative_prompt_embeds=uncondition_prompt_embeds.to(device),
-                    negative_pooled_prompt_embeds=uncondition_pooled_prompt_embeds.to(device),
-                    height=resolution,
-                    width=resolution,
-                    num_inference_steps=steps,
-                    guidance_scale=cfg,
-                    num_images_per_prompt=1,
-                    generator= torch.Generator(pipe.device).manual_seed(sample_seed),
-                    )
-                # save latent
-                latent_path = f"{save_dir}/{args.image_prefix}_{sample_seed}.nplatent"
-                time_id = torch.tensor(list((1024, 1024) + 
-                                            (0,0) + 
-                                            (1024, 1024))).to(vae.device, dtype=vae.dtype)
-                latent_dict = {
-                    'latent': latent[0].cpu(),
-                    'time_id': time_id.cpu(),
-                }
-                torch.save(latent_dict, latent_path)
-                
-                # save image
-                image = output.images[0]
-                image_path = f"{save_dir}/{args.image_prefix}_{sample_seed}.webp"
-                image.save(image_path)
-                
-                training_item = {
-                    'bucket': "1024x1024",
-                    'latent_path':latent_path,
-                    'latent_path_md5':get_md5_by_path(latent_path),
-                    'image_path':image_path,
-                    'image_path_md5':get_md5_by_path(image_path),
-                }
-                metadata['generation_configs'][j]['item_list'].append(training_item)
-                sample_seed += 1
-                
-                del output,latent
-                flush()
+            jobs.append((j, seed + i))
+    opposite_embeds = {
+        pos_set_name: (neg_prompt_embeds, neg_pooled_prompt_embeds),
+        neg_set_name: (pos_prompt_embeds, pos_pooled_prompt_embeds),
+    }
+    time_id = torch.tensor(list((1024, 1024) + 
+                                (0,0) + 
+                                (1024, 1024))).to(dtype=vae.dtype)
+    # latents and previews are written by a background thread while the next batch renders
+    writer = ThreadPoolExecutor(max_workers=1)
+    item_futures = [[] for _ in prompt_embeds_list]
+    with torch.no_grad():
+        for batch_start in tqdm(range(0, len(jobs), batch_size)):
+            batch_jobs = jobs[batch_start:batch_start + batch_size]
+            batch_embeds = [prompt_embeds_list[j] for j, _ in batch_jobs]
+            batch_uncond = [opposite_embeds[set_name] for set_name, _, _ in batch_embeds]
+            output,latent = pipe(
+                prompt_embeds=torch.cat([embeds for _, embeds, _ in batch_embeds]).to(device), 
+                pooled_prompt_embeds=torch.cat([pooled for _, _, pooled in batch_embeds]).to(device), 
+                negative_prompt_embeds=torch.cat([embeds for embeds, _ in batch_uncond]).to(device),
+                negative_pooled_prompt_embeds=torch.cat([pooled for _, pooled in batch_uncond]).to(device),
+                height=resolution,
+                width=resolution,
+                num_inference_steps=steps,
+                guidance_scale=cfg,
+                num_images_per_prompt=1,
+                # one cpu generator per image, the same noise as rendering the seed alone
+                generator=[torch.Generator("cpu").manual_seed(sample_seed) for _, sample_seed in batch_jobs],
+                )
+            for k, (j, sample_seed) in enumerate(batch_jobs):
+                set_name = prompt_embeds_list[j][0]
+                save_path = f"{args.train_data_dir}/{set_name}/{args.image_prefix}_{sample_seed}"
+                item_futures[j].append(writer.submit(save_training_item, save_path, latent[k].cpu(), time_id, output.images[k]))
+            del output,latent
+            flush()
+    writer.shutdown(wait=True)
+    for j in range(len(prompt_embeds_list)):
+        metadata['generation_configs'][j]['item_list'] = [future.result() for future in item_futures[j]]
                     
     # save metadata
     with open(metadata_path, "w", encoding='utf-8') as writefile:
@@ -1,10 +1,11 @@
 import glob
 from tqdm import tqdm
 import os
+from utils.file_inventory import scan_files
 
 output_dir = "F:/ImageSet/kolors_pony/female/blue_archive"
 
-files = glob.glob(f"{output_dir}/**", recursive=True)
+files = scan_files(output_dir)
 image_exts = [".png",".jpg",".jpeg",".webp"]
 image_files = [f for f in files if os.path.splitext(f)[-1].lower() in image_exts and "_ori" not in f]
 for image_file in tqdm(image_files):
@@ -2,6 +2,7 @@ import os
 import glob
 import random
 from tqdm import tqdm
+from utils.file_inventory import scan_files
 
 input_dir = "F:/ImageSet/SA1B_caption"
 
@@ -16,7 +17,7 @@ others_output_dir = f"{output_dir}/others"
 os.makedirs(others_output_dir,exist_ok=True)
 
 supported_image_types = ['.txt']
-files = glob.glob(f"{input_dir}/**", recursive=True)
+files = scan_files(input_dir)
 text_files = [f for f in files if os.path.splitext(f)[-1].lower() in supported_image_types]
 
 random.shuffle(text_files)
@@ -98,17 +98,75 @@ class LoRAModule(nn.Module):
 
         self.multiplier = multiplier
         self.org_module = org_module  # remove in applying
+        # kept in a list so it isn't registered as a submodule, merge writes to its weight
+        self.org_module_ref = [org_module]
+        self.merged = False
+        self.org_weight_backup = None
+
+    # a float, or one multiplier per sample as a list / 1d tensor
+    @property
+    def multiplier(self):
+        return self._multiplier
+
+    @multiplier.setter
+    def multiplier(self, value):
+        if isinstance(value, (list, tuple)):
+            value = torch.tensor(value, dtype=torch.float32)
+        self._multiplier = value
+        # the adapter is skipped while it has no effect
+        if isinstance(value, torch.Tensor):
+            self.skip = bool((value == 0).all())
+        else:
+            self.skip = value == 0
 
     def apply_to(self):
         self.org_forward = self.org_module.forward
         self.org_module.forward = self.forward
         del self.org_module
 
+    # up @ down * scale in the shape of the original weight
+    def get_delta_weight(self):
+        up = self.lora_up.weight.float()
+        down = self.lora_down.weight.float()
+        if up.dim() == 4:
+            # up is 1x1, the product keeps the kernel of down
+            delta = (up.flatten(1) @ down.flatten(1)).reshape(up.shape[0], *down.shape[1:])
+        else:
+            delta = up @ down
+        return delta * self.scale
+
+    # fold the adapter into the original weight for inference, the original weight is kept on cpu for unmerge
+    @torch.no_grad()
+    def merge(self, multiplier):
+        if self.merged:
+            return
+        weight = self.org_module_ref[0].weight
+        self.org_weight_backup = weight.data.to("cpu", copy=True)
+        weight.data += (self.get_delta_weight() * multiplier).to(weight.device, weight.dtype)
+        self.merged = True
+
+    # restores the exact original weight
+    @torch.no_grad()
+    def unmerge(self):
+        if not self.merged:
+            return
+        weight = self.org_module_ref[0].weight
+        weight.data.copy_(self.org_weight_backup.to(weight.device))
+        self.org_weight_backup = None
+        self.merged = False
+
     def forward(self, x):
-        return (
-            self.org_forward(x)
-            + self.lora_up(self.lora_down(x)) * self.multiplier * self.scale
-        )
+        if self.merged or self.skip:
+            return self.org_forward(x)
+        lora_out = self.lora_up(self.lora_down(x))
+        multiplier = self.multiplier
+        if isinstance(multiplier, torch.Tensor):
+            # one multiplier per sample, tiled when the batch was repeated (e.g. [uncond, cond] for cfg)
+            multiplier = multiplier.to(lora_out.device, lora_out.dtype)
+            if lora_out.shape[0] != multiplier.shape[0]:
+                multiplier = multiplier.repeat(lora_out.shape[0] // multiplier.shape[0])
+            multiplier = multiplier.reshape([-1] + [1] * (lora_out.dim() - 1))
+        return self.org_forward(x) + lora_out * (multiplier * self.scale)
 
 
 class LoRANetwork(nn.Module):
@@ -261,12 +319,32 @@ class LoRANetwork(nn.Module):
             save_file(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
+    # scale can be a list with one scale per sample, to compare slider scales in one batched forward
     def set_lora_slider(self, scale):
         self.lora_scale = scale
 
+    def get_lora_multiplier(self):
+        if isinstance(self.lora_scale, (list, tuple, torch.Tensor)):
+            return torch.as_tensor(self.lora_scale, dtype=torch.float32)
+        return 1.0 * self.lora_scale
+
+    # fold the loras into the unet weights for sampling, training needs unmerge first
+    def merge(self, scale=None):
+        if scale is None:
+            scale = self.lora_scale
+        if isinstance(scale, (list, tuple, torch.Tensor)):
+            raise ValueError("merge needs a single scale, per sample scales only work unmerged")
+        for lora in self.unet_loras:
+            lora.merge(1.0 * scale)
+
+    def unmerge(self):
+        for lora in self.unet_loras:
+            lora.unmerge()
+
     def __enter__(self):
+        multiplier = self.get_lora_multiplier()
         for lora in self.unet_loras:
-            lora.multiplier = 1.0 * self.lora_scale
+            lora.multiplier = multiplier
 
     def __exit__(self, exc_type, exc_value, tb):
         for lora in self.unet_loras:
@@ -0,0 +1,161 @@
+# equivalence check and cpu micro benchmark of comfy.utils.bislerp against the previous implementation
+# exits with 1 when an output differs from the reference
+# example:
+#   python test/bench_bislerp.py
+#   python test/bench_bislerp.py --repeat 10 --skip_check
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comfy.utils import bislerp
+
+# previous implementation, kept for the comparison
+def bislerp_reference(samples, width, height):
+    def slerp(b1, b2, r):
+        '''slerps batches b1, b2 according to ratio r, batches should be flat e.g. NxC'''
+
+        c = b1.shape[-1]
+
+        #norms
+        b1_norms = torch.norm(b1, dim=-1, keepdim=True)
+        b2_norms = torch.norm(b2, dim=-1, keepdim=True)
+
+        #normalize
+        b1_normalized = b1 / b1_norms
+        b2_normalized = b2 / b2_norms
+
+        #zero when norms are zero
+        b1_normalized[b1_norms.expand(-1,c) == 0.0] = 0.0
+        b2_normalized[b2_norms.expand(-1,c) == 0.0] = 0.0
+
+        #slerp
+        dot = (b1_normalized*b2_normalized).sum(1)
+        omega = torch.acos(dot)
+        so = torch.sin(omega)
+
+        #technically not mathematically correct, but more pleasing?
+        res = (torch.sin((1.0-r.squeeze(1))*omega)/so).unsqueeze(1)*b1_normalized + (torch.sin(r.squeeze(1)*omega)/so).unsqueeze(1) * b2_normalized
+        res *= (b1_norms * (1.0-r) + b2_norms * r).expand(-1,c)
+
+        #edge cases for same or polar opposites
+        res[dot > 1 - 1e-5] = b1[dot > 1 - 1e-5]
+        res[dot < 1e-5 - 1] = (b1 * (1.0-r) + b2 * r)[dot < 1e-5 - 1]
+        return res
+
+    def generate_bilinear_data(length_old, length_new, device):
+        coords_1 = torch.arange(length_old, dtype=torch.float32, device=device).reshape((1,1,1,-1))
+        coords_1 = torch.nn.functional.interpolate(coords_1, size=(1, length_new), mode="bilinear")
+        ratios = coords_1 - coords_1.floor()
+        coords_1 = coords_1.to(torch.int64)
+
+        coords_2 = torch.arange(length_old, dtype=torch.float32, device=device).reshape((1,1,1,-1)) + 1
+        coords_2[:,:,:,-1] -= 1
+        coords_2 = torch.nn.functional.interpolate(coords_2, size=(1, length_new), mode="bilinear")
+        coords_2 = coords_2.to(torch.int64)
+        return ratios, coords_1, coords_2
+
+    orig_dtype = samples.dtype
+    samples = samples.float()
+    n,c,h,w = samples.shape
+    h_new, w_new = (height, width)
+
+    #linear w
+    ratios, coords_1, coords_2 = generate_bilinear_data(w, w_new, samples.device)
+    coords_1 = coords_1.expand((n, c, h, -1))
+    coords_2 = coords_2.expand((n, c, h, -1))
+    ratios = ratios.expand((n, 1, h, -1))
+
+    pass_1 = samples.gather(-1,coords_1).movedim(1, -1).reshape((-1,c))
+    pass_2 = samples.gather(-1,coords_2).movedim(1, -1).reshape((-1,c))
+    ratios = ratios.movedim(1, -1).reshape((-1,1))
+
+    result = slerp(pass_1, pass_2, ratios)
+    result = result.reshape(n, h, w_new, c).movedim(-1, 1)
+
+    #linear h
+    ratios, coords_1, coords_2 = generate_bilinear_data(h, h_new, samples.device)
+    coords_1 = coords_1.reshape((1,1,-1,1)).expand((n, c, -1, w_new))
+    coords_2 = coords_2.reshape((1,1,-1,1)).expand((n, c, -1, w_new))
+    ratios = ratios.reshape((1,1,-1,1)).expand((n, 1, -1, w_new))
+
+    pass_1 = result.gather(-2,coords_1).movedim(1, -1).reshape((-1,c))
+    pass_2 = result.gather(-2,coords_2).movedim(1, -1).reshape((-1,c))
+    ratios = ratios.movedim(1, -1).reshape((-1,1))
+
+    result = slerp(pass_1, pass_2, ratios)
+    result = result.reshape(n, h_new, w_new, c).movedim(-1, 1)
+    return result.to(orig_dtype)
+
+# (name, samples, width, height)
+def get_check_cases():
+    torch.manual_seed(0)
+    cases = [
+        ("upscale 1.5x", torch.randn(2, 4, 64, 48), 72, 96),
+        ("downscale", torch.randn(1, 4, 96, 96), 40, 56),
+        ("same size", torch.randn(1, 4, 32, 32), 32, 32),
+        ("single pixel", torch.randn(1, 4, 1, 1), 8, 8),
+        ("fp16", torch.randn(1, 4, 32, 40).half(), 60, 48),
+        ("non contiguous", torch.randn(1, 32, 40, 4).movedim(-1, 1), 50, 64),
+    ]
+    # zero vectors, equal neighbours and polar opposites hit the edge cases of slerp
+    edge = torch.randn(1, 4, 16, 16)
+    edge[:, :, :, 4] = 0.0
+    edge[:, :, :, 8] = edge[:, :, :, 9]
+    edge[:, :, :, 12] = -edge[:, :, :, 13]
+    edge[:, :, 6] = -edge[:, :, 7]
+    cases.append(("edge cases", edge, 37, 29))
+    return cases
+
+def check(atol):
+    failed = False
+    for name, samples, width, height in get_check_cases():
+        reference = bislerp_reference(samples, width, height)
+        result = bislerp(samples, width, height)
+        same_nan = torch.equal(torch.isnan(reference), torch.isnan(result))
+        max_diff = (result.float() - reference.float()).nan_to_num().abs().max().item()
+        ok = result.shape == reference.shape and result.dtype == reference.dtype and same_nan and max_diff <= atol
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {tuple(samples.shape)} -> {tuple(result.shape)}, max abs diff {max_diff:.2e}")
+        failed = failed or not ok
+    return not failed
+
+def measure(fn, repeat):
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="bislerp equivalence check and benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="take the best of n runs")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--skip_check", action="store_true")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if not args.skip_check and not check(args.atol):
+        print("bislerp differs from the reference")
+        sys.exit(1)
+
+    # latent upscales as used for hires fix
+    benchmarks = [
+        ("sdxl latent 1.5x", (1, 4, 128, 128), 192, 192),
+        ("sdxl latent 2x batch 4", (4, 4, 128, 128), 256, 256),
+        ("portrait 1.5x", (1, 4, 168, 96), 144, 252),
+    ]
+    for name, shape, width, height in benchmarks:
+        samples = torch.randn(shape)
+        reference_time = measure(lambda: bislerp_reference(samples, width, height), args.repeat)
+        new_time = measure(lambda: bislerp(samples, width, height), args.repeat)
+        print(f"{name}: reference {reference_time * 1000:.1f} ms, new {new_time * 1000:.1f} ms, speedup {reference_time / new_time:.2f}x")
+
+if __name__ == "__main__":
+    main()
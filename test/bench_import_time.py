@@ -0,0 +1,91 @@
+# import time benchmark for the trainers, based on python -X importtime
+# example:
+#   python test/bench_import_time.py --module train_kolors_lora_ui --save import_time.json
+#   python test/bench_import_time.py --module train_kolors_lora_ui --baseline import_time.json
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+# return list of (module, self_us, cumulative_us, depth)
+def parse_importtime(stderr):
+    rows = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        rows.append((module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return rows
+
+def measure_import(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=REPO_DIR, capture_output=True, text=True)
+    rows = parse_importtime(result.stderr)
+    total_us = sum(row[1] for row in rows)
+    top_level = sorted([row for row in rows if row[3] == 0], key=lambda row: row[2], reverse=True)
+    return {
+        "returncode": result.returncode,
+        "total_ms": total_us / 1000,
+        "top_level": {row[0]: row[2] / 1000 for row in top_level},
+    }
+
+# wall time until argparse answers, the config is checked before the heavy imports
+def measure_help(script):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, "--help"], cwd=REPO_DIR, capture_output=True)
+    return (time.perf_counter() - start) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="import time benchmark")
+    parser.add_argument("--module", type=str, default="train_kolors_lora_ui")
+    parser.add_argument("--repeat", type=int, default=3, help="take the best of n runs")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--save", type=str, default=None, help="save result json")
+    parser.add_argument("--baseline", type=str, default=None, help="compare with a saved result json")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed regression ratio against baseline")
+    args = parser.parse_args()
+
+    results = [measure_import(args.module) for _ in range(args.repeat)]
+    result = min(results, key=lambda r: r["total_ms"])
+    if result["returncode"] != 0:
+        print(f"import {args.module} failed, timings only cover the modules imported before the error")
+    help_ms = min(measure_help(f"{args.module}.py") for _ in range(args.repeat))
+    result["help_ms"] = help_ms
+
+    print(f"module: {args.module}")
+    print(f"total import time: {result['total_ms']:.1f} ms")
+    print(f"--help wall time: {help_ms:.1f} ms")
+    print("top level imports (cumulative ms):")
+    for module, ms in list(result["top_level"].items())[:args.top]:
+        print(f"  {ms:10.1f}  {module}")
+
+    if args.save is not None:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=4)
+        print(f"saved to {args.save}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressed = False
+        for key in ["total_ms", "help_ms"]:
+            ratio = result[key] / max(baseline[key], 1e-6) - 1
+            print(f"{key}: {baseline[key]:.1f} -> {result[key]:.1f} ({ratio * 100:+.1f}%)")
+            if ratio > args.threshold:
+                regressed = True
+        new_modules = [module for module in result["top_level"] if module not in baseline["top_level"]]
+        if len(new_modules) > 0:
+            print("new top level imports:", ", ".join(new_modules))
+        if regressed:
+            print("import time regression")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
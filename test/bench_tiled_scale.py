@@ -0,0 +1,96 @@
+# cpu benchmark of comfy.utils.tiled_scale against the previous one tile at a time implementation
+# function is a small conv upscaler standing in for a vae decoder
+# example:
+#   python test/bench_tiled_scale.py
+#   python test/bench_tiled_scale.py --size 128 --batch 2 --tile_batch_size 16
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comfy.utils import tiled_scale
+
+# previous implementation, kept for the comparison
+@torch.inference_mode()
+def tiled_scale_reference(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None):
+    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
+    for b in range(samples.shape[0]):
+        s = samples[b:b+1]
+        out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
+        out_div = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
+        for y in range(0, s.shape[2], tile_y - overlap):
+            for x in range(0, s.shape[3], tile_x - overlap):
+                x = max(0, min(s.shape[-1] - overlap, x))
+                y = max(0, min(s.shape[-2] - overlap, y))
+                s_in = s[:,:,y:y+tile_y,x:x+tile_x]
+
+                ps = function(s_in).to(output_device)
+                mask = torch.ones_like(ps)
+                feather = round(overlap * upscale_amount)
+                for t in range(feather):
+                        mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
+                        mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
+                        mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
+                        mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
+                out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
+                out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
+                if pbar is not None:
+                    pbar.update(1)
+
+        output[b:b+1] = out/out_div
+    return output
+
+class Upscaler(torch.nn.Module):
+    def __init__(self, in_channels, out_channels, upscale_amount):
+        super().__init__()
+        self.upscale_amount = upscale_amount
+        self.conv_in = torch.nn.Conv2d(in_channels, 32, 3, padding=1)
+        self.conv_out = torch.nn.Conv2d(32, out_channels, 3, padding=1)
+
+    def forward(self, x):
+        x = torch.nn.functional.silu(self.conv_in(x))
+        x = torch.nn.functional.interpolate(x, scale_factor=self.upscale_amount, mode="nearest")
+        return self.conv_out(x)
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def main():
+    parser = argparse.ArgumentParser(description="tiled_scale benchmark")
+    parser.add_argument("--size", type=int, default=96, help="latent height and width")
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--tile", type=int, default=32)
+    parser.add_argument("--overlap", type=int, default=8)
+    parser.add_argument("--upscale_amount", type=int, default=8)
+    parser.add_argument("--tile_batch_size", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3, help="take the best of n runs")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    samples = torch.randn(args.batch, 4, args.size, args.size)
+    function = Upscaler(4, 3, args.upscale_amount).eval()
+    kwargs = {"tile_x": args.tile, "tile_y": args.tile, "overlap": args.overlap, "upscale_amount": args.upscale_amount, "out_channels": 3}
+
+    reference_time, reference = measure(lambda: tiled_scale_reference(samples, function, **kwargs), args.repeat)
+    print(f"reference: {reference_time * 1000:.1f} ms")
+    for tile_batch_size in sorted(set([1, args.tile_batch_size])):
+        new_time, result = measure(lambda: tiled_scale(samples, function, tile_batch_size=tile_batch_size, **kwargs), args.repeat)
+        max_diff = (result - reference).abs().max().item()
+        print(f"tile_batch_size {tile_batch_size}: {new_time * 1000:.1f} ms, speedup {reference_time / new_time:.2f}x, max abs diff {max_diff:.2e}")
+        if not torch.allclose(result, reference, atol=1e-4, rtol=1e-4):
+            print("results differ from the reference")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@ import os
 import sys
 sys.path.append('F:/T2ITrainer/aesthetic')
 import aesthetic_predict
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.score_store import ScoreStore
 
 
 def main():
@@ -9,26 +11,33 @@ def main():
     # eval
     ae_model,image_encoder,preprocess,device = aesthetic_predict.init_model()
 
+    # reuse scores from previous runs, only score new images
+    scorer_id = "aesthetic"
+    score_store = ScoreStore(os.path.join(input_dir, "scores.db"))
+
     total_score = 0
-    subsets = os.listdir(input_dir)
+    subsets = [subset for subset in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, subset))]
     for subset in subsets:
         subset_dir = os.path.join(input_dir, subset)
-        subset_score = 0
         files = os.listdir(subset_dir)
-        for image_file in files:
-            if not image_file.endswith('.webp'):
+        image_paths = [os.path.join(subset_dir,image_file) for image_file in files if image_file.endswith('.webp')]
+        scores = score_store.get_paths(scorer_id, image_paths)
+        new_scores = []
+        for image_path in image_paths:
+            if image_path in scores:
                 continue
-            
-            image_path = os.path.join(subset_dir,image_file)
-            subset_score += aesthetic_predict.predict(ae_model,image_encoder,preprocess,image_path,device)
+            scores[image_path] = aesthetic_predict.predict(ae_model,image_encoder,preprocess,image_path,device)
+            new_scores.append(image_path)
+        score_store.upsert_paths(scorer_id, new_scores, [scores[image_path] for image_path in new_scores])
         
         # get average score
-        subset_score /= len(files)
+        subset_score = sum(scores.values()) / len(files)
         total_score+=subset_score
         print(f"{subset}:{subset_score}")
     
     total_score /= len(subsets)
     print(f"total_score:{total_score}")
+    score_store.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
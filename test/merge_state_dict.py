@@ -1,13 +1,9 @@
 # Thanks to Kwai/kolors for the open source weight and comfyanonymous/ComfyUI for unet mapping code
 
 import torch
-import safetensors
-from safetensors import safe_open
-from safetensors.torch import save_file
 import json
-import comfy.utils as utils
-import copy
 import argparse
+from utils.merge_utils import stream_merge
 
 def main(args):
     print("running merge_state_dict")
@@ -24,43 +20,31 @@ def main(args):
     print("kolors_model_path:",kolors_model_path)
     print("sdxl_model_path:",sdxl_model_path)
 
+    # multi model weighted merge, each extra model uses its own ratio
+    models = [(sdxl_model_path, ratio)]
+    extra_model_paths = args.extra_model_paths or []
+    extra_ratios = args.extra_ratios or []
+    if len(extra_model_paths) != len(extra_ratios):
+        raise ValueError("extra_model_paths and extra_ratios must have the same length")
+    for extra_model_path, extra_ratio in zip(extra_model_paths, extra_ratios):
+        print("extra_model_path:",extra_model_path,"ratio:",extra_ratio)
+        models.append((extra_model_path, extra_ratio))
 
-    kolors_model = safetensors.safe_open(kolors_model_path, 'pt')
-    keys = kolors_model.keys()
-    model_a = {key:kolors_model.get_tensor(key) for key in keys}
-    model_b = safetensors.torch.load_file(sdxl_model_path)
-    SDXL = {'use_checkpoint': False, 'image_size': 32, 'out_channels': 4, 'use_spatial_transformer': True, 'legacy': False,
-                'num_classes': 'sequential', 'adm_in_channels': 2816, 'dtype': torch.float16, 'in_channels': 4, 'model_channels': 320,
-                'num_res_blocks': [2, 2, 2], 'transformer_depth': [0, 0, 2, 2, 10, 10], 'channel_mult': [1, 2, 4], 'transformer_depth_middle': 10,
-                'use_linear_in_transformer': True, 'context_dim': 2048, 'num_head_channels': 64, 'transformer_depth_output': [0, 0, 0, 2, 2, 2, 10, 10, 10],
-                'use_temporal_attention': False, 'use_temporal_resblock': False}
-    mapping = utils.unet_to_diffusers(SDXL)
-    new_sd = copy.deepcopy(model_a)
-    prefix = "model.diffusion_model."
-    
-    print("Merge begin")
-    for k, v in mapping.items():
-        # print(k, v)
-        diffusion_model_key = f"{prefix}{v}"
-        if diffusion_model_key not in model_b or k not in model_a:
-            continue
-        if model_b[diffusion_model_key].shape != model_a[k].shape:
-            print("\nshape mismatch:")
-            print(diffusion_model_key)
-            print(model_b[diffusion_model_key].shape)
-            print(k)
-            print(model_a[k].shape)
-            continue
-        
-        calc_weight = (1 - ratio) * model_a[k].to(torch.float32) + ratio * model_b[diffusion_model_key].to(torch.float32)
-        new_sd[k] = calc_weight.to(torch.float16)
-        if perturbed_ratio > 0:
-            # perturbed model
-            # code referenced from https://www.reddit.com/r/StableDiffusion/comments/1dfuicw/perturbed_sd3_experiment/
-            new_sd[k] += torch.normal(torch.zeros_like(calc_weight)*calc_weight.mean(), torch.ones_like(calc_weight)*calc_weight.std()*perturbed_ratio).to(torch.float16)
+    block_ratios = None
+    if args.block_ratios:
+        block_ratios = json.loads(args.block_ratios)
+        print("block_ratios:",block_ratios)
 
-    save_file(new_sd, merged_kolors_path, kolors_model.metadata())
-    print("Merge End")
+    device = args.device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    stats = stream_merge(kolors_model_path, models, merged_kolors_path,
+                         block_ratios=block_ratios,
+                         perturbed_ratio=perturbed_ratio,
+                         chunk_size_mb=args.chunk_size_mb,
+                         device=device)
+    print(stats)
 
 
 def parse_args(input_args=None):
@@ -98,6 +82,39 @@ def parse_args(input_args=None):
         default=0.02,
         help=("Experiment Function. Add some randomness to the merged. Default: 0. If you want to try it, recommanded 0.02 no more than 0.03"),
     )
+    parser.add_argument(
+        "--extra_model_paths",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Extra .safetensors files (SDXL or diffusers unet) merged together with the SDXL model.",
+    )
+    parser.add_argument(
+        "--extra_ratios",
+        type=float,
+        nargs="*",
+        default=None,
+        help="Ratio of each extra model, same order as extra_model_paths.",
+    )
+    parser.add_argument(
+        "--block_ratios",
+        type=str,
+        default=None,
+        help=("Per block multiplier of the merge ratios in json. Example: {\"down_blocks.0\": 0.5, \"mid_block\": 0}. "
+              "The longest matching diffusers key prefix is used, other blocks use 1."),
+    )
+    parser.add_argument(
+        "--chunk_size_mb",
+        type=int,
+        default=512,
+        help="Max fp32 size of tensors merged at once. Lower it to reduce memory usage.",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="Device used for merging. Default: cuda if available.",
+    )
     if input_args is not None:
         args = parser.parse_args(input_args)
     else:
@@ -0,0 +1,162 @@
+# long lived training worker
+# the ui starts a new python process per run, which re-imports torch/diffusers and reloads
+# the text encoder, vae and unet every time. this daemon imports the trainer once and runs
+# jobs in process, trainers which support it (train_kolors_lora_ui.py) keep the base models
+# resident and only reset the lora adapters between jobs.
+#
+# usage:
+#   python train_daemon.py
+#   python ui.py  # runs go to the daemon when it is up, otherwise to a new process
+#
+# jobs are received over a local socket (multiprocessing.connection with authkey) and run
+# one at a time, stdout/stderr of the job including the tqdm progress is streamed back.
+import argparse
+import contextlib
+import gc
+import importlib
+import os
+import sys
+import time
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+
+from utils.daemon_client import DAEMON_AUTHKEY_ENV, DAEMON_HOST, DAEMON_PORT, get_authkey_path, load_or_create_authkey
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# file like object sending every finished line to the client, tqdm lines end with \r
+class ConnectionStream():
+    def __init__(self, conn, mirror):
+        self.conn = conn
+        self.mirror = mirror
+        self.buffer = ""
+        self.connected = True
+
+    def write(self, text):
+        self.mirror.write(text)
+        self.buffer += text
+        while True:
+            positions = [p for p in (self.buffer.find("\n"), self.buffer.find("\r")) if p >= 0]
+            if len(positions) == 0:
+                break
+            position = min(positions)
+            line = self.buffer[:position]
+            self.buffer = self.buffer[position + 1:]
+            if line.strip() != "":
+                self.send(line)
+        return len(text)
+
+    def send(self, line):
+        # the ui may be closed during a job, keep training anyway
+        if not self.connected:
+            return
+        try:
+            self.conn.send({"type": "log", "text": line})
+        except OSError:
+            self.connected = False
+
+    def flush(self):
+        self.mirror.flush()
+
+    def isatty(self):
+        return False
+
+    def close_line(self):
+        if self.buffer.strip() != "":
+            self.send(self.buffer)
+        self.buffer = ""
+
+def load_script(script):
+    module_name = os.path.splitext(os.path.basename(script))[0]
+    if not os.path.exists(os.path.join(REPO_DIR, f"{module_name}.py")):
+        raise FileNotFoundError(f"{script} not found in {REPO_DIR}")
+    module = importlib.import_module(module_name)
+    if not hasattr(module, "main") or not hasattr(module, "parse_args"):
+        raise ValueError(f"{script} doesn't provide parse_args and main")
+    if hasattr(module, "keep_models_resident"):
+        module.keep_models_resident()
+    return module
+
+# accelerate keeps its state in singletons, reset them so the next job gets a fresh Accelerator
+def reset_accelerate_state():
+    from accelerate.state import AcceleratorState, GradientState
+    AcceleratorState._reset_state(True)
+    GradientState._reset_state()
+
+def run_job(conn, script, script_args):
+    stdout = ConnectionStream(conn, sys.stdout)
+    stderr = ConnectionStream(conn, sys.stderr)
+    returncode = 0
+    start = time.time()
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            print(f"job: {script} {' '.join(script_args)}")
+            module = load_script(script)
+            try:
+                args = module.parse_args(script_args)
+                # the same config check as running the script directly
+                if hasattr(module, "check_train_config"):
+                    module.check_train_config(args)
+                module.main(args)
+            finally:
+                if hasattr(module, "reset_resident_models"):
+                    module.reset_resident_models()
+                reset_accelerate_state()
+                gc.collect()
+            print(f"job finished in {time.time() - start:.1f}s")
+    except SystemExit as e:
+        # argparse errors and sys.exit in the trainer shouldn't stop the daemon
+        returncode = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        error = traceback.format_exc()
+        print(error, file=sys.stderr)
+        stdout.close_line()
+        stderr.close_line()
+        if stderr.connected:
+            conn.send({"type": "error", "text": error})
+        return
+    stdout.close_line()
+    stderr.close_line()
+    if stdout.connected:
+        conn.send({"type": "done", "returncode": returncode})
+
+def main():
+    parser = argparse.ArgumentParser(description="training daemon")
+    parser.add_argument("--host", type=str, default=DAEMON_HOST)
+    parser.add_argument("--port", type=int, default=DAEMON_PORT)
+    parser.add_argument("--preload", type=str, nargs="*", default=["train_kolors_lora_ui.py"], help="scripts imported at startup")
+    args = parser.parse_args()
+
+    # no fixed fallback key, anyone knowing it could run code in the daemon
+    authkey = load_or_create_authkey()
+    if authkey is None:
+        print(f"no daemon key, set {DAEMON_AUTHKEY_ENV} or fix the key file {get_authkey_path()}")
+        sys.exit(1)
+
+    sys.path.insert(0, REPO_DIR)
+    for script in args.preload:
+        load_script(script)
+
+    with Listener((args.host, args.port), authkey=authkey) as listener:
+        print(f"training daemon listening on {args.host}:{args.port}")
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, AuthenticationError) as e:
+                # wrong authkey or broken handshake
+                print(f"connection refused: {e}")
+                continue
+            try:
+                message = conn.recv()
+                if message["type"] == "ping":
+                    conn.send({"type": "pong"})
+                elif message["type"] == "job":
+                    run_job(conn, message["script"], message["args"])
+            except (OSError, EOFError) as e:
+                print(f"connection lost: {e}")
+            finally:
+                conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -93,7 +93,7 @@ import json
 
 
 # import sys
-from utils.image_utils_kolors import BucketBatchSampler, CachedPairsDataset
+from utils.image_utils_kolors import BucketBatchSampler, SharedPairsDataset, collate_pairs, expand_pair_embeddings, pack_pair_latents
 
 # from prodigyopt import Prodigy
 
@@ -117,6 +117,7 @@ if is_wandb_available():
 from safetensors.torch import save_file
 
 from utils.dist_utils import flush
+from utils.safetensors_utils import LazyStateDict
 
 import glob
 
@@ -136,7 +137,14 @@ from torchvision import transforms
 
 import cv2
 
-from utils.image_utils_kolors import crop_image
+from utils.image_utils_kolors import crop_image, RESOLUTION_CONFIG
+from utils.cache_registry import (
+    CacheRegistry, TEXT, LATENT, CENTER_CROP_POLICY,
+    hash_text, get_bucket_config, get_text_key, get_latent_key
+)
+from utils.model_fingerprint import get_encoder_fingerprint, get_vae_fingerprint, get_unet_fingerprint
+from utils.file_inventory import scan_files
+from utils.dpo_reference import get_reference_rows, get_timestep_tables, get_scheduled_inputs, get_reference_signature, load_reference_cache, precompute_reference, get_reference_predictions
 # from slider.lora import LoRANetwork
 
 # import slider.debug_util as debug_util
@@ -222,6 +230,31 @@ def parse_args(input_args=None):
         action="store_true",
         help="Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass.",
     )
+    parser.add_argument(
+        "--reference_mode",
+        type=str,
+        default="none",
+        choices=["none", "online", "cached"],
+        help=("reference model predictions in the preference score. online: frozen unet forward every step, "
+              "cached: precomputed once over a seeded (pair, timestep, noise) schedule"),
+    )
+    parser.add_argument(
+        "--reference_slots",
+        type=int,
+        default=4,
+        help="timestep / noise draws per pair of the reference schedule",
+    )
+    parser.add_argument(
+        "--reference_batch_size",
+        type=int,
+        default=4,
+        help="draws per reference unet forward when precomputing",
+    )
+    parser.add_argument(
+        "--split_branches",
+        action="store_true",
+        help="run the winner and loser predictions as separate unet forwards, lower memory but slower",
+    )
     parser.add_argument(
         "--learning_rate",
         type=float,
@@ -749,18 +782,20 @@ def main(args):
     
     if not (args.model_path is None or args.model_path == ""):
         # load from file
-        state_dict = safetensors.torch.load_file(args.model_path, device="cpu")
+        # lazy view over the file, tensors are read one at a time directly in weight_dtype
+        state_dict = LazyStateDict(args.model_path, dtype=weight_dtype)
         unexpected_keys = load_model_dict_into_meta(
             unet,
             state_dict,
             device=offload_device,
-            dtype=torch.float32,
+            dtype=weight_dtype,
             model_name_or_path=args.model_path,
         )
         # updated_state_dict = unet.state_dict()
         if len(unexpected_keys) > 0:
             print(f"Unexpected keys in state_dict: {unexpected_keys}")
         unet.to(offload_device, dtype=weight_dtype)
+        state_dict.close()
         del state_dict,unexpected_keys
         flush()
 
@@ -971,9 +1006,9 @@ def main(args):
                 raise FileNotFoundError(f"{neg_dir} does not exist")
             
             supported_image_types = ['.jpg','.jpeg','.png','.webp']
-            pos_files = glob.glob(f"{pos_dir}/**", recursive=True)
+            pos_files = scan_files(pos_dir)
             pos_image_files = [f for f in pos_files if os.path.splitext(f)[-1].lower() in supported_image_types]
-            neg_files = glob.glob(f"{neg_dir}/**", recursive=True)
+            neg_files = scan_files(neg_dir)
             neg_image_files = [f for f in neg_files if os.path.splitext(f)[-1].lower() in supported_image_types]
             
             file_list = [pos_image_files, neg_image_files]
@@ -1040,6 +1075,46 @@ def main(args):
             tokenizer = None
             vae = None
             
+            # shared cache registry, embeddings of the same prompt and latents of the same image are reused
+            registry = CacheRegistry()
+            encoder_fingerprint = get_encoder_fingerprint(args.pretrained_model_name_or_path)
+            vae_fingerprint = get_vae_fingerprint(args.pretrained_model_name_or_path, args.vae_path)
+            bucket_config = get_bucket_config(1024, RESOLUTION_CONFIG[1024])
+            registry.register_cache(encoder_fingerprint, vae_fingerprint, bucket_config, CENTER_CROP_POLICY, source=metadata_path, trainer="kolors_dpo")
+            text_key = get_text_key(encoder_fingerprint)
+            latent_key = get_latent_key(vae_fingerprint, bucket_config, CENTER_CROP_POLICY)
+            
+            # vae is loaded on first use, also when every text embedding is cached
+            def load_vae():
+                vae_folder = os.path.join(args.pretrained_model_name_or_path, "vae")
+                if args.vae_path:
+                    vae = AutoencoderKL.from_single_file(
+                        args.vae_path,
+                        config=vae_folder,
+                    )
+                else:
+                    # load from repo
+                    weight_file = "diffusion_pytorch_model"
+                    vae_variant = None
+                    ext = ".safetensors"
+                    # diffusion_pytorch_model.fp16.safetensors
+                    fp16_weight = os.path.join(vae_folder, f"{weight_file}.fp16{ext}")
+                    fp32_weight = os.path.join(vae_folder, f"{weight_file}{ext}")
+                    if os.path.exists(fp16_weight):
+                        vae_variant = "fp16"
+                    elif os.path.exists(fp32_weight):
+                        vae_variant = None
+                    else:
+                        raise FileExistsError(f"{fp16_weight} and {fp32_weight} not found. \n Please download the model from https://huggingface.co/Kwai-Kolors/Kolors or https://hf-mirror.com/Kwai-Kolors/Kolors")
+                    
+                    vae = AutoencoderKL.from_pretrained(
+                            args.pretrained_model_name_or_path, variant=vae_variant
+                        )
+
+                vae.to(accelerator.device, dtype=weight_dtype)
+                vae.requires_grad_(False)
+                return vae
+            
             prompt_embeds_list = []
             for generation_config in metadata['generation_configs']:
                 set_name = generation_config['set_name']
@@ -1050,16 +1125,38 @@ def main(args):
                         if generation_config['npz_path_md5'] != get_md5_by_path(npz_path):
                             recreate_cache = True
                             print("npz_path_md5 changed, recreating cache")
+                    cached_npz = None
                     if not recreate_cache:
+                        cached_npz = torch.load(npz_path)
+                        # embeddings stamped by another text encoder are encoded again, unstamped ones are kept
+                        if cached_npz.get('encoder_fingerprint', encoder_fingerprint) != encoder_fingerprint:
+                            print(f"{npz_path} was cached with another text encoder, recreating it")
+                            cached_npz = None
+                    if cached_npz is not None:
                         npz_path_md5 = get_md5_by_path(npz_path)
                         generation_config['npz_path'] = npz_path
                         generation_config['npz_path_md5'] = npz_path_md5
-                        cached_npz = torch.load(npz_path)
                         prompt_embeds = cached_npz['prompt_embed']
                         pooled_prompt_embeds = cached_npz['pooled_prompt_embed']
                         prompt_embeds_list.append((set_name,prompt_embeds, pooled_prompt_embeds))
+                        registry.register(text_key, TEXT, hash_text(generation_config['prompt']), npz_path)
                         continue
                 
+                # the same prompt may be encoded already by another trainer or data script
+                source_path = None
+                if not recreate_cache:
+                    source_path = registry.find(text_key, hash_text(generation_config['prompt']), exclude_path=npz_path)
+                if source_path is not None:
+                    cached_npz = torch.load(source_path)
+                    prompt_embeds = cached_npz['prompt_embed']
+                    pooled_prompt_embeds = cached_npz['pooled_prompt_embed']
+                    torch.save({"prompt_embed": prompt_embeds, "pooled_prompt_embed": pooled_prompt_embeds, "encoder_fingerprint": encoder_fingerprint}, npz_path)
+                    generation_config['npz_path'] = npz_path
+                    generation_config['npz_path_md5'] = get_md5_by_path(npz_path)
+                    registry.register(text_key, TEXT, hash_text(generation_config['prompt']), npz_path)
+                    prompt_embeds_list.append((set_name,prompt_embeds, pooled_prompt_embeds))
+                    continue
+                
                 if text_encoder is None:
                     text_encoder = ChatGLMModel.from_pretrained(
                     f'{args.pretrained_model_name_or_path}/text_encoder',
@@ -1070,35 +1167,6 @@ def main(args):
                 if tokenizer is None:
                     tokenizer = ChatGLMTokenizer.from_pretrained(f'{args.pretrained_model_name_or_path}/text_encoder')
                 
-                if vae is None:
-                    vae_folder = os.path.join(args.pretrained_model_name_or_path, "vae")
-                    if args.vae_path:
-                        vae = AutoencoderKL.from_single_file(
-                            args.vae_path,
-                            config=vae_folder,
-                        )
-                    else:
-                        # load from repo
-                        weight_file = "diffusion_pytorch_model"
-                        vae_variant = None
-                        ext = ".safetensors"
-                        # diffusion_pytorch_model.fp16.safetensors
-                        fp16_weight = os.path.join(vae_folder, f"{weight_file}.fp16{ext}")
-                        fp32_weight = os.path.join(vae_folder, f"{weight_file}{ext}")
-                        if os.path.exists(fp16_weight):
-                            vae_variant = "fp16"
-                        elif os.path.exists(fp32_weight):
-                            vae_variant = None
-                        else:
-                            raise FileExistsError(f"{fp16_weight} and {fp32_weight} not found. \n Please download the model from https://huggingface.co/Kwai-Kolors/Kolors or https://hf-mirror.com/Kwai-Kolors/Kolors")
-                            
-                        vae = AutoencoderKL.from_pretrained(
-                                args.pretrained_model_name_or_path, variant=vae_variant
-                            )
-                
-                    vae.to(accelerator.device, dtype=weight_dtype)
-                    vae.requires_grad_(False)
-                
                 prompt = generation_config['prompt']
                 set_name = generation_config['set_name']
                 # for positive images generation
@@ -1109,12 +1177,14 @@ def main(args):
                 npz_dict = {
                     "prompt_embed": prompt_embed.cpu(), 
                     "pooled_prompt_embed": pooled_prompt_embed.cpu(),
+                    "encoder_fingerprint": encoder_fingerprint,
                 }
                 # save latent to cache file
                 torch.save(npz_dict, npz_path)
                 generation_config['npz_path'] = npz_path
                 npz_path_md5 = get_md5_by_path(npz_path)
                 generation_config['npz_path_md5'] = npz_path_md5
+                registry.register(text_key, TEXT, hash_text(prompt), npz_path)
                 prompt_embeds_list.append((set_name,prompt_embeds, pooled_prompt_embeds))
             
             # not use uncondition
@@ -1149,7 +1219,11 @@ def main(args):
                         if 'latent_path_md5' in generation_config:
                             if generation_config['latent_path_md5'] != get_md5_by_path(latent_path):
                                 recreate_cache = True
+                        # latents stamped by another vae are encoded again, unstamped ones are kept
+                        latent_stale = False
                         if not recreate_cache:
+                            latent_stale = torch.load(latent_path).get('vae_fingerprint', vae_fingerprint) != vae_fingerprint
+                        if not recreate_cache and not latent_stale:
                             # metadata['generation_configs'][i]['latent_path_md5'] = get_md5_by_path(latent_path)
                             training_item = {
                                 'bucket':f"{width}x{height}",
@@ -1159,6 +1233,7 @@ def main(args):
                                 'image_path_md5':get_md5_by_path(image_path),
                             }
                             metadata['generation_configs'][i]['item_list'].append(training_item)
+                            registry.register(latent_key, LATENT, training_item['image_path_md5'], latent_path)
                             continue
                     
                     # save latent
@@ -1173,7 +1248,33 @@ def main(args):
                     image_height, image_width, _ = cropped_image.shape
                     target_size = (image_height,image_width)
                     
+                    # the same image may be encoded already with the same vae, buckets and crop
+                    image_md5 = get_md5_by_path(image_path)
+                    source_path = None
+                    if not recreate_cache:
+                        source_path = registry.find(latent_key, image_md5, exclude_path=latent_path)
+                    if source_path is not None:
+                        time_id = torch.tensor(list(original_size + crops_coords_top_left + target_size))
+                        latent_dict = {
+                            'time_id': time_id,
+                            'latent': torch.load(source_path)['latent'],
+                            'vae_fingerprint': vae_fingerprint,
+                        }
+                        torch.save(latent_dict, latent_path)
+                        registry.register(latent_key, LATENT, image_md5, latent_path)
+                        training_item = {
+                            'bucket':f"{image_width}x{image_height}",
+                            'latent_path':latent_path,
+                            'latent_path_md5':get_md5_by_path(latent_path),
+                            'image_path':image_path,
+                            'image_path_md5':image_md5,
+                        }
+                        metadata['generation_configs'][i]['item_list'].append(training_item)
+                        continue
+                    
                     # vae encode file
+                    if vae is None:
+                        vae = load_vae()
                     train_transforms = transforms.Compose([transforms.ToTensor(), transforms.Normalize([0.5], [0.5])])
                     image = train_transforms(cropped_image)
                     
@@ -1199,9 +1300,11 @@ def main(args):
 
                     latent_dict = {
                         'time_id': time_id.cpu(),
-                        'latent': latent.cpu()
+                        'latent': latent.cpu(),
+                        'vae_fingerprint': vae_fingerprint,
                     }
                     torch.save(latent_dict, latent_path)
+                    registry.register(latent_key, LATENT, image_md5, latent_path)
                 
                     
                     training_item = {
@@ -1209,10 +1312,11 @@ def main(args):
                         'latent_path':latent_path,
                         'latent_path_md5':get_md5_by_path(latent_path),
                         'image_path':image_path,
-                        'image_path_md5':get_md5_by_path(image_path),
+                        'image_path_md5':image_md5,
                     }
                     metadata['generation_configs'][i]['item_list'].append(training_item)
                     
+            registry.close()
             del vae
             flush()
             # save metadata
@@ -1255,34 +1359,59 @@ def main(args):
     unet.to(accelerator.device)
 
 
-    def collate_fn(examples):
-        pos_latents = torch.stack([example["pos_latent"] for example in examples])
-        pos_prompt_embeds = torch.stack([example["pos_prompt_embed"] for example in examples])
-        pos_pooled_prompt_embeds = torch.stack([example["pos_pooled_prompt_embed"] for example in examples])
-        pos_time_ids = torch.stack([example["pos_time_id"] for example in examples])
-        neg_latents = torch.stack([example["neg_latent"] for example in examples])
-        neg_prompt_embeds = torch.stack([example["neg_prompt_embed"] for example in examples])
-        neg_pooled_prompt_embeds = torch.stack([example["neg_pooled_prompt_embed"] for example in examples])
-        neg_time_ids = torch.stack([example["neg_time_id"] for example in examples])
-        main_prompt_embeds = torch.stack([example["main_prompt_embed"] for example in examples])
-        main_pooled_prompt_embeds = torch.stack([example["main_pooled_prompt_embed"] for example in examples])
-
-        return {
-            "pos_latents":pos_latents,
-            "pos_prompt_embeds":pos_prompt_embeds,
-            "pos_pooled_prompt_embeds":pos_pooled_prompt_embeds,
-            "pos_time_ids":pos_time_ids,
-            "neg_latents":neg_latents,
-            "neg_prompt_embeds":neg_prompt_embeds,
-            "neg_pooled_prompt_embeds":neg_pooled_prompt_embeds,
-            "neg_time_ids":neg_time_ids,
-            "main_prompt_embeds":main_prompt_embeds,
-            "main_pooled_prompt_embeds":main_pooled_prompt_embeds,
-        }
-        
     # create dataset based on input_dir
     # no caption dropout for slider training, avoid affect the uncondition space
-    train_dataset = CachedPairsDataset(datarows,conditional_dropout_percent=0)
+    # shared embeddings are loaded once, latents are read from one packed file
+    pack_path = os.path.join(args.train_data_dir, "pairs_latents.safetensors")
+    # packed once on the main process, the other ranks open it after the barrier
+    if accelerator.is_main_process:
+        pack_pair_latents(datarows, pack_path)
+    accelerator.wait_for_everyone()
+    train_dataset = SharedPairsDataset(datarows,pack_path,conditional_dropout_percent=0)
+    embedding_table = (train_dataset.prompt_embeds.to(accelerator.device), train_dataset.pooled_prompt_embeds.to(accelerator.device))
+    
+    max_denoising_steps = 50
+    reference_seed = args.seed if args.seed is not None else 0
+    reference_cache = None
+    if args.reference_mode != "none":
+        # repeats of a pair share its reference draws
+        _, dataset_rows = get_reference_rows(train_dataset)
+        timestep_tables = get_timestep_tables(noise_scheduler, max_denoising_steps, accelerator.device)
+        
+        # frozen base model: the unet with the lora adapters disabled
+        @torch.no_grad()
+        def predict_reference(noised_latents, timesteps, prompt_embeds, pooled_prompt_embeds, time_ids):
+            reference_unet = unwrap_model(unet)
+            reference_unet.disable_adapters()
+            try:
+                with accelerator.autocast():
+                    return predict_noise_xl_single(
+                        reference_unet,
+                        noise_scheduler,
+                        timesteps,
+                        noised_latents,
+                        text_embeddings=prompt_embeds,
+                        add_text_embeddings=pooled_prompt_embeds,
+                        add_time_ids=time_ids,
+                    )
+            finally:
+                reference_unet.enable_adapters()
+    
+    if args.reference_mode == "cached":
+        reference_path = os.path.join(args.train_data_dir, "dpo_reference.safetensors")
+        reference_signature = get_reference_signature(
+            train_dataset, get_unet_fingerprint(args.pretrained_model_name_or_path, args.model_path),
+            args.reference_slots, reference_seed, max_denoising_steps, weight_dtype
+        )
+        if accelerator.is_main_process and load_reference_cache(reference_path, reference_signature) is None:
+            precompute_reference(
+                predict_reference, noise_scheduler, train_dataset, embedding_table, reference_path, reference_signature,
+                args.reference_slots, reference_seed, timestep_tables, max_denoising_steps,
+                args.reference_batch_size, weight_dtype, accelerator.device
+            )
+            flush()
+        accelerator.wait_for_everyone()
+        reference_cache = load_reference_cache(reference_path, reference_signature)
 
     # referenced from everyDream discord minienglish1 shared script
     #create bucket batch sampler
@@ -1292,7 +1421,7 @@ def main(args):
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_sampler=bucket_batch_sampler, #use bucket_batch_sampler instead of shuffle
-        collate_fn=collate_fn,
+        collate_fn=collate_pairs,
         num_workers=dataloader_num_workers,
     )
     
@@ -1405,7 +1534,6 @@ def main(args):
     )
     
     device = accelerator.device
-    max_denoising_steps = 50
     unet.train()
     for epoch in range(first_epoch, args.num_train_epochs):
         if epoch >= args.break_epoch:
@@ -1420,6 +1548,7 @@ def main(args):
         for step, batch in enumerate(train_dataloader):
             with accelerator.accumulate(unet):
                 with accelerator.autocast():
+                    batch = expand_pair_embeddings(batch, embedding_table)
                     pos_latents = batch["pos_latents"].to(accelerator.device)
                     pos_prompt_embeds = batch["pos_prompt_embeds"].to(accelerator.device)
                     pos_pooled_prompt_embeds = batch["pos_pooled_prompt_embeds"].to(accelerator.device)
@@ -1431,46 +1560,59 @@ def main(args):
                     main_prompt_embeds = batch["main_prompt_embeds"].to(accelerator.device)
                     main_pooled_prompt_embeds = batch["main_pooled_prompt_embeds"].to(accelerator.device)
                     
-                    # prepare predicted noise image
-                    # 
-                    noise_scheduler.set_timesteps(
-                        max_denoising_steps, device=device
-                    )
                     optimizer.zero_grad()
-                    # 1 ~ 49 からランダム
-                    timesteps_to = torch.randint(
-                        1, max_denoising_steps, (1,)
-                    ).item()
+                    if args.reference_mode == "none":
+                        # prepare predicted noise image
+                        # 
+                        noise_scheduler.set_timesteps(
+                            max_denoising_steps, device=device
+                        )
+                        # 1 ~ 49 からランダム
+                        timesteps_to = torch.randint(
+                            1, max_denoising_steps, (1,)
+                        ).item()
                     
-                    shape = pos_latents.shape
+                        shape = pos_latents.shape
 
-                    seed = random.randint(0,2*15)
+                        seed = random.randint(0,2*15)
                     
-                    # get positive latents
-                    generator = torch.manual_seed(seed)
-                    noise = randn_tensor(shape, generator=generator, device=device)
-                    timestep = noise_scheduler.timesteps[timesteps_to:timesteps_to+1]
-                    # get latents
-                    pos_noised_latents = noise_scheduler.add_noise(pos_latents, noise, timestep)
+                        # get positive latents
+                        generator = torch.manual_seed(seed)
+                        noise = randn_tensor(shape, generator=generator, device=device)
+                        timestep = noise_scheduler.timesteps[timesteps_to:timesteps_to+1]
+                        # get latents
+                        pos_noised_latents = noise_scheduler.add_noise(pos_latents, noise, timestep)
                     
-                    pos_noised_latents = pos_noised_latents.to(device, dtype=weight_dtype)
-                    noise = noise.to(device, dtype=weight_dtype)
+                        pos_noised_latents = pos_noised_latents.to(device, dtype=weight_dtype)
+                        noise = noise.to(device, dtype=weight_dtype)
                     
-                    # get negative latents
-                    generator = torch.manual_seed(seed)
-                    # use the same noise and timestep as positive
-                    # noise = randn_tensor(shape, generator=generator, device=device)
-                    # timestep = noise_scheduler.timesteps[timesteps_to:timesteps_to+1]
-                    # get latents
-                    neg_noised_latents = noise_scheduler.add_noise(neg_latents, noise, timestep)
-                    neg_noised_latents = neg_noised_latents.to(device, dtype=weight_dtype)
-                    # noise = noise.to(device, dtype=weight_dtype)
+                        # get negative latents
+                        generator = torch.manual_seed(seed)
+                        # use the same noise and timestep as positive
+                        # noise = randn_tensor(shape, generator=generator, device=device)
+                        # timestep = noise_scheduler.timesteps[timesteps_to:timesteps_to+1]
+                        # get latents
+                        neg_noised_latents = noise_scheduler.add_noise(neg_latents, noise, timestep)
+                        neg_noised_latents = neg_noised_latents.to(device, dtype=weight_dtype)
+                        # noise = noise.to(device, dtype=weight_dtype)
                     
-                    # reset noise_scheduler to 1000
-                    noise_scheduler.set_timesteps(noise_scheduler.config.num_train_timesteps)
-                    current_timestep = noise_scheduler.timesteps[
-                        int(timesteps_to * noise_scheduler.config.num_train_timesteps / max_denoising_steps)
-                    ]
+                        # reset noise_scheduler to 1000
+                        noise_scheduler.set_timesteps(noise_scheduler.config.num_train_timesteps)
+                        current_timestep = noise_scheduler.timesteps[
+                            int(timesteps_to * noise_scheduler.config.num_train_timesteps / max_denoising_steps)
+                        ]
+                    else:
+                        # a draw of the reference schedule per sample, the reference predictions
+                        # were made with the same noise and timesteps
+                        reference_rows = [dataset_rows[index] for index in batch["indices"].tolist()]
+                        reference_slots = [random.randrange(args.reference_slots) for _ in reference_rows]
+                        noise, timestep, current_timestep = get_scheduled_inputs(
+                            reference_rows, reference_slots, reference_seed, tuple(pos_latents.shape[1:]),
+                            timestep_tables, max_denoising_steps, device
+                        )
+                        pos_noised_latents = noise_scheduler.add_noise(pos_latents, noise, timestep).to(device, dtype=weight_dtype)
+                        neg_noised_latents = noise_scheduler.add_noise(neg_latents, noise, timestep).to(device, dtype=weight_dtype)
+                        noise = noise.to(device, dtype=weight_dtype)
 
                     # # scale lora 
                     # unet.set_adapters('default', default_positive_scale)
@@ -1538,35 +1680,73 @@ def main(args):
                     #     guidance_scale=1,
                     # )
                     
-                    pos_target_latents = predict_noise_xl_single(
-                        unet,
-                        noise_scheduler,
-                        current_timestep,
-                        pos_noised_latents,
-                        text_embeddings=pos_prompt_embeds,
-                        add_text_embeddings=pos_pooled_prompt_embeds,
-                        add_time_ids=pos_time_ids,
-                    )
+                    # winner and loser in one unet forward
+                    if args.split_branches:
+                        pos_target_latents = predict_noise_xl_single(
+                            unet,
+                            noise_scheduler,
+                            current_timestep,
+                            pos_noised_latents,
+                            text_embeddings=pos_prompt_embeds,
+                            add_text_embeddings=pos_pooled_prompt_embeds,
+                            add_time_ids=pos_time_ids,
+                        )
 
-                    neg_target_latents = predict_noise_xl_single(
-                        unet,
-                        noise_scheduler,
-                        current_timestep,
-                        neg_noised_latents,
-                        text_embeddings=neg_prompt_embeds,
-                        add_text_embeddings=neg_pooled_prompt_embeds,
-                        add_time_ids=neg_time_ids,
-                    )
+                        neg_target_latents = predict_noise_xl_single(
+                            unet,
+                            noise_scheduler,
+                            current_timestep,
+                            neg_noised_latents,
+                            text_embeddings=neg_prompt_embeds,
+                            add_text_embeddings=neg_pooled_prompt_embeds,
+                            add_time_ids=neg_time_ids,
+                        )
+                    else:
+                        # per sample timesteps of the reference schedule are repeated for the loser half
+                        if current_timestep.dim() > 0:
+                            batch_timestep = torch.cat([current_timestep, current_timestep])
+                        else:
+                            batch_timestep = current_timestep
+                        target_latents = predict_noise_xl_single(
+                            unet,
+                            noise_scheduler,
+                            batch_timestep,
+                            torch.cat([pos_noised_latents, neg_noised_latents]),
+                            text_embeddings=torch.cat([pos_prompt_embeds, neg_prompt_embeds]),
+                            add_text_embeddings=torch.cat([pos_pooled_prompt_embeds, neg_pooled_prompt_embeds]),
+                            add_time_ids=torch.cat([pos_time_ids, neg_time_ids]),
+                        )
+                        pos_target_latents, neg_target_latents = target_latents.chunk(2)
                     
-                    pos_loss = F.mse_loss(pos_target_latents.float(), noise.float(), reduction="mean")
-                    neg_loss = F.mse_loss(neg_target_latents.float(), noise.float(), reduction="mean")
+                    if args.reference_mode == "none":
+                        pos_loss = F.mse_loss(pos_target_latents.float(), noise.float(), reduction="mean")
+                        neg_loss = F.mse_loss(neg_target_latents.float(), noise.float(), reduction="mean")
 
-                    # 偏好分数 s(x_i, x_j) = f_theta(x_i) - f_theta(x_j)
-                    preference_score = pos_loss - neg_loss
+                        # 偏好分数 s(x_i, x_j) = f_theta(x_i) - f_theta(x_j)
+                        preference_score = pos_loss - neg_loss
+                    else:
+                        if reference_cache is not None:
+                            ref_pos_target_latents, ref_neg_target_latents = get_reference_predictions(reference_cache, reference_rows, reference_slots, device)
+                        else:
+                            ref_target_latents = predict_reference(
+                                torch.cat([pos_noised_latents, neg_noised_latents]),
+                                torch.cat([current_timestep, current_timestep]),
+                                torch.cat([pos_prompt_embeds, neg_prompt_embeds]),
+                                torch.cat([pos_pooled_prompt_embeds, neg_pooled_prompt_embeds]),
+                                torch.cat([pos_time_ids, neg_time_ids]),
+                            )
+                            ref_pos_target_latents, ref_neg_target_latents = ref_target_latents.chunk(2)
+                        # per sample losses, the samples have their own timesteps
+                        pos_loss = F.mse_loss(pos_target_latents.float(), noise.float(), reduction="none").mean(dim=[1,2,3])
+                        neg_loss = F.mse_loss(neg_target_latents.float(), noise.float(), reduction="none").mean(dim=[1,2,3])
+                        ref_pos_loss = F.mse_loss(ref_pos_target_latents.float(), noise.float(), reduction="none").mean(dim=[1,2,3])
+                        ref_neg_loss = F.mse_loss(ref_neg_target_latents.float(), noise.float(), reduction="none").mean(dim=[1,2,3])
+                        # preference score relative to the reference model
+                        preference_score = (pos_loss - neg_loss) - (ref_pos_loss - ref_neg_loss)
                     preference_score = preference_score.to(device)
                     
                     # 将偏好分数转换为概率
-                    target = torch.tensor(1, device=device, dtype=torch.float32)  # 将 y = 1 或 y = -1 映射为 0.5 和 0.5
+                    target = torch.ones_like(preference_score, dtype=torch.float32)  # 将 y = 1 或 y = -1 映射为 0.5 和 0.5
                     # target = torch.ones(pos_target_latents.shape, device=device, dtype=torch.float32)
                     # target = torch.zeros(pos_target_latents.shape, device=device, dtype=torch.float32)
                     L = torch.nn.BCEWithLogitsLoss()
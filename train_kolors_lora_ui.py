@@ -27,149 +27,9 @@
 # 20240402 bucketing works!!!!, many thanks to @minienglish1 from everydream discord
 #          added whole repeats to dataset
 # 20240710 add kolors training, dir kolors copied from https://github.com/Kwai-Kolors/Kolors
-# from diffusers.models.attention_processor import AttnProcessor2_0
-from diffusers.models.model_loading_utils import load_model_dict_into_meta
-# import jsonlines
-
-import safetensors
 import argparse
-# import functools
-import gc
-# import logging
-import math
 import os
-import random
-# import shutil
-# from pathlib import Path
-
-import accelerate
-# import datasets
-import numpy as np
-import torch
-import torch.nn.functional as F
-import torch.utils.checkpoint
-import transformers
-import diffusers
-
-# from diffusers.image_processor import VaeImageProcessor
-
-from accelerate import Accelerator
-from accelerate.utils import DistributedDataParallelKwargs, ProjectConfiguration, set_seed
-from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
-# from datasets import load_dataset
-# from packaging import version
-# from torchvision import transforms
-# from torchvision.transforms.functional import crop
-from tqdm.auto import tqdm
-# from transformers import AutoTokenizer, PretrainedConfig
-from diffusers import (
-    AutoencoderKL,
-    DDPMScheduler,
-    # EulerDiscreteScheduler,
-    # DiffusionPipeline,
-    UNet2DConditionModel,
-)
-from pathlib import Path
-from diffusers.optimization import get_scheduler
-# from diffusers.training_utils import _set_state_dict_into_text_encoder, cast_training_params, compute_snr
-from diffusers.training_utils import (
-    cast_training_params,
-    compute_snr
-)
-from diffusers.utils import (
-    # check_min_version,
-    convert_all_state_dict_to_peft,
-    convert_state_dict_to_diffusers,
-    convert_state_dict_to_kohya,
-    convert_unet_state_dict_to_peft,
-    is_wandb_available,
-)
-from diffusers.loaders import LoraLoaderMixin
-# from diffusers.utils.import_utils import is_xformers_available
-from diffusers.utils.torch_utils import is_compiled_module
-
-# from diffusers import StableDiffusionXLPipeline
-from kolors.pipelines.pipeline_stable_diffusion_xl_chatglm_256 import StableDiffusionXLPipeline
-from tqdm import tqdm 
-# from PIL import Image 
-
-from sklearn.model_selection import train_test_split
-
-import json
-
-
-# import sys
-from utils.image_utils_kolors import BucketBatchSampler, CachedImageDataset, create_metadata_cache
-
-# from prodigyopt import Prodigy
-
-
-# https://github.com/Lightning-AI/pytorch-lightning/blob/0d52f4577310b5a1624bed4d23d49e37fb05af9e/src/lightning_fabric/utilities/seed.py
-from random import getstate as python_get_rng_state
-from random import setstate as python_set_rng_state
-
-from peft import LoraConfig
-from peft.utils import get_peft_model_state_dict, set_peft_model_state_dict
-from kolors.models.modeling_chatglm import ChatGLMModel
-from kolors.models.tokenization_chatglm import ChatGLMTokenizer
-# try:
-#     from diffusers.utils import randn_tensor
-# except:
-#     from diffusers.utils.torch_utils import randn_tensor
-
-if is_wandb_available():
-    import wandb
-    
-from safetensors.torch import save_file
-
-from utils.dist_utils import flush
-
-from hashlib import md5
-import glob
-
-# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
-# check_min_version("0.30.0.dev0")
-
-logger = get_logger(__name__)
-# =========Debias implementation from: https://github.com/kohya-ss/sd-scripts/blob/main/library/custom_train_functions.py#L99
-def prepare_scheduler_for_custom_training(noise_scheduler, device):
-    if hasattr(noise_scheduler, "all_snr"):
-        return
-
-    alphas_cumprod = noise_scheduler.alphas_cumprod
-    sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
-    sqrt_one_minus_alphas_cumprod = torch.sqrt(1.0 - alphas_cumprod)
-    alpha = sqrt_alphas_cumprod
-    sigma = sqrt_one_minus_alphas_cumprod
-    all_snr = (alpha / sigma) ** 2
-
-    noise_scheduler.all_snr = all_snr.to(device)
-
-
-def apply_snr_weight(loss, timesteps, noise_scheduler, gamma, v_prediction=False):
-    snr = torch.stack([noise_scheduler.all_snr[t] for t in timesteps])
-    min_snr_gamma = torch.minimum(snr, torch.full_like(snr, gamma))
-    if v_prediction:
-        snr_weight = torch.div(min_snr_gamma, snr + 1).float().to(loss.device)
-    else:
-        snr_weight = torch.div(min_snr_gamma, snr).float().to(loss.device)
-    loss = loss * snr_weight
-    return loss
-
-def apply_debiased_estimation(loss, timesteps, noise_scheduler):
-    snr_t = torch.stack([noise_scheduler.all_snr[t] for t in timesteps])  # batch_size
-    snr_t = torch.minimum(snr_t, torch.ones_like(snr_t) * 1000)  # if timestep is 0, snr_t is inf, so limit it to 1000
-    weight = 1 / torch.sqrt(snr_t)
-    loss = weight * loss
-    return loss
-# =========Debias implementation from: https://github.com/kohya-ss/sd-scripts/blob/main/library/custom_train_functions.py#L99
-
-
-def memory_stats():
-    print("\nmemory_stats:\n")
-    print(torch.cuda.memory_allocated()/1024**2)
-    print(torch.cuda.memory_cached()/1024**2)
+from utils.train_config import check_train_config
 
 def parse_args(input_args=None):
     parser = argparse.ArgumentParser(description="Simple example of a training script.")
@@ -402,6 +262,18 @@ def parse_args(input_args=None):
         default=0.1,
         help=("dataset split ratio for validation"),
     )
+    parser.add_argument(
+        "--validation_timesteps",
+        type=int,
+        default=4,
+        help=("timesteps per validation sample, one from each of n equal ranges of the schedule, the loss is logged per range"),
+    )
+    parser.add_argument(
+        "--validation_batch_size",
+        type=int,
+        default=4,
+        help=("validation samples and timesteps per unet call"),
+    )
     parser.add_argument(
         "--model_path",
         type=str,
@@ -455,6 +327,42 @@ def parse_args(input_args=None):
         default=1100,
         help="Max time steps limitation. The training timesteps would limited as this value. 0 to max_time_steps",
     )
+    parser.add_argument(
+        "--preview_prompts",
+        type=str,
+        default=None,
+        help=("sample preview images with the lora of every saved checkpoint. a text file with one prompt per line or prompts separated by |"),
+    )
+    parser.add_argument(
+        "--preview_negative_prompt",
+        type=str,
+        default="",
+        help=("negative prompt of the preview images"),
+    )
+    parser.add_argument(
+        "--preview_steps",
+        type=int,
+        default=12,
+        help=("dpm-solver++ steps of the preview images"),
+    )
+    parser.add_argument(
+        "--preview_guidance_scale",
+        type=float,
+        default=5.0,
+        help=("cfg of the preview images"),
+    )
+    parser.add_argument(
+        "--preview_batch_size",
+        type=int,
+        default=1,
+        help=("preview prompts per unet call, the unet call also runs the negative prompt"),
+    )
+    parser.add_argument(
+        "--preview_seed",
+        type=int,
+        default=0,
+        help=("noise seed of the preview images, the same for every checkpoint"),
+    )
     
     if input_args is not None:
         args = parser.parse_args(input_args)
@@ -479,6 +387,203 @@ def parse_args(input_args=None):
 
     return args
 
+# parse and validate before the heavy imports below, a bad config fails without waiting for torch/diffusers
+if __name__ == "__main__":
+    args = parse_args()
+    check_train_config(args)
+
+# from diffusers.models.attention_processor import AttnProcessor2_0
+from diffusers.models.model_loading_utils import load_model_dict_into_meta
+# import jsonlines
+
+import safetensors
+# import functools
+import gc
+# import logging
+import math
+import random
+# import shutil
+# from pathlib import Path
+
+import accelerate
+# import datasets
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.checkpoint
+import transformers
+import diffusers
+
+# from diffusers.image_processor import VaeImageProcessor
+
+from accelerate import Accelerator
+from accelerate.utils import DistributedDataParallelKwargs, ProjectConfiguration, set_seed, extract_model_from_parallel
+from accelerate.logging import get_logger
+from accelerate.utils import ProjectConfiguration, set_seed
+# from datasets import load_dataset
+# from packaging import version
+# from torchvision import transforms
+# from torchvision.transforms.functional import crop
+from tqdm.auto import tqdm
+# from transformers import AutoTokenizer, PretrainedConfig
+from diffusers import (
+    AutoencoderKL,
+    DDPMScheduler,
+    # EulerDiscreteScheduler,
+    # DiffusionPipeline,
+    UNet2DConditionModel,
+)
+from pathlib import Path
+from diffusers.optimization import get_scheduler
+# from diffusers.training_utils import _set_state_dict_into_text_encoder, cast_training_params, compute_snr
+from diffusers.training_utils import (
+    cast_training_params,
+    compute_snr
+)
+from diffusers.utils import (
+    # check_min_version,
+    convert_all_state_dict_to_peft,
+    convert_state_dict_to_diffusers,
+    convert_state_dict_to_kohya,
+    convert_unet_state_dict_to_peft,
+)
+from diffusers.loaders import LoraLoaderMixin
+# from diffusers.utils.import_utils import is_xformers_available
+from diffusers.utils.torch_utils import is_compiled_module
+
+# from diffusers import StableDiffusionXLPipeline
+from kolors.pipelines.pipeline_stable_diffusion_xl_chatglm_256 import StableDiffusionXLPipeline
+from tqdm import tqdm 
+# from PIL import Image 
+
+import json
+
+
+# import sys
+from utils.image_utils_kolors import BucketBatchSampler, CachedImageDataset, create_metadata_cache, split_stale_datarows
+
+# from prodigyopt import Prodigy
+
+
+# https://github.com/Lightning-AI/pytorch-lightning/blob/0d52f4577310b5a1624bed4d23d49e37fb05af9e/src/lightning_fabric/utilities/seed.py
+
+from peft import LoraConfig
+from peft.tuners.tuners_utils import BaseTunerLayer
+from peft.utils import get_peft_model_state_dict, set_peft_model_state_dict
+from kolors.models.modeling_chatglm import ChatGLMModel
+from kolors.models.tokenization_chatglm import ChatGLMTokenizer
+# try:
+#     from diffusers.utils import randn_tensor
+# except:
+#     from diffusers.utils.torch_utils import randn_tensor
+
+# wandb is imported by accelerate only when report_to is wandb
+from safetensors.torch import save_file
+
+from utils.dist_utils import flush
+from utils.safetensors_utils import LazyStateDict
+from utils.model_fingerprint import get_encoder_fingerprint, get_vae_fingerprint
+from utils.file_inventory import scan_files
+from utils.validation_engine import ValidationEngine
+from utils.preview_sampler import PREVIEW_ADAPTER, PreviewSampler, create_preview_embeddings, load_preview_embeddings, read_preview_prompts
+
+from hashlib import md5
+import glob
+
+# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
+# check_min_version("0.30.0.dev0")
+
+logger = get_logger(__name__)
+# =========Debias implementation from: https://github.com/kohya-ss/sd-scripts/blob/main/library/custom_train_functions.py#L99
+def prepare_scheduler_for_custom_training(noise_scheduler, device):
+    if hasattr(noise_scheduler, "all_snr"):
+        return
+
+    alphas_cumprod = noise_scheduler.alphas_cumprod
+    sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
+    sqrt_one_minus_alphas_cumprod = torch.sqrt(1.0 - alphas_cumprod)
+    alpha = sqrt_alphas_cumprod
+    sigma = sqrt_one_minus_alphas_cumprod
+    all_snr = (alpha / sigma) ** 2
+
+    noise_scheduler.all_snr = all_snr.to(device)
+
+
+def apply_snr_weight(loss, timesteps, noise_scheduler, gamma, v_prediction=False):
+    snr = torch.stack([noise_scheduler.all_snr[t] for t in timesteps])
+    min_snr_gamma = torch.minimum(snr, torch.full_like(snr, gamma))
+    if v_prediction:
+        snr_weight = torch.div(min_snr_gamma, snr + 1).float().to(loss.device)
+    else:
+        snr_weight = torch.div(min_snr_gamma, snr).float().to(loss.device)
+    loss = loss * snr_weight
+    return loss
+
+def apply_debiased_estimation(loss, timesteps, noise_scheduler):
+    snr_t = torch.stack([noise_scheduler.all_snr[t] for t in timesteps])  # batch_size
+    snr_t = torch.minimum(snr_t, torch.ones_like(snr_t) * 1000)  # if timestep is 0, snr_t is inf, so limit it to 1000
+    weight = 1 / torch.sqrt(snr_t)
+    loss = weight * loss
+    return loss
+# =========Debias implementation from: https://github.com/kohya-ss/sd-scripts/blob/main/library/custom_train_functions.py#L99
+
+
+# models kept in memory between jobs when the trainer runs inside train_daemon.py
+# None when the script runs standalone, then every model is loaded for the run and released after it
+resident_models = None
+
+def keep_models_resident():
+    global resident_models
+    if resident_models is None:
+        resident_models = {}
+
+# key: (model kind, *load options), only the latest version of each kind is kept
+def get_resident_model(key, load_fn):
+    if resident_models is None:
+        return load_fn()
+    if key not in resident_models:
+        for old_key in [k for k in resident_models if k[0] == key[0]]:
+            del resident_models[old_key]
+        flush()
+        resident_models[key] = load_fn()
+    else:
+        print(f"reuse resident {key[0]}")
+    return resident_models[key]
+
+# put the original modules back in place of the injected lora layers
+def remove_lora_layers(model):
+    for name, module in list(model.named_modules()):
+        if isinstance(module, BaseTunerLayer):
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            setattr(parent, child_name, module.get_base_layer())
+    if hasattr(model, "peft_config"):
+        del model.peft_config
+    model._hf_peft_config_loaded = False
+
+# called by train_daemon.py after every job, finished or failed, so the next job starts from the base weights
+def reset_resident_models():
+    if resident_models is None:
+        return
+    for key, model in resident_models.items():
+        if key[0] == "unet":
+            # drop the autocast forward wrapper added by accelerator.prepare
+            model = extract_model_from_parallel(model, keep_fp32_wrapper=False)
+            remove_lora_layers(model)
+            model.requires_grad_(False)
+            model.train(False)
+        elif key[0] == "text_encoder_vae":
+            _, text_encoder, vae = model
+            text_encoder.to("cpu")
+            vae.to("cpu")
+    flush()
+
+def memory_stats():
+    print("\nmemory_stats:\n")
+    print(torch.cuda.memory_allocated()/1024**2)
+    print(torch.cuda.memory_cached()/1024**2)
+
+
 def main(args):
     
     if not os.path.exists(args.output_dir): os.makedirs(args.output_dir)
@@ -509,9 +614,6 @@ def main(args):
     lr_num_cycles = args.cosine_restarts
     lr_power = 1
     
-    # this is for consistence validation. all validation would use this seed to generate the same validation set
-    val_seed = random.randint(1, 100)
-    
     # test max_time_steps
     # args.max_time_steps = 600
     
@@ -599,52 +701,64 @@ def main(args):
     if not os.path.exists(metadata_path) or not os.path.exists(val_metadata_path):
         offload_device = torch.device("cpu")
     
-    # load from repo
-    if args.pretrained_model_name_or_path == "Kwai-Kolors/Kolors":
-        unet = UNet2DConditionModel.from_pretrained(
-                args.pretrained_model_name_or_path, subfolder="unet", variant="fp16"
-            ).to(offload_device, dtype=weight_dtype)
-    else:
+    def load_unet():
         # load from repo
-        unet_folder = os.path.join(args.pretrained_model_name_or_path, "unet")
-        weight_file = "diffusion_pytorch_model"
-        unet_variant = None
-        ext = ".safetensors"
-        # diffusion_pytorch_model.fp16.safetensors
-        fp16_weight = os.path.join(unet_folder, f"{weight_file}.fp16{ext}")
-        fp32_weight = os.path.join(unet_folder, f"{weight_file}{ext}")
-        if os.path.exists(fp16_weight):
-            unet_variant = "fp16"
-        elif os.path.exists(fp32_weight):
-            unet_variant = None
+        if args.pretrained_model_name_or_path == "Kwai-Kolors/Kolors":
+            unet = UNet2DConditionModel.from_pretrained(
+                    args.pretrained_model_name_or_path, subfolder="unet", variant="fp16"
+                ).to(offload_device, dtype=weight_dtype)
         else:
-            raise FileExistsError(f"{fp16_weight} and {fp32_weight} not found. \n Please download the model from https://huggingface.co/Kwai-Kolors/Kolors or https://hf-mirror.com/Kwai-Kolors/Kolors")
+            # load from repo
+            unet_folder = os.path.join(args.pretrained_model_name_or_path, "unet")
+            weight_file = "diffusion_pytorch_model"
+            unet_variant = None
+            ext = ".safetensors"
+            # diffusion_pytorch_model.fp16.safetensors
+            fp16_weight = os.path.join(unet_folder, f"{weight_file}.fp16{ext}")
+            fp32_weight = os.path.join(unet_folder, f"{weight_file}{ext}")
+            if os.path.exists(fp16_weight):
+                unet_variant = "fp16"
+            elif os.path.exists(fp32_weight):
+                unet_variant = None
+            else:
+                raise FileExistsError(f"{fp16_weight} and {fp32_weight} not found. \n Please download the model from https://huggingface.co/Kwai-Kolors/Kolors or https://hf-mirror.com/Kwai-Kolors/Kolors")
             
-        unet = UNet2DConditionModel.from_pretrained(
-                    unet_folder, variant=unet_variant
-                ).to(offload_device, dtype=weight_dtype)
+            unet = UNet2DConditionModel.from_pretrained(
+                        unet_folder, variant=unet_variant
+                    ).to(offload_device, dtype=weight_dtype)
     
-    if not (args.model_path is None or args.model_path == ""):
-        # load from file
-        state_dict = safetensors.torch.load_file(args.model_path, device="cpu")
-        unexpected_keys = load_model_dict_into_meta(
-            unet,
-            state_dict,
-            device=offload_device,
-            dtype=torch.float32,
-            model_name_or_path=args.model_path,
-        )
-        # updated_state_dict = unet.state_dict()
-        if len(unexpected_keys) > 0:
-            print(f"Unexpected keys in state_dict: {unexpected_keys}")
-        unet.to(offload_device, dtype=weight_dtype)
-        del state_dict,unexpected_keys
-        flush()
+        if not (args.model_path is None or args.model_path == ""):
+            # load from file
+            # lazy view over the file, tensors are read one at a time directly in weight_dtype
+            state_dict = LazyStateDict(args.model_path, dtype=weight_dtype)
+            unexpected_keys = load_model_dict_into_meta(
+                unet,
+                state_dict,
+                device=offload_device,
+                dtype=weight_dtype,
+                model_name_or_path=args.model_path,
+            )
+            # updated_state_dict = unet.state_dict()
+            if len(unexpected_keys) > 0:
+                print(f"Unexpected keys in state_dict: {unexpected_keys}")
+            unet.to(offload_device, dtype=weight_dtype)
+            state_dict.close()
+            del state_dict,unexpected_keys
+            flush()
+        return unet
+
+    # the daemon keeps the unet between jobs, loaded once per base model and model_path
+    unet_key = ("unet", args.pretrained_model_name_or_path, args.model_path or "", str(weight_dtype))
+    unet = get_resident_model(unet_key, load_unet)
+    unet.to(offload_device, dtype=weight_dtype)
 
     unet.requires_grad_(False)
 
     if args.gradient_checkpointing:
         unet.enable_gradient_checkpointing()
+    elif resident_models is not None:
+        # a resident unet may still have it enabled by the previous job
+        unet.disable_gradient_checkpointing()
 
     # now we will add new LoRA weights to the attention layers
     unet_lora_config = LoraConfig(
@@ -655,6 +769,10 @@ def main(args):
         target_modules=["to_k", "to_q", "to_v", "to_out.0"],
     )
     unet.add_adapter(unet_lora_config)
+    if args.preview_prompts:
+        # second adapter for the lora of the last checkpoint, sampled by the preview sampler
+        unet.add_adapter(unet_lora_config, adapter_name=PREVIEW_ADAPTER)
+        unet.set_adapter("default")
     def unwrap_model(model):
         model = accelerator.unwrap_model(model)
         model = model._orig_mod if is_compiled_module(model) else model
@@ -747,7 +865,7 @@ def main(args):
         # resolution = args.resolution_config.split(",")
         
         supported_image_types = ['.jpg','.jpeg','.png','.webp']
-        files = glob.glob(f"{input_dir}/**", recursive=True)
+        files = scan_files(input_dir)
         image_files = [f for f in files if os.path.splitext(f)[-1].lower() in supported_image_types]
         
         # function to remove metadata datarows which in not exist in directory
@@ -789,6 +907,9 @@ def main(args):
         datarows = full_datarows
         # if not single_image_training:
         #     single_image_training = (len(resolution) > 1 and len(full_datarows) == len(resolution)) or len(full_datarows) == len(resolution)
+        # fingerprints of the current text encoder and vae weights, stamped into the cache files
+        encoder_fingerprint = get_encoder_fingerprint(args.pretrained_model_name_or_path)
+        vae_fingerprint = get_vae_fingerprint(args.pretrained_model_name_or_path, args.vae_path)
         # no metadata file, all files should be cached
         cache_list = []
         if (len(datarows) == 0) or recreate_cache:
@@ -863,19 +984,15 @@ def main(args):
                 print(f"corrupted files: {len(corrupted_files)}")
                 # add corrupted files to cache list
                 cache_list += corrupted_files
+            
+            # embeddings and latents stamped by another text encoder or vae are cached again
+            # unstamped caches from older versions are kept
+            stale_files, full_datarows = split_stale_datarows(full_datarows, encoder_fingerprint, vae_fingerprint)
+            if len(stale_files) > 0:
+                print(f"cached with another text encoder or vae: {len(stale_files)}")
+                cache_list += stale_files
                     
-        if len(cache_list)>0:
-            # Load the tokenizers
-            tokenizer_one = ChatGLMTokenizer.from_pretrained(
-                args.pretrained_model_name_or_path,
-                subfolder="text_encoder",
-                revision=revision, 
-                variant=variant
-            )
-
-            text_encoder_one = ChatGLMModel.from_pretrained(
-                args.pretrained_model_name_or_path, subfolder="text_encoder", revision=revision, variant=variant
-            )
+        def load_vae():
             vae_folder = os.path.join(args.pretrained_model_name_or_path, "vae")
             if args.vae_path:
                 vae = AutoencoderKL.from_single_file(
@@ -896,10 +1013,30 @@ def main(args):
                     vae_variant = None
                 else:
                     raise FileExistsError(f"{fp16_weight} and {fp32_weight} not found. \n Please download the model from https://huggingface.co/Kwai-Kolors/Kolors or https://hf-mirror.com/Kwai-Kolors/Kolors")
-                    
+                
                 vae = AutoencoderKL.from_pretrained(
                         args.pretrained_model_name_or_path, variant=vae_variant
                     )
+            return vae
+
+        def load_text_encoder_and_vae():
+            # Load the tokenizers
+            tokenizer_one = ChatGLMTokenizer.from_pretrained(
+                args.pretrained_model_name_or_path,
+                subfolder="text_encoder",
+                revision=revision, 
+                variant=variant
+            )
+
+            text_encoder_one = ChatGLMModel.from_pretrained(
+                args.pretrained_model_name_or_path, subfolder="text_encoder", revision=revision, variant=variant
+            )
+            return tokenizer_one, text_encoder_one, load_vae()
+
+        # the daemon keeps the text encoder and vae on cpu between jobs
+        text_encoder_key = ("text_encoder_vae", args.pretrained_model_name_or_path, args.vae_path or "")
+        if len(cache_list)>0:
+            tokenizer_one, text_encoder_one, vae = get_resident_model(text_encoder_key, load_text_encoder_and_vae)
             
             vae.requires_grad_(False)
             text_encoder_one.requires_grad_(False)
@@ -910,7 +1047,9 @@ def main(args):
             tokenizers = [tokenizer_one]
             text_encoders = [text_encoder_one]
             # create metadata and latent cache
-            cached_datarows = create_metadata_cache(tokenizers,text_encoders,vae,cache_list,metadata_path=metadata_path,recreate_cache=args.recreate_cache, resolution_config=args.resolution)
+            # share embeddings and latents with the other kolors trainers through the cache registry
+            cached_datarows = create_metadata_cache(tokenizers,text_encoders,vae,cache_list,metadata_path=metadata_path,recreate_cache=args.recreate_cache, resolution_config=args.resolution,
+                                                    encoder_fingerprint=encoder_fingerprint, vae_fingerprint=vae_fingerprint)
             
             # merge newly cached datarows to full_datarows
             full_datarows += cached_datarows
@@ -926,6 +1065,7 @@ def main(args):
                     full_datarows = full_datarows + full_datarows.copy()
                     validation_ratio = 0.5
                     train_ratio = 0.5
+                from sklearn.model_selection import train_test_split
                 training_datarows, validation_datarows = train_test_split(full_datarows, train_size=train_ratio, test_size=validation_ratio)
                 datarows = training_datarows
             else:
@@ -946,6 +1086,9 @@ def main(args):
                 
             # clear memory
             del validation_datarows
+            if resident_models is not None:
+                vae.to("cpu")
+                text_encoder_one.to("cpu")
             del vae, tokenizer_one, text_encoder_one
             gc.collect()
             torch.cuda.empty_cache()
@@ -1106,6 +1249,61 @@ def main(args):
         unet, optimizer, train_dataloader, lr_scheduler
     )
 
+    # ==========================================================
+    # preview sampler, samples the lora of every saved checkpoint
+    # ==========================================================
+    preview_sampler = None
+    if args.preview_prompts and accelerator.is_main_process:
+        preview_prompts = read_preview_prompts(args.preview_prompts)
+        preview_embeddings_path = os.path.join(args.output_dir, "preview_embeddings.npkolors")
+        preview_embeddings = load_preview_embeddings(preview_embeddings_path, preview_prompts, args.preview_negative_prompt, encoder_fingerprint)
+        tokenizer_one, text_encoder_one = None, None
+        if preview_embeddings is None or resident_models is not None:
+            tokenizer_one, text_encoder_one, vae = get_resident_model(text_encoder_key, load_text_encoder_and_vae)
+        else:
+            # the embeddings are cached, only the vae is needed
+            vae = load_vae()
+        vae.requires_grad_(False)
+        vae.to(accelerator.device, dtype=torch.float32)
+        if preview_embeddings is None:
+            print("encode preview prompts")
+            text_encoder_one.requires_grad_(False)
+            text_encoder_one.to(accelerator.device, dtype=weight_dtype)
+            encode_pipe = StableDiffusionXLPipeline(
+                vae=vae,
+                text_encoder=text_encoder_one,
+                tokenizer=tokenizer_one,
+                unet=unwrap_model(unet),
+                scheduler=noise_scheduler,
+                force_zeros_for_empty_prompt=False
+            )
+            preview_embeddings = create_preview_embeddings(encode_pipe, preview_embeddings_path, preview_prompts, args.preview_negative_prompt, encoder_fingerprint)
+            text_encoder_one.to("cpu")
+            del encode_pipe
+        del tokenizer_one, text_encoder_one
+        flush()
+        # the pipeline wraps the live unet, nothing is reloaded
+        preview_pipe = StableDiffusionXLPipeline(
+            vae=vae,
+            text_encoder=None,
+            tokenizer=None,
+            unet=unwrap_model(unet),
+            scheduler=noise_scheduler,
+            force_zeros_for_empty_prompt=False
+        )
+        preview_sampler = PreviewSampler(
+            preview_pipe,
+            noise_scheduler,
+            preview_embeddings,
+            os.path.join(args.output_dir, "previews"),
+            steps=args.preview_steps,
+            guidance_scale=args.preview_guidance_scale,
+            resolution=int(args.resolution),
+            batch_size=args.preview_batch_size,
+            seed=args.preview_seed,
+        )
+        del vae
+
 
     # We need to initialize the trackers we use, and also store our configuration.
     # The trackers initializes automatically on the main process.
@@ -1150,8 +1348,9 @@ def main(args):
         else:
             # Get the mos recent checkpoint
             dirs = os.listdir(args.output_dir)
-            dirs = [d for d in dirs if d.startswith(args.save_name)]
-            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
+            # only {save_name}-<step>, save_name may contain "-"
+            dirs = [d for d in dirs if d.rpartition("-")[0] == args.save_name and d.rpartition("-")[2].isdigit()]
+            dirs = sorted(dirs, key=lambda x: int(x.rsplit("-", 1)[-1]))
             path = dirs[-1] if len(dirs) > 0 else None
 
         if path is None:
@@ -1179,6 +1378,29 @@ def main(args):
         disable=not accelerator.is_local_main_process,
     )
     
+    # validation loss per sample, weighted like the training loss
+    def get_validation_loss(model_pred, target, timesteps):
+        loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
+        loss = loss.mean(dim=list(range(1, len(loss.shape))))
+        if not (args.snr_gamma is None or args.snr_gamma == 0):
+            # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
+            # Since we predict the noise instead of x_0, the original formulation is slightly changed.
+            # This is discussed in Section 4.2 of the same paper.
+            snr = compute_snr(noise_scheduler, timesteps)
+            mse_loss_weights = torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(
+                dim=1
+            )[0]
+            if noise_scheduler.config.prediction_type == "epsilon":
+                mse_loss_weights = mse_loss_weights / snr
+            elif noise_scheduler.config.prediction_type == "v_prediction":
+                mse_loss_weights = mse_loss_weights / (snr + 1)
+            loss = loss * mse_loss_weights
+        # referenced from https://github.com/kohya-ss/sd-scripts/blob/25f961bc779bc79aef440813e3e8e92244ac5739/sdxl_train.py
+        if args.use_debias:
+            loss = apply_debiased_estimation(loss,timesteps,noise_scheduler)
+        return loss
+    validation_engine = None
+    
     max_time_steps = noise_scheduler.config.num_train_timesteps
     if args.max_time_steps is not None and args.max_time_steps > 0:
         max_time_steps = args.max_time_steps
@@ -1274,6 +1496,9 @@ def main(args):
                     logs = {"step_loss": step_loss, lr_name: lr, "epoch": epoch}
                     accelerator.log(logs, step=global_step)
                     progress_bar.set_postfix(**logs)
+                    # one unet call of the running preview, if it waits for one
+                    if preview_sampler is not None:
+                        preview_sampler.step()
                     
                     if global_step >= max_train_steps:
                         break
@@ -1289,11 +1514,6 @@ def main(args):
             continue
         
         
-        # store rng before validation
-        before_state = torch.random.get_rng_state()
-        np_seed = np.random.seed()
-        py_state = python_get_rng_state()
-        
         if accelerator.is_main_process:
             if (epoch >= args.skip_epoch and epoch % args.save_model_epochs == 0) or epoch == args.num_train_epochs - 1:
                 accelerator.wait_for_everyone()
@@ -1301,135 +1521,44 @@ def main(args):
                     save_path = os.path.join(args.output_dir, f"{args.save_name}-{global_step}")
                     accelerator.save_state(save_path)
                     logger.info(f"Saved state to {save_path}")
+                    if preview_sampler is not None:
+                        preview_sampler.submit(os.path.basename(save_path))
             
             # only execute when val_metadata_path exists
             if ((epoch >= args.skip_epoch and epoch % args.validation_epochs == 0) or epoch == args.num_train_epochs - 1) and os.path.exists(val_metadata_path):
-                with torch.no_grad():
-                    unet = unwrap_model(unet)
-                    # freeze rng
-                    np.random.seed(val_seed)
-                    torch.manual_seed(val_seed)
-                    dataloader_generator = torch.Generator()
-                    dataloader_generator.manual_seed(val_seed)
-                    torch.backends.cudnn.deterministic = True
-                    
-                    validation_datarows = []
+                # the validation set and its noise bank are built once and kept for the whole run
+                if validation_engine is None:
                     with open(val_metadata_path, "r", encoding='utf-8') as readfile:
                         validation_datarows = json.loads(readfile.read())
+                    validation_engine = ValidationEngine(
+                        validation_datarows,
+                        noise_scheduler,
+                        num_buckets=args.validation_timesteps,
+                        batch_size=args.validation_batch_size,
+                    )
+                    del validation_datarows
+                
+                if len(validation_engine) == 0:
+                    print("No validation data, skip validation.")
+                else:
+                    print("\nStart val_loss\n")
+                    unet = unwrap_model(unet)
+                    avg_loss, bucket_losses = validation_engine.evaluate(unet, get_validation_loss, accelerator.device, weight_dtype)
                     
-                    if len(validation_datarows)>0:
-                        validation_dataset = CachedImageDataset(validation_datarows,conditional_dropout_percent=0)
-                        
-                        batch_size  = 1
-                        # batch_size = args.train_batch_size
-                        # handle batch size > validation dataset size
-                        # if batch_size > len(validation_datarows):
-                        #     batch_size = 1
-                        
-                        val_batch_sampler = BucketBatchSampler(validation_dataset, batch_size=batch_size, drop_last=True)
-
-                        #initialize the DataLoader with the bucket batch sampler
-                        val_dataloader = torch.utils.data.DataLoader(
-                            validation_dataset,
-                            batch_sampler=val_batch_sampler, #use bucket_batch_sampler instead of shuffle
-                            collate_fn=collate_fn,
-                            num_workers=dataloader_num_workers,
-                        )
-
-                        print("\nStart val_loss\n")
-                        
-                        total_loss = 0.0
-                        num_batches = len(val_dataloader)
-                        # if no val data, skip the following 
-                        if num_batches == 0:
-                            print("No validation data, skip validation.")
-                        else:
-                            # basically the as same as the training loop
-                            enumerate_val_dataloader = enumerate(val_dataloader)
-                            for i, batch in tqdm(enumerate_val_dataloader,position=1):
-                                latents = batch["latents"].to(accelerator.device)
-                                bsz, _, _, _ = latents.shape
-                                
-                                indices = torch.randint(0, noise_scheduler.config.num_train_timesteps, (bsz,))
-                                timesteps = noise_scheduler.timesteps[indices].to(device=accelerator.device)
-                                
-                                noise = torch.randn_like(latents)
-                                
-                                # Add noise to the model input according to the noise magnitude at each timestep
-                                # (this is the forward diffusion process)
-                                noisy_model_input = noise_scheduler.add_noise(latents, noise, timesteps)
-                                
-                                add_time_ids = batch["time_ids"].to(accelerator.device, dtype=weight_dtype)
-                                unet_added_conditions = {"time_ids": add_time_ids}
-                                prompt_embeds = batch["prompt_embeds"].to(accelerator.device)
-                                pooled_prompt_embeds = batch["pooled_prompt_embeds"].to(accelerator.device)
-                                unet_added_conditions.update({"text_embeds": pooled_prompt_embeds})
-                                model_pred = unet(
-                                    noisy_model_input,
-                                    timesteps,
-                                    prompt_embeds,
-                                    added_cond_kwargs=unet_added_conditions,
-                                    return_dict=False,
-                                )[0]
-                                
-                                target = noise
-                                # loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
-                                # code reference: https://github.com/huggingface/diffusers/blob/main/examples/text_to_image/train_text_to_image.py
-                                if args.snr_gamma is None or args.snr_gamma == 0:
-                                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
-                                else:
-                                    # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
-                                    # Since we predict the noise instead of x_0, the original formulation is slightly changed.
-                                    # This is discussed in Section 4.2 of the same paper.
-                                    snr = compute_snr(noise_scheduler, timesteps)
-                                    mse_loss_weights = torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(
-                                        dim=1
-                                    )[0]
-                                    if noise_scheduler.config.prediction_type == "epsilon":
-                                        mse_loss_weights = mse_loss_weights / snr
-                                    elif noise_scheduler.config.prediction_type == "v_prediction":
-                                        mse_loss_weights = mse_loss_weights / (snr + 1)
-
-                                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
-                                    loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
-                                    loss = loss.mean()
-                                    del mse_loss_weights
-                                
-                                
-                                # referenced from https://github.com/kohya-ss/sd-scripts/blob/25f961bc779bc79aef440813e3e8e92244ac5739/sdxl_train.py
-                                if args.use_debias:
-                                    loss = apply_debiased_estimation(loss,timesteps,noise_scheduler)
-                                
-                                total_loss+=loss.detach()
-                                del latents, target, loss, model_pred,  timesteps,  bsz, noise, noisy_model_input
-                                gc.collect()
-                                torch.cuda.empty_cache()
-                                
-                            avg_loss = total_loss / num_batches
-                            
-                            lr = lr_scheduler.get_last_lr()[0]
-                            lr_name = "val_lr"
-                            if args.optimizer == "prodigy":
-                                lr = lr_scheduler.optimizers[-1].param_groups[0]["d"] * lr_scheduler.optimizers[-1].param_groups[0]["lr"]
-                                lr_name = "val_lr lr/d*lr"
-                            logs = {"val_loss": avg_loss, lr_name: lr, "epoch": epoch}
-                            print(logs)
-                            progress_bar.set_postfix(**logs)
-                            accelerator.log(logs, step=global_step)
-                            del num_batches, avg_loss, total_loss
-                        del validation_datarows, validation_dataset, val_batch_sampler, val_dataloader
-                        gc.collect()
-                        torch.cuda.empty_cache()
-                        print("\nEnd val_loss\n")
-            
-        # restore rng before validation
-        np.random.seed(np_seed)
-        torch.random.set_rng_state(before_state)
-        torch.backends.cudnn.deterministic = False
-        version, state, gauss = py_state
-        python_set_rng_state((version, tuple(state), gauss))
+                    lr = lr_scheduler.get_last_lr()[0]
+                    lr_name = "val_lr"
+                    if args.optimizer == "prodigy":
+                        lr = lr_scheduler.optimizers[-1].param_groups[0]["d"] * lr_scheduler.optimizers[-1].param_groups[0]["lr"]
+                        lr_name = "val_lr lr/d*lr"
+                    logs = {"val_loss": avg_loss, lr_name: lr, "epoch": epoch}
+                    print(logs)
+                    progress_bar.set_postfix(**logs)
+                    # loss curve of each timestep range
+                    logs.update({f"val_loss/t{bucket}": loss for bucket, loss in bucket_losses.items()})
+                    accelerator.log(logs, step=global_step)
+                    del avg_loss, bucket_losses
+                    print("\nEnd val_loss\n")
         
-        # del before_state, np_seed, py_state
         gc.collect()
         torch.cuda.empty_cache()
         
@@ -1438,11 +1567,14 @@ def main(args):
         # end validation part
         # ==================================================
     
+    if preview_sampler is not None:
+        # previews of the last checkpoints
+        preview_sampler.close()
+        del preview_sampler
     accelerator.end_training()
     print("Saved to ")
     print(args.output_dir)
 
 
 if __name__ == "__main__":
-    args = parse_args()
     main(args)
\ No newline at end of file
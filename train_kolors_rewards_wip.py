@@ -100,7 +100,8 @@ import json
 
 
 # import sys
-from utils.image_utils_kolors import BucketBatchSampler, CachedImageDataset, create_metadata_cache
+from utils.image_utils_kolors import BucketBatchSampler, CachedImageDataset, create_metadata_cache, split_stale_datarows
+from utils.model_fingerprint import get_encoder_fingerprint, get_vae_fingerprint
 
 # from prodigyopt import Prodigy
 
@@ -124,6 +125,8 @@ if is_wandb_available():
 from safetensors.torch import save_file
 
 from utils.dist_utils import flush
+from utils.safetensors_utils import LazyStateDict
+from utils.file_inventory import scan_files
 
 from hashlib import md5
 import glob
@@ -606,18 +609,20 @@ def main(args):
     
     if not (args.model_path is None or args.model_path == ""):
         # load from file
-        state_dict = safetensors.torch.load_file(args.model_path, device="cpu")
+        # lazy view over the file, tensors are read one at a time directly in weight_dtype
+        state_dict = LazyStateDict(args.model_path, dtype=weight_dtype)
         unexpected_keys = load_model_dict_into_meta(
             unet,
             state_dict,
             device=offload_device,
-            dtype=torch.float32,
+            dtype=weight_dtype,
             model_name_or_path=args.model_path,
         )
         # updated_state_dict = unet.state_dict()
         if len(unexpected_keys) > 0:
             print(f"Unexpected keys in state_dict: {unexpected_keys}")
         unet.to(offload_device, dtype=weight_dtype)
+        state_dict.close()
         del state_dict,unexpected_keys
         flush()
 
@@ -836,7 +841,7 @@ def main(args):
         # resolutions = args.resolution_config.split(",")
         
         supported_image_types = ['.jpg','.jpeg','.png','.webp']
-        files = glob.glob(f"{input_dir}/**", recursive=True)
+        files = scan_files(input_dir)
         image_files = [f for f in files if os.path.splitext(f)[-1].lower() in supported_image_types]
         
         # function to remove metadata datarows which in not exist in directory
@@ -878,6 +883,9 @@ def main(args):
         datarows = full_datarows
         # if not single_image_training:
         #     single_image_training = (len(resolutions) > 1 and len(full_datarows) == len(resolutions)) or len(full_datarows) == len(resolutions)
+        # fingerprints of the current text encoder and vae weights, stamped into the cache files
+        encoder_fingerprint = get_encoder_fingerprint(args.pretrained_model_name_or_path)
+        vae_fingerprint = get_vae_fingerprint(args.pretrained_model_name_or_path, args.vae_path)
         # no metadata file, all files should be cached
         if (len(full_datarows) == 0) or recreate_cache:
             cache_list = image_files
@@ -951,6 +959,13 @@ def main(args):
                 print(f"corrupted files: {len(corrupted_files)}")
                 # add corrupted files to cache list
                 cache_list += corrupted_files
+            
+            # embeddings and latents stamped by another text encoder or vae are cached again
+            # unstamped caches from older versions are kept
+            stale_files, full_datarows = split_stale_datarows(full_datarows, encoder_fingerprint, vae_fingerprint)
+            if len(stale_files) > 0:
+                print(f"cached with another text encoder or vae: {len(stale_files)}")
+                cache_list += stale_files
                     
         if len(cache_list)>0:
             # Load the tokenizers
@@ -971,7 +986,8 @@ def main(args):
             tokenizers = [tokenizer_one]
             text_encoders = [text_encoder_one]
             # create metadata and latent cache
-            cached_datarows = create_metadata_cache(tokenizers,text_encoders,vae,cache_list,metadata_path=metadata_path,recreate_cache=args.recreate_cache,resolution_config=args.resolution_config)
+            cached_datarows = create_metadata_cache(tokenizers,text_encoders,vae,cache_list,metadata_path=metadata_path,recreate_cache=args.recreate_cache,resolution_config=args.resolution_config,
+                                                    encoder_fingerprint=encoder_fingerprint, vae_fingerprint=vae_fingerprint, trainer="kolors_rewards")
             
             # merge newly cached datarows to full_datarows
             full_datarows += cached_datarows
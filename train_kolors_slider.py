@@ -93,7 +93,7 @@ import json
 
 
 # import sys
-from utils.image_utils_kolors import BucketBatchSampler, CachedPairsDataset
+from utils.image_utils_kolors import BucketBatchSampler, SharedPairsDataset, collate_pairs, expand_pair_embeddings, pack_pair_latents
 
 # from prodigyopt import Prodigy
 
@@ -117,6 +117,7 @@ if is_wandb_available():
 from safetensors.torch import save_file
 
 from utils.dist_utils import flush
+from utils.safetensors_utils import LazyStateDict
 
 import glob
 
@@ -136,7 +137,14 @@ from torchvision import transforms
 
 import cv2
 
-from utils.image_utils_kolors import crop_image
+from utils.image_utils_kolors import crop_image, RESOLUTION_CONFIG
+from utils.cache_registry import (
+    CacheRegistry, TEXT, LATENT, CENTER_CROP_POLICY,
+    hash_text, get_bucket_config, get_text_key, get_latent_key
+)
+from utils.model_fingerprint import get_encoder_fingerprint, get_vae_fingerprint
+from utils.file_inventory import scan_files
+from utils.lora_scale import SampleLoraScales
 # from slider.lora import LoRANetwork
 
 # import slider.debug_util as debug_util
@@ -222,6 +230,11 @@ def parse_args(input_args=None):
         action="store_true",
         help="Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass.",
     )
+    parser.add_argument(
+        "--split_branches",
+        action="store_true",
+        help="run the positive and negative slider branches as separate unet forwards, lower memory but slower",
+    )
     parser.add_argument(
         "--learning_rate",
         type=float,
@@ -711,18 +724,20 @@ def main(args):
     
     if not (args.model_path is None or args.model_path == ""):
         # load from file
-        state_dict = safetensors.torch.load_file(args.model_path, device="cpu")
+        # lazy view over the file, tensors are read one at a time directly in weight_dtype
+        state_dict = LazyStateDict(args.model_path, dtype=weight_dtype)
         unexpected_keys = load_model_dict_into_meta(
             unet,
             state_dict,
             device=offload_device,
-            dtype=torch.float32,
+            dtype=weight_dtype,
             model_name_or_path=args.model_path,
         )
         # updated_state_dict = unet.state_dict()
         if len(unexpected_keys) > 0:
             print(f"Unexpected keys in state_dict: {unexpected_keys}")
         unet.to(offload_device, dtype=weight_dtype)
+        state_dict.close()
         del state_dict,unexpected_keys
         flush()
 
@@ -933,9 +948,9 @@ def main(args):
                 raise FileNotFoundError(f"{neg_dir} does not exist")
             
             supported_image_types = ['.jpg','.jpeg','.png','.webp']
-            pos_files = glob.glob(f"{pos_dir}/**", recursive=True)
+            pos_files = scan_files(pos_dir)
             pos_image_files = [f for f in pos_files if os.path.splitext(f)[-1].lower() in supported_image_types]
-            neg_files = glob.glob(f"{neg_dir}/**", recursive=True)
+            neg_files = scan_files(neg_dir)
             neg_image_files = [f for f in neg_files if os.path.splitext(f)[-1].lower() in supported_image_types]
             
             file_list = [pos_image_files, neg_image_files]
@@ -1002,6 +1017,46 @@ def main(args):
             tokenizer = None
             vae = None
             
+            # shared cache registry, embeddings of the same prompt and latents of the same image are reused
+            registry = CacheRegistry()
+            encoder_fingerprint = get_encoder_fingerprint(args.pretrained_model_name_or_path)
+            vae_fingerprint = get_vae_fingerprint(args.pretrained_model_name_or_path, args.vae_path)
+            bucket_config = get_bucket_config(1024, RESOLUTION_CONFIG[1024])
+            registry.register_cache(encoder_fingerprint, vae_fingerprint, bucket_config, CENTER_CROP_POLICY, source=metadata_path, trainer="kolors_slider")
+            text_key = get_text_key(encoder_fingerprint)
+            latent_key = get_latent_key(vae_fingerprint, bucket_config, CENTER_CROP_POLICY)
+            
+            # vae is loaded on first use, also when every text embedding is cached
+            def load_vae():
+                vae_folder = os.path.join(args.pretrained_model_name_or_path, "vae")
+                if args.vae_path:
+                    vae = AutoencoderKL.from_single_file(
+                        args.vae_path,
+                        config=vae_folder,
+                    )
+                else:
+                    # load from repo
+                    weight_file = "diffusion_pytorch_model"
+                    vae_variant = None
+                    ext = ".safetensors"
+                    # diffusion_pytorch_model.fp16.safetensors
+                    fp16_weight = os.path.join(vae_folder, f"{weight_file}.fp16{ext}")
+                    fp32_weight = os.path.join(vae_folder, f"{weight_file}{ext}")
+                    if os.path.exists(fp16_weight):
+                        vae_variant = "fp16"
+                    elif os.path.exists(fp32_weight):
+                        vae_variant = None
+                    else:
+                        raise FileExistsError(f"{fp16_weight} and {fp32_weight} not found. \n Please download the model from https://huggingface.co/Kwai-Kolors/Kolors or https://hf-mirror.com/Kwai-Kolors/Kolors")
+                    
+                    vae = AutoencoderKL.from_pretrained(
+                            args.pretrained_model_name_or_path, variant=vae_variant
+                        )
+
+                vae.to(accelerator.device, dtype=weight_dtype)
+                vae.requires_grad_(False)
+                return vae
+            
             prompt_embeds_list = []
             for generation_config in metadata['generation_configs']:
                 set_name = generation_config['set_name']
@@ -1012,16 +1067,38 @@ def main(args):
                         if generation_config['npz_path_md5'] != get_md5_by_path(npz_path):
                             recreate_cache = True
                             print("npz_path_md5 changed, recreating cache")
+                    cached_npz = None
                     if not recreate_cache:
+                        cached_npz = torch.load(npz_path)
+                        # embeddings stamped by another text encoder are encoded again, unstamped ones are kept
+                        if cached_npz.get('encoder_fingerprint', encoder_fingerprint) != encoder_fingerprint:
+                            print(f"{npz_path} was cached with another text encoder, recreating it")
+                            cached_npz = None
+                    if cached_npz is not None:
                         npz_path_md5 = get_md5_by_path(npz_path)
                         generation_config['npz_path'] = npz_path
                         generation_config['npz_path_md5'] = npz_path_md5
-                        cached_npz = torch.load(npz_path)
                         prompt_embeds = cached_npz['prompt_embed']
                         pooled_prompt_embeds = cached_npz['pooled_prompt_embed']
                         prompt_embeds_list.append((set_name,prompt_embeds, pooled_prompt_embeds))
+                        registry.register(text_key, TEXT, hash_text(generation_config['prompt']), npz_path)
                         continue
                 
+                # the same prompt may be encoded already by another trainer or data script
+                source_path = None
+                if not recreate_cache:
+                    source_path = registry.find(text_key, hash_text(generation_config['prompt']), exclude_path=npz_path)
+                if source_path is not None:
+                    cached_npz = torch.load(source_path)
+                    prompt_embeds = cached_npz['prompt_embed']
+                    pooled_prompt_embeds = cached_npz['pooled_prompt_embed']
+                    torch.save({"prompt_embed": prompt_embeds, "pooled_prompt_embed": pooled_prompt_embeds, "encoder_fingerprint": encoder_fingerprint}, npz_path)
+                    generation_config['npz_path'] = npz_path
+                    generation_config['npz_path_md5'] = get_md5_by_path(npz_path)
+                    registry.register(text_key, TEXT, hash_text(generation_config['prompt']), npz_path)
+                    prompt_embeds_list.append((set_name,prompt_embeds, pooled_prompt_embeds))
+                    continue
+                
                 if text_encoder is None:
                     text_encoder = ChatGLMModel.from_pretrained(
                     f'{args.pretrained_model_name_or_path}/text_encoder',
@@ -1032,35 +1109,6 @@ def main(args):
                 if tokenizer is None:
                     tokenizer = ChatGLMTokenizer.from_pretrained(f'{args.pretrained_model_name_or_path}/text_encoder')
                 
-                if vae is None:
-                    vae_folder = os.path.join(args.pretrained_model_name_or_path, "vae")
-                    if args.vae_path:
-                        vae = AutoencoderKL.from_single_file(
-                            args.vae_path,
-                            config=vae_folder,
-                        )
-                    else:
-                        # load from repo
-                        weight_file = "diffusion_pytorch_model"
-                        vae_variant = None
-                        ext = ".safetensors"
-                        # diffusion_pytorch_model.fp16.safetensors
-                        fp16_weight = os.path.join(vae_folder, f"{weight_file}.fp16{ext}")
-                        fp32_weight = os.path.join(vae_folder, f"{weight_file}{ext}")
-                        if os.path.exists(fp16_weight):
-                            vae_variant = "fp16"
-                        elif os.path.exists(fp32_weight):
-                            vae_variant = None
-                        else:
-                            raise FileExistsError(f"{fp16_weight} and {fp32_weight} not found. \n Please download the model from https://huggingface.co/Kwai-Kolors/Kolors or https://hf-mirror.com/Kwai-Kolors/Kolors")
-                            
-                        vae = AutoencoderKL.from_pretrained(
-                                args.pretrained_model_name_or_path, variant=vae_variant
-                            )
-                
-                    vae.to(accelerator.device, dtype=weight_dtype)
-                    vae.requires_grad_(False)
-                
                 prompt = generation_config['prompt']
                 set_name = generation_config['set_name']
                 # for positive images generation
@@ -1071,12 +1119,14 @@ def main(args):
                 npz_dict = {
                     "prompt_embed": prompt_embed.cpu(), 
                     "pooled_prompt_embed": pooled_prompt_embed.cpu(),
+                    "encoder_fingerprint": encoder_fingerprint,
                 }
                 # save latent to cache file
                 torch.save(npz_dict, npz_path)
                 generation_config['npz_path'] = npz_path
                 npz_path_md5 = get_md5_by_path(npz_path)
                 generation_config['npz_path_md5'] = npz_path_md5
+                registry.register(text_key, TEXT, hash_text(prompt), npz_path)
                 prompt_embeds_list.append((set_name,prompt_embeds, pooled_prompt_embeds))
             
             # not use uncondition
@@ -1111,7 +1161,11 @@ def main(args):
                         if 'latent_path_md5' in generation_config:
                             if generation_config['latent_path_md5'] != get_md5_by_path(latent_path):
                                 recreate_cache = True
+                        # latents stamped by another vae are encoded again, unstamped ones are kept
+                        latent_stale = False
                         if not recreate_cache:
+                            latent_stale = torch.load(latent_path).get('vae_fingerprint', vae_fingerprint) != vae_fingerprint
+                        if not recreate_cache and not latent_stale:
                             # metadata['generation_configs'][i]['latent_path_md5'] = get_md5_by_path(latent_path)
                             training_item = {
                                 'bucket':f"{width}x{height}",
@@ -1121,6 +1175,7 @@ def main(args):
                                 'image_path_md5':get_md5_by_path(image_path),
                             }
                             metadata['generation_configs'][i]['item_list'].append(training_item)
+                            registry.register(latent_key, LATENT, training_item['image_path_md5'], latent_path)
                             continue
                     
                     # save latent
@@ -1135,7 +1190,33 @@ def main(args):
                     image_height, image_width, _ = cropped_image.shape
                     target_size = (image_height,image_width)
                     
+                    # the same image may be encoded already with the same vae, buckets and crop
+                    image_md5 = get_md5_by_path(image_path)
+                    source_path = None
+                    if not recreate_cache:
+                        source_path = registry.find(latent_key, image_md5, exclude_path=latent_path)
+                    if source_path is not None:
+                        time_id = torch.tensor(list(original_size + crops_coords_top_left + target_size))
+                        latent_dict = {
+                            'time_id': time_id,
+                            'latent': torch.load(source_path)['latent'],
+                            'vae_fingerprint': vae_fingerprint,
+                        }
+                        torch.save(latent_dict, latent_path)
+                        registry.register(latent_key, LATENT, image_md5, latent_path)
+                        training_item = {
+                            'bucket':f"{image_width}x{image_height}",
+                            'latent_path':latent_path,
+                            'latent_path_md5':get_md5_by_path(latent_path),
+                            'image_path':image_path,
+                            'image_path_md5':image_md5,
+                        }
+                        metadata['generation_configs'][i]['item_list'].append(training_item)
+                        continue
+                    
                     # vae encode file
+                    if vae is None:
+                        vae = load_vae()
                     train_transforms = transforms.Compose([transforms.ToTensor(), transforms.Normalize([0.5], [0.5])])
                     image = train_transforms(cropped_image)
                     
@@ -1161,9 +1242,11 @@ def main(args):
 
                     latent_dict = {
                         'time_id': time_id.cpu(),
-                        'latent': latent.cpu()
+                        'latent': latent.cpu(),
+                        'vae_fingerprint': vae_fingerprint,
                     }
                     torch.save(latent_dict, latent_path)
+                    registry.register(latent_key, LATENT, image_md5, latent_path)
                 
                     
                     training_item = {
@@ -1171,10 +1254,11 @@ def main(args):
                         'latent_path':latent_path,
                         'latent_path_md5':get_md5_by_path(latent_path),
                         'image_path':image_path,
-                        'image_path_md5':get_md5_by_path(image_path),
+                        'image_path_md5':image_md5,
                     }
                     metadata['generation_configs'][i]['item_list'].append(training_item)
                     
+            registry.close()
             del vae
             flush()
             # save metadata
@@ -1217,34 +1301,16 @@ def main(args):
     unet.to(accelerator.device)
 
 
-    def collate_fn(examples):
-        pos_latents = torch.stack([example["pos_latent"] for example in examples])
-        pos_prompt_embeds = torch.stack([example["pos_prompt_embed"] for example in examples])
-        pos_pooled_prompt_embeds = torch.stack([example["pos_pooled_prompt_embed"] for example in examples])
-        pos_time_ids = torch.stack([example["pos_time_id"] for example in examples])
-        neg_latents = torch.stack([example["neg_latent"] for example in examples])
-        neg_prompt_embeds = torch.stack([example["neg_prompt_embed"] for example in examples])
-        neg_pooled_prompt_embeds = torch.stack([example["neg_pooled_prompt_embed"] for example in examples])
-        neg_time_ids = torch.stack([example["neg_time_id"] for example in examples])
-        main_prompt_embeds = torch.stack([example["main_prompt_embed"] for example in examples])
-        main_pooled_prompt_embeds = torch.stack([example["main_pooled_prompt_embed"] for example in examples])
-
-        return {
-            "pos_latents":pos_latents,
-            "pos_prompt_embeds":pos_prompt_embeds,
-            "pos_pooled_prompt_embeds":pos_pooled_prompt_embeds,
-            "pos_time_ids":pos_time_ids,
-            "neg_latents":neg_latents,
-            "neg_prompt_embeds":neg_prompt_embeds,
-            "neg_pooled_prompt_embeds":neg_pooled_prompt_embeds,
-            "neg_time_ids":neg_time_ids,
-            "main_prompt_embeds":main_prompt_embeds,
-            "main_pooled_prompt_embeds":main_pooled_prompt_embeds,
-        }
-        
     # create dataset based on input_dir
     # no caption dropout for slider training, avoid affect the uncondition space
-    train_dataset = CachedPairsDataset(datarows,conditional_dropout_percent=0)
+    # shared embeddings are loaded once, latents are read from one packed file
+    pack_path = os.path.join(args.train_data_dir, "pairs_latents.safetensors")
+    # packed once on the main process, the other ranks open it after the barrier
+    if accelerator.is_main_process:
+        pack_pair_latents(datarows, pack_path)
+    accelerator.wait_for_everyone()
+    train_dataset = SharedPairsDataset(datarows,pack_path,conditional_dropout_percent=0)
+    embedding_table = (train_dataset.prompt_embeds.to(accelerator.device), train_dataset.pooled_prompt_embeds.to(accelerator.device))
 
     # referenced from everyDream discord minienglish1 shared script
     #create bucket batch sampler
@@ -1254,7 +1320,7 @@ def main(args):
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_sampler=bucket_batch_sampler, #use bucket_batch_sampler instead of shuffle
-        collate_fn=collate_fn,
+        collate_fn=collate_pairs,
         num_workers=dataloader_num_workers,
     )
     
@@ -1376,6 +1442,7 @@ def main(args):
         for step, batch in enumerate(train_dataloader):
             with accelerator.accumulate(unet):
                 with accelerator.autocast():
+                    batch = expand_pair_embeddings(batch, embedding_table)
                     pos_latents = batch["pos_latents"].to(accelerator.device)
                     pos_prompt_embeds = batch["pos_prompt_embeds"].to(accelerator.device)
                     pos_pooled_prompt_embeds = batch["pos_pooled_prompt_embeds"].to(accelerator.device)
@@ -1428,79 +1495,54 @@ def main(args):
                         int(timesteps_to * noise_scheduler.config.num_train_timesteps / max_denoising_steps)
                     ]
 
-                    # # scale lora 
-                    unet.set_adapters('default', default_positive_scale)
-                    pos_target_latents = predict_noise_xl(
-                        unet,
-                        noise_scheduler,
-                        current_timestep,
-                        pos_noised_latents,
-                        text_embeddings=concat_embeddings(
-                            neg_prompt_embeds,
-                            pos_prompt_embeds,
-                            1,
-                        ),
-                        add_text_embeddings=concat_embeddings(
-                            neg_pooled_prompt_embeds,
-                            pos_pooled_prompt_embeds,
-                            1,
-                        ),
-                        add_time_ids=concat_embeddings(
-                            pos_time_ids, pos_time_ids, 1
-                        ),
-                        guidance_scale=1,
-                    )
-
-                    loss_pos = F.mse_loss(pos_target_latents.float(), noise.float())
-                    # progress_bar.set_description(f"pos_step_loss*1k: {loss_pos.item():.4f}")
-                    
-                    # Backpropagate
-                    accelerator.backward(loss_pos)
-
-                    pos_step_loss = loss_pos.detach().item()
-                    lr = lr_scheduler.get_last_lr()[0]
-                    lr_name = "lr"
-                    if args.optimizer == "prodigy":
-                        if resume_step>0 and resume_step == global_step:
-                            lr = 0
-                        else:
-                            lr = lr_scheduler.optimizers[-1].param_groups[0]["d"] * lr_scheduler.optimizers[-1].param_groups[0]["lr"]
-                        lr_name = "lr/d*lr"
-                    logs = {"pos_step_loss": pos_step_loss, lr_name: lr, "epoch": epoch}
-                    accelerator.log(logs, step=global_step)
-                    progress_bar.set_postfix(**logs)
-                    
-                    
-                    unet.set_adapters('default', default_negative_scale)
-                    # scale lora 
-                    neg_target_latents = predict_noise_xl(
-                        unet,
-                        noise_scheduler,
-                        current_timestep,
-                        neg_noised_latents,
-                        text_embeddings=concat_embeddings(
-                            neg_prompt_embeds,
-                            main_prompt_embeds,
-                            1,
-                        ),
-                        add_text_embeddings=concat_embeddings(
-                            neg_pooled_prompt_embeds,
-                            main_pooled_prompt_embeds,
-                            1,
-                        ),
-                        add_time_ids=concat_embeddings(
-                            neg_time_ids, neg_time_ids, 1
-                        ),
-                        guidance_scale=1,
-                    )
-
-                    loss_neg = F.mse_loss(neg_target_latents.float(), noise.float())
-                    # progress_bar.set_description(f"neg_step_loss*1k: {loss_neg.item()*1000:.4f}")
+                    # positive branch: lora at the positive scale on the positive prompt
+                    # negative branch: lora at the negative scale on the main prompt
+                    # both run in one unet forward with a lora scale per sample
+                    batch_size = pos_latents.shape[0]
+                    branches = [
+                        (pos_noised_latents, pos_prompt_embeds, pos_pooled_prompt_embeds, pos_time_ids, default_positive_scale),
+                        (neg_noised_latents, main_prompt_embeds, main_pooled_prompt_embeds, neg_time_ids, default_negative_scale),
+                    ]
+                    if args.split_branches:
+                        branch_groups = [[branch] for branch in branches]
+                    else:
+                        branch_groups = [branches]
+                    branch_losses = []
+                    for branch_group in branch_groups:
+                        n_branches = len(branch_group)
+                        scales = [branch[4] for branch in branch_group for _ in range(batch_size)]
+                        time_ids = torch.cat([branch[3] for branch in branch_group])
+                        # the same scales for the uncond and cond half of the batch
+                        with SampleLoraScales(unet, scales + scales):
+                            target_latents = predict_noise_xl(
+                                unet,
+                                noise_scheduler,
+                                current_timestep,
+                                torch.cat([branch[0] for branch in branch_group]),
+                                text_embeddings=concat_embeddings(
+                                    torch.cat([neg_prompt_embeds] * n_branches),
+                                    torch.cat([branch[1] for branch in branch_group]),
+                                    1,
+                                ),
+                                add_text_embeddings=concat_embeddings(
+                                    torch.cat([neg_pooled_prompt_embeds] * n_branches),
+                                    torch.cat([branch[2] for branch in branch_group]),
+                                    1,
+                                ),
+                                add_time_ids=concat_embeddings(
+                                    time_ids, time_ids, 1
+                                ),
+                                guidance_scale=1,
+                            )
+                            # one mean per branch, the same loss as separate forwards
+                            losses = [F.mse_loss(target.float(), noise.float()) for target in target_latents.chunk(n_branches)]
+                            
+                            # Backpropagate, inside the block for gradient checkpointing
+                            accelerator.backward(sum(losses))
+                        branch_losses += [loss.detach().item() for loss in losses]
+                        del target_latents, losses
+                    pos_step_loss, neg_step_loss = branch_losses
                     
-                    # Backpropagate
-                    accelerator.backward(loss_neg)
-
-                    neg_step_loss = loss_neg.detach().item()
                     lr = lr_scheduler.get_last_lr()[0]
                     lr_name = "lr"
                     if args.optimizer == "prodigy":
@@ -1509,7 +1551,7 @@ def main(args):
                         else:
                             lr = lr_scheduler.optimizers[-1].param_groups[0]["d"] * lr_scheduler.optimizers[-1].param_groups[0]["lr"]
                         lr_name = "lr/d*lr"
-                    logs = {"neg_step_loss": neg_step_loss, lr_name: lr, "epoch": epoch}
+                    logs = {"pos_step_loss": pos_step_loss, "neg_step_loss": neg_step_loss, lr_name: lr, "epoch": epoch}
                     accelerator.log(logs, step=global_step)
                     progress_bar.set_postfix(**logs)
                     
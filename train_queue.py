@@ -0,0 +1,178 @@
+# local scheduler for batches of training configs
+# configs are the json files ui.py / ui_sd35.py / ui_slider.py save, the queue is kept in
+# queue/queue.db so jobs can be added while it runs and an interrupted run resumes the queue.
+#
+# usage:
+#   python train_queue.py add config_a.json config_b.json
+#   python train_queue.py run                                # one job at a time
+#   python train_queue.py run --mode daemon                  # one job at a time in train_daemon.py
+#   python train_queue.py run --mode packed --max_parallel 2 --job_memory_gb 20
+#   python train_queue.py status
+#   python train_queue.py retry                              # failed jobs back to pending
+#
+# jobs on the same dataset and resolution run back to back, only the first of them recreates
+# the cache when recreate_cache is set, and they never run at the same time in packed mode.
+# a config may set "memory_gb" to override --job_memory_gb for packed mode.
+import argparse
+import subprocess
+import sys
+import time
+
+from utils.job_queue import JobQueue, DONE, FAILED, config_to_args, get_data_dir_key, get_free_gpu_memory
+from utils.train_config import validate_train_config
+from utils.daemon_client import daemon_available, run_daemon_job
+
+def format_job(job):
+    config = job["config"]
+    duration = ""
+    if job["started_at"] is not None and job["finished_at"] is not None:
+        duration = f" {job['finished_at'] - job['started_at']:.0f}s"
+    return (f"[{job['id']}] {job['status']:8s} {config.get('script')} {config.get('save_name')} "
+            f"data={config.get('train_data_dir')} res={config.get('resolution')}{duration}")
+
+# returns the args for the job or None when the config is invalid
+def prepare_job(queue, job, prepared_groups):
+    config = job["config"]
+    errors = validate_train_config(config)
+    if len(errors) > 0:
+        log_path = queue.start(job["id"])
+        with open(log_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(errors) + "\n")
+        queue.finish(job["id"], 1)
+        print(f"job {job['id']} invalid config:\n" + "\n".join(errors))
+        return None
+    # the first job of the group builds the cache, the rest reuse it
+    if job["group_key"] in prepared_groups and config.get("recreate_cache"):
+        config = dict(config)
+        config["recreate_cache"] = False
+        print(f"job {job['id']}: cache already recreated by this queue run, recreate_cache disabled")
+    prepared_groups.add(job["group_key"])
+    return [config["script"]] + config_to_args(config)
+
+def run_daemon_mode(queue, args, prepared_groups):
+    last_group = None
+    while True:
+        jobs = queue.pending(prefer_group=last_group)
+        if len(jobs) == 0:
+            return
+        job = jobs[0]
+        script_args = prepare_job(queue, job, prepared_groups)
+        if script_args is None:
+            continue
+        log_path = queue.start(job["id"])
+        print(f"start {format_job(queue.get(job['id']))}")
+        result = {"returncode": 1}
+        with open(log_path, "w", encoding="utf-8") as log_file:
+            try:
+                for line in run_daemon_job(script_args[0], script_args[1:], result=result):
+                    log_file.write(line + "\n")
+                    log_file.flush()
+            except RuntimeError as e:
+                log_file.write(str(e))
+        queue.finish(job["id"], result["returncode"])
+        last_group = job["group_key"]
+        print(f"end   {format_job(queue.get(job['id']))}")
+
+def run_process_mode(queue, args, prepared_groups):
+    max_parallel = args.max_parallel if args.mode == "packed" else 1
+    # job_id -> (process, log_file, group_key)
+    running = {}
+    last_group = None
+    last_launch = 0
+    while True:
+        for job_id, (process, log_file, group_key) in list(running.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            log_file.close()
+            queue.finish(job_id, returncode)
+            last_group = group_key
+            del running[job_id]
+            print(f"end   {format_job(queue.get(job_id))}")
+
+        # jobs on the dataset of a running job wait, two jobs writing the same cache would corrupt it
+        # the group key also has the base model and vae, jobs of another group may still share the dataset
+        running_data_dirs = set(get_data_dir_key(queue.get(job_id)["config"]) for job_id in running)
+        jobs = queue.pending(prefer_group=last_group, exclude_data_dirs=running_data_dirs)
+        if len(jobs) == 0 and len(running) == 0:
+            return
+
+        if len(jobs) > 0 and len(running) < max_parallel and (len(running) == 0 or time.time() - last_launch >= args.start_interval):
+            job = jobs[0]
+            can_start = True
+            if len(running) > 0:
+                # memory is read after the previous job had start_interval to load its models
+                free_memory = get_free_gpu_memory()
+                required = float(job["config"].get("memory_gb") or args.job_memory_gb) * 1024
+                if free_memory is None:
+                    print("nvidia-smi not available, running one job at a time")
+                    max_parallel = 1
+                    can_start = False
+                elif max(free_memory) < required:
+                    can_start = False
+            if can_start:
+                script_args = prepare_job(queue, job, prepared_groups)
+                if script_args is not None:
+                    log_path = queue.start(job["id"])
+                    log_file = open(log_path, "w", encoding="utf-8")
+                    process = subprocess.Popen([sys.executable] + script_args, stdout=log_file, stderr=subprocess.STDOUT)
+                    running[job["id"]] = (process, log_file, job["group_key"])
+                    last_launch = time.time()
+                    print(f"start {format_job(queue.get(job['id']))} log={log_path}")
+                continue
+        time.sleep(args.poll_interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="training job queue")
+    parser.add_argument("--queue", type=str, default="queue/queue.db", help="queue database path")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="add config json files")
+    add_parser.add_argument("configs", nargs="+")
+
+    run_parser = subparsers.add_parser("run", help="run pending jobs")
+    run_parser.add_argument("configs", nargs="*", help="config json files added before running")
+    run_parser.add_argument("--mode", type=str, default="sequential", choices=["sequential", "packed", "daemon"])
+    run_parser.add_argument("--max_parallel", type=int, default=2, help="packed mode only")
+    run_parser.add_argument("--job_memory_gb", type=float, default=24, help="free gpu memory required to start another job in packed mode")
+    run_parser.add_argument("--start_interval", type=float, default=120, help="seconds between job starts in packed mode")
+    run_parser.add_argument("--poll_interval", type=float, default=5)
+
+    subparsers.add_parser("status", help="list jobs")
+    subparsers.add_parser("retry", help="set failed jobs back to pending")
+    subparsers.add_parser("clear", help="remove finished jobs")
+    remove_parser = subparsers.add_parser("remove", help="remove jobs by id")
+    remove_parser.add_argument("ids", nargs="+", type=int)
+    args = parser.parse_args()
+
+    with JobQueue(args.queue) as queue:
+        if args.command in ["add", "run"]:
+            for config_path in args.configs:
+                job_id = queue.add_file(config_path)
+                print(f"added job {job_id}: {config_path}")
+        if args.command == "run":
+            recovered = queue.recover()
+            if len(recovered) > 0:
+                print(f"resuming interrupted jobs: {recovered}")
+            if args.mode == "daemon" and not daemon_available():
+                print("train_daemon.py is not running, start it first or use --mode sequential")
+                sys.exit(1)
+            prepared_groups = set()
+            if args.mode == "daemon":
+                run_daemon_mode(queue, args, prepared_groups)
+            else:
+                run_process_mode(queue, args, prepared_groups)
+            failed = queue.jobs(FAILED)
+            print(f"queue finished, done: {len(queue.jobs(DONE))}, failed: {len(failed)}")
+        elif args.command == "status":
+            for job in queue.jobs():
+                print(format_job(job))
+        elif args.command == "retry":
+            print(f"{queue.retry_failed()} jobs set to pending")
+        elif args.command == "clear":
+            print(f"{queue.clear_done()} jobs removed")
+        elif args.command == "remove":
+            queue.remove(args.ids)
+
+if __name__ == "__main__":
+    main()
@@ -121,6 +121,7 @@ if is_wandb_available():
 from safetensors.torch import save_file
 
 from utils.dist_utils import flush
+from utils.file_inventory import scan_files
 
 from hashlib import md5
 import glob
@@ -879,7 +880,7 @@ def main(args):
         # resolution = args.resolution_config.split(",")
         
         supported_image_types = ['.jpg','.jpeg','.png','.webp']
-        files = glob.glob(f"{input_dir}/**", recursive=True)
+        files = scan_files(input_dir)
         image_files = [f for f in files if os.path.splitext(f)[-1].lower() in supported_image_types]
         
         # function to remove metadata datarows which in not exist in directory
@@ -4,6 +4,12 @@ import subprocess
 import json
 import sys
 import os
+from utils.daemon_client import call_training_script
+from utils.job_queue import JobQueue
+from utils.train_config import get_train_config_warnings, validate_train_config
+
+# lines of training output shown in the output box
+max_output_lines = 30
 
 
 default_config = {
@@ -227,7 +233,8 @@ def run(
         if not vae_path.endswith('.safetensors') and not vae_path == "":
             msg = "Vae need to be a single file ends with .safetensors. It should be the fp16 fix vae from https://huggingface.co/madebyollin/sdxl-vae-fp16-fix/tree/main"
             gr.Warning(msg)
-            return msg
+            yield msg
+            return
     
     inputs = {
         "seed":seed,
@@ -266,6 +273,15 @@ def run(
         "cosine_restarts":cosine_restarts,
         "max_time_steps":max_time_steps
     }
+    # check the config here, so a bad path doesn't wait for the training process imports
+    config_errors = validate_train_config(inputs)
+    if len(config_errors) > 0:
+        msg = "\n".join(config_errors)
+        gr.Warning(msg)
+        yield msg
+        return
+    for warning in get_train_config_warnings(inputs):
+        gr.Warning(warning)
     # Convert the inputs dictionary to a list of arguments
     # args = ["python", "train_sd3_lora_ui.py"]  # replace "your_script.py" with the name of your script
     # script = "test_.pyt"
@@ -280,7 +296,11 @@ def run(
                 args.append(str(value))
                 
     # Call the script with the arguments
-    subprocess.call(args)
+    # runs in train_daemon.py when it is up, the output is streamed to the output box
+    output_lines = []
+    for line in call_training_script(args):
+        output_lines.append(line)
+        yield "\n".join(output_lines[-max_output_lines:])
     save_config(
         config_path,
         script,
@@ -321,9 +341,17 @@ def run(
         max_time_steps
     )
     # print(args)
-    return " ".join(args)
+    output_lines.append(" ".join(args))
+    yield "\n".join(output_lines[-max_output_lines:])
     
 
+# save the config and add a snapshot of it to the queue, run the queue with train_queue.py
+def add_to_queue(config_path, *config_values):
+    save_config(config_path, *config_values)
+    with JobQueue() as queue:
+        job_id = queue.add_file(config_path)
+    return f"Added job {job_id} from {config_path}, start the queue with: python train_queue.py run"
+
 with gr.Blocks() as demo:
     gr.Markdown(
     """
@@ -445,9 +473,12 @@ with gr.Blocks() as demo:
         max_time_steps,
     ]
     output = gr.Textbox(label="Output Box")
-    run_btn = gr.Button("Run")
+    with gr.Row():
+        run_btn = gr.Button("Run")
+        queue_btn = gr.Button("Add to queue")
     # inputs.append(config_path)
     run_btn.click(fn=run, inputs=inputs, outputs=output, api_name="run")
+    queue_btn.click(fn=add_to_queue, inputs=inputs, outputs=output)
     save_config_btn.click(fn=save_config, inputs=inputs)
     load_config_btn.click(fn=load_config, inputs=[config_path], outputs=inputs)
 demo.launch()
\ No newline at end of file
@@ -9,7 +9,9 @@ default_config = {
     "sdxl_model_path":"/path/to/yoursdxlweight.safetensors",
     "merged_kolors_path":"/path/to/kolors/unet/merged_diffusion_pytorch_model.fp16.safetensors",
     "ratio":0.25,
-    "perturbed_ratio":0
+    "perturbed_ratio":0,
+    "block_ratios":"",
+    "chunk_size_mb":512
 }
 
 def run(
@@ -18,14 +20,18 @@ def run(
         sdxl_model_path,
         merged_kolors_path,
         ratio,
-        perturbed_ratio
+        perturbed_ratio,
+        block_ratios,
+        chunk_size_mb
     ):
     inputs = {
         "kolors_model_path":kolors_model_path,
         "sdxl_model_path":sdxl_model_path,
         "merged_kolors_path":merged_kolors_path,
         "ratio":ratio,
-        "perturbed_ratio":perturbed_ratio
+        "perturbed_ratio":perturbed_ratio,
+        "block_ratios":block_ratios if block_ratios else None,
+        "chunk_size_mb":int(chunk_size_mb)
     }
     # Convert the inputs dictionary to a list of arguments
     # args = ["python", "train_sd3_lora_ui.py"]  # replace "your_script.py" with the name of your script
@@ -67,6 +73,10 @@ with gr.Blocks() as demo:
         gr.Markdown("Experiment Function. Add some randomness to the merged. Default: 0. If you want to try it, recommanded 0.02 no more than 0.03")
         with gr.Row():
             perturbed_ratio = gr.Number(label="perturbed_ratio", value=default_config["perturbed_ratio"], minimum=0, maximum=0.1, step=0.001)
+        gr.Markdown("Per block multiplier of the ratio in json, blocks not listed use 1. Example: {\"down_blocks.0\": 0.5, \"mid_block\": 0}")
+        with gr.Row():
+            block_ratios = gr.Textbox(label="block_ratios", value=default_config["block_ratios"])
+            chunk_size_mb = gr.Number(label="chunk_size_mb", value=default_config["chunk_size_mb"], minimum=16, step=16)
         
     inputs = [
         script,
@@ -74,7 +84,9 @@ with gr.Blocks() as demo:
         sdxl_model_path,
         merged_kolors_path,
         ratio,
-        perturbed_ratio
+        perturbed_ratio,
+        block_ratios,
+        chunk_size_mb
         ]
     output = gr.Textbox(label="Output Box")
     run_btn = gr.Button("Run")
@@ -4,6 +4,10 @@ import subprocess
 import json
 import sys
 import os
+from utils.daemon_client import call_training_script
+
+# lines of training output shown in the output box
+max_output_lines = 30
 
 
 default_config = {
@@ -286,7 +290,11 @@ def run(
                 args.append(str(value))
                 
     # Call the script with the arguments
-    subprocess.call(args)
+    # runs in train_daemon.py when it is up, the output is streamed to the output box
+    output_lines = []
+    for line in call_training_script(args):
+        output_lines.append(line)
+        yield "\n".join(output_lines[-max_output_lines:])
     save_config(
         config_path,
         script,
@@ -328,7 +336,8 @@ def run(
         freeze_transformer_layer_after_include
     )
     # print(args)
-    return " ".join(args)
+    output_lines.append(" ".join(args))
+    yield "\n".join(output_lines[-max_output_lines:])
     
 
 with gr.Blocks() as demo:
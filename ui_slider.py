@@ -4,6 +4,10 @@ import subprocess
 import json
 import sys
 import os
+from utils.daemon_client import call_training_script
+
+# lines of training output shown in the output box
+max_output_lines = 30
 
 config_keys = [
     'script',
@@ -335,7 +339,8 @@ def run(
     if vae_path is None or vae_path == "" or not vae_path.endswith('.safetensors'):
         msg = "Vae need to be a single file ends with .safetensors. It should be the fp16 fix vae from https://huggingface.co/madebyollin/sdxl-vae-fp16-fix/tree/main"
         gr.Warning(msg)
-        return msg
+        yield msg
+        return
     
     inputs = {
         "seed":seed,
@@ -387,7 +392,11 @@ def run(
                 args.append(str(value))
                 
     # Call the script with the arguments
-    subprocess.call(args)
+    # runs in train_daemon.py when it is up, the output is streamed to the output box
+    output_lines = []
+    for line in call_training_script(args):
+        output_lines.append(line)
+        yield "\n".join(output_lines[-max_output_lines:])
     save_config(
         config_path,
         script,
@@ -427,7 +436,8 @@ def run(
         image_prefix
     )
     # print(args)
-    return " ".join(args)
+    output_lines.append(" ".join(args))
+    yield "\n".join(output_lines[-max_output_lines:])
     
 
 with gr.Blocks() as demo:
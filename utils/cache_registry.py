@@ -0,0 +1,244 @@
+import json
+import os
+import sqlite3
+import time
+from hashlib import md5
+
+# registry of text embedding / latent cache files shared by all kolors trainers and data scripts
+# a cache is identified by (encoder fingerprint, vae fingerprint, bucket config, crop policy)
+# artifacts are looked up by what they depend on only:
+#   text embeddings: encoder fingerprint + md5 of the encoded text
+#   latents: vae fingerprint + bucket config + crop policy + md5 of the image file
+# so a caption encoded by prepare_512_training.py or the slider trainer is found by the lora trainer
+# under any file name, instead of being encoded again.
+# fingerprints come from utils/model_fingerprint.py
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_REGISTRY_PATH = os.path.join(REPO_DIR, "cache", "cache_registry.db")
+
+TEXT = "text"
+LATENT = "latent"
+
+# crop_image / cache_file: center crop to the nearest bucket of the resolution, then resize
+CENTER_CROP_POLICY = "center_crop_nearest_bucket"
+
+def hash_text(text):
+    return md5(text.encode("utf-8")).hexdigest()
+
+def get_bucket_config(resolution, buckets):
+    return json.dumps({"resolution": int(resolution), "buckets": [list(bucket) for bucket in buckets]}, sort_keys=True)
+
+def get_cache_key(encoder_fingerprint, vae_fingerprint, bucket_config, crop_policy):
+    return md5(json.dumps([encoder_fingerprint, vae_fingerprint, bucket_config, crop_policy]).encode("utf-8")).hexdigest()[:16]
+
+def get_text_key(encoder_fingerprint):
+    return f"{TEXT}:{encoder_fingerprint}"
+
+def get_latent_key(vae_fingerprint, bucket_config, crop_policy):
+    return f"{LATENT}:" + md5(json.dumps([vae_fingerprint, bucket_config, crop_policy]).encode("utf-8")).hexdigest()[:16]
+
+def get_file_md5(path, chunk_size=1024 * 1024):
+    hasher = md5()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class CacheRegistry():
+    def __init__(self, db_path=CACHE_REGISTRY_PATH):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS caches ("
+            "cache_key TEXT PRIMARY KEY, "
+            "encoder_fingerprint TEXT, "
+            "vae_fingerprint TEXT, "
+            "bucket_config TEXT, "
+            "crop_policy TEXT, "
+            "created_at REAL, "
+            "last_used_at REAL)"
+        )
+        # which dataset / metadata file used the cache, and from which trainer
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_sources ("
+            "cache_key TEXT NOT NULL, "
+            "source TEXT NOT NULL, "
+            "trainer TEXT, "
+            "last_used_at REAL, "
+            "PRIMARY KEY (cache_key, source))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            "artifact_key TEXT NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "content_hash TEXT NOT NULL, "
+            "path TEXT NOT NULL, "
+            "file_size INTEGER, "
+            "file_mtime REAL, "
+            "file_md5 TEXT, "
+            "created_at REAL, "
+            "PRIMARY KEY (artifact_key, content_hash, path))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_artifact_path ON artifacts (path)")
+        self.conn.commit()
+
+    def register_cache(self, encoder_fingerprint, vae_fingerprint, bucket_config, crop_policy, source=None, trainer=None):
+        cache_key = get_cache_key(encoder_fingerprint, vae_fingerprint, bucket_config, crop_policy)
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO caches (cache_key, encoder_fingerprint, vae_fingerprint, bucket_config, crop_policy, created_at, last_used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(cache_key) DO UPDATE SET last_used_at=excluded.last_used_at",
+            (cache_key, encoder_fingerprint, vae_fingerprint, bucket_config, crop_policy, now, now)
+        )
+        if source is not None:
+            self.conn.execute(
+                "INSERT INTO cache_sources (cache_key, source, trainer, last_used_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(cache_key, source) DO UPDATE SET trainer=excluded.trainer, last_used_at=excluded.last_used_at",
+                (cache_key, os.path.abspath(source), trainer, now)
+            )
+        self.conn.commit()
+        return cache_key
+
+    # call commit() after a batch of registers
+    def register(self, artifact_key, kind, content_hash, path, file_md5=None):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self.conn.execute(
+            "INSERT INTO artifacts (artifact_key, kind, content_hash, path, file_size, file_mtime, file_md5, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(artifact_key, content_hash, path) DO UPDATE SET "
+            "file_size=excluded.file_size, file_mtime=excluded.file_mtime, file_md5=excluded.file_md5",
+            (artifact_key, kind, content_hash, path, stat.st_size, stat.st_mtime, file_md5, time.time())
+        )
+
+    # the file was rewritten by its owner (e.g. cache_file adds time_id to the npz), keep its rows valid
+    def refresh(self, path, file_md5=None):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self.conn.execute(
+            "UPDATE artifacts SET file_size=?, file_mtime=?, file_md5=? WHERE path=?",
+            (stat.st_size, stat.st_mtime, file_md5, path)
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    # path of an existing compatible artifact, None if there is none
+    # files which were deleted or changed since they were registered are dropped
+    def find(self, artifact_key, content_hash, exclude_path=None):
+        rows = self.conn.execute(
+            "SELECT path, file_size, file_mtime FROM artifacts WHERE artifact_key=? AND content_hash=? ORDER BY created_at DESC",
+            (artifact_key, content_hash)
+        ).fetchall()
+        if exclude_path is not None:
+            exclude_path = os.path.abspath(exclude_path)
+        for row in rows:
+            if row["path"] == exclude_path:
+                continue
+            if self.is_unchanged(row):
+                return row["path"]
+            self.conn.execute("DELETE FROM artifacts WHERE path=?", (row["path"],))
+        self.conn.commit()
+        return None
+
+    def is_unchanged(self, row):
+        if not os.path.exists(row["path"]):
+            return False
+        stat = os.stat(row["path"])
+        return stat.st_size == row["file_size"] and stat.st_mtime == row["file_mtime"]
+
+    # artifact keys which belong to a cache
+    def get_artifact_keys(self, cache):
+        return [
+            get_text_key(cache["encoder_fingerprint"]),
+            get_latent_key(cache["vae_fingerprint"], cache["bucket_config"], cache["crop_policy"]),
+        ]
+
+    def list_caches(self):
+        caches = []
+        for row in self.conn.execute("SELECT * FROM caches ORDER BY last_used_at DESC").fetchall():
+            cache = dict(row)
+            text_key, latent_key = self.get_artifact_keys(cache)
+            cache["text_artifacts"] = self.conn.execute("SELECT COUNT(*) FROM artifacts WHERE artifact_key=?", (text_key,)).fetchone()[0]
+            cache["latent_artifacts"] = self.conn.execute("SELECT COUNT(*) FROM artifacts WHERE artifact_key=?", (latent_key,)).fetchone()[0]
+            cache["sources"] = [dict(source) for source in self.conn.execute(
+                "SELECT source, trainer, last_used_at FROM cache_sources WHERE cache_key=?", (cache["cache_key"],)
+            ).fetchall()]
+            caches.append(cache)
+        return caches
+
+    # check registered files still exist and are unchanged, check_md5 also rehashes files with a stored md5
+    def verify(self, cache_key=None, check_md5=False):
+        if cache_key is None:
+            rows = self.conn.execute("SELECT * FROM artifacts").fetchall()
+        else:
+            cache = self.conn.execute("SELECT * FROM caches WHERE cache_key=?", (cache_key,)).fetchone()
+            if cache is None:
+                return None
+            keys = self.get_artifact_keys(cache)
+            rows = self.conn.execute("SELECT * FROM artifacts WHERE artifact_key IN (?, ?)", keys).fetchall()
+        report = {"ok": 0, "missing": [], "modified": []}
+        for row in rows:
+            if not os.path.exists(row["path"]):
+                report["missing"].append(row["path"])
+            elif not self.is_unchanged(row):
+                report["modified"].append(row["path"])
+            elif check_md5 and row["file_md5"] and get_file_md5(row["path"]) != row["file_md5"]:
+                report["modified"].append(row["path"])
+            else:
+                report["ok"] += 1
+        return report
+
+    # drop registry rows of missing or modified files
+    # max_age_days: also forget caches not used for that long, delete_files removes their files
+    # files still referenced by a cache in use are never deleted
+    def gc(self, max_age_days=None, delete_files=False):
+        stats = {"stale_rows": 0, "caches": 0, "deleted_files": 0}
+        for row in self.conn.execute("SELECT * FROM artifacts").fetchall():
+            if not self.is_unchanged(row):
+                self.conn.execute("DELETE FROM artifacts WHERE path=?", (row["path"],))
+                stats["stale_rows"] += 1
+        if max_age_days is not None:
+            threshold = time.time() - max_age_days * 86400
+            caches = [dict(row) for row in self.conn.execute("SELECT * FROM caches").fetchall()]
+            expired = [cache for cache in caches if cache["last_used_at"] < threshold]
+            live_keys = set()
+            for cache in caches:
+                if cache["last_used_at"] >= threshold:
+                    live_keys.update(self.get_artifact_keys(cache))
+            for cache in expired:
+                for artifact_key in self.get_artifact_keys(cache):
+                    if artifact_key in live_keys:
+                        continue
+                    paths = [row["path"] for row in self.conn.execute(
+                        "SELECT path FROM artifacts WHERE artifact_key=?", (artifact_key,)
+                    ).fetchall()]
+                    for path in paths:
+                        referenced = self.conn.execute(
+                            "SELECT COUNT(*) FROM artifacts WHERE path=? AND artifact_key!=?", (path, artifact_key)
+                        ).fetchone()[0]
+                        if delete_files and referenced == 0 and os.path.exists(path):
+                            os.remove(path)
+                            stats["deleted_files"] += 1
+                    self.conn.execute("DELETE FROM artifacts WHERE artifact_key=?", (artifact_key,))
+                self.conn.execute("DELETE FROM caches WHERE cache_key=?", (cache["cache_key"],))
+                self.conn.execute("DELETE FROM cache_sources WHERE cache_key=?", (cache["cache_key"],))
+                stats["caches"] += 1
+        self.conn.commit()
+        return stats
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,147 @@
+# Thanks to Kwai/kolors for the open source weight and comfyanonymous/ComfyUI for unet mapping code
+# ldm (single file checkpoint) -> diffusers unet conversion
+# the key map is computed once per unet config and cached to disk, shapes are validated from the
+# safetensors headers only, and the resulting plan is applied tensor by tensor
+
+import os
+import json
+from hashlib import md5
+import torch
+import comfy.utils
+from utils.safetensors_utils import LazyStateDict, SafetensorsStreamWriter, SAFETENSORS_DTYPES, TORCH_TO_SAFETENSORS_DTYPES
+
+# from ComfyUI-Kolors-MZ plugin
+KOLORS_UNET_CONFIG = {'use_checkpoint': False, 'image_size': 32, 'out_channels': 4, 'use_spatial_transformer': True, 'legacy': False,
+        'num_classes': 'sequential', 'adm_in_channels': 5632, 'dtype': torch.float16, 'in_channels': 4, 'model_channels': 320,
+        'num_res_blocks': [2, 2, 2], 'transformer_depth': [0, 0, 2, 2, 10, 10], 'channel_mult': [1, 2, 4], 'transformer_depth_middle': 10,
+        'use_linear_in_transformer': True, 'context_dim': 2048, 'num_head_channels': 64, 'transformer_depth_output': [0, 0, 0, 2, 2, 2, 10, 10, 10],
+        'use_temporal_attention': False, 'use_temporal_resblock': False}
+
+SDXL_UNET_CONFIG = {'use_checkpoint': False, 'image_size': 32, 'out_channels': 4, 'use_spatial_transformer': True, 'legacy': False,
+        'num_classes': 'sequential', 'adm_in_channels': 2816, 'dtype': torch.float16, 'in_channels': 4, 'model_channels': 320,
+        'num_res_blocks': [2, 2, 2], 'transformer_depth': [0, 0, 2, 2, 10, 10], 'channel_mult': [1, 2, 4], 'transformer_depth_middle': 10,
+        'use_linear_in_transformer': True, 'context_dim': 2048, 'num_head_channels': 64, 'transformer_depth_output': [0, 0, 0, 2, 2, 2, 10, 10, 10],
+        'use_temporal_attention': False, 'use_temporal_resblock': False}
+
+UNET_CONFIGS = {
+    "kolors": KOLORS_UNET_CONFIG,
+    "sdxl": SDXL_UNET_CONFIG,
+}
+
+LDM_UNET_PREFIX = "model.diffusion_model."
+
+# bump when the mapping code changes so old cache files are not reused
+KEY_MAP_VERSION = 1
+KEY_MAP_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "key_maps")
+
+key_map_memory_cache = {}
+
+def get_config_fingerprint(unet_config):
+    config_str = json.dumps(unet_config, sort_keys=True, default=str)
+    return md5(f"{KEY_MAP_VERSION}:{config_str}".encode("utf-8")).hexdigest()[:16]
+
+# return diffusers key -> ldm key (without prefix), cached in memory and on disk per unet config
+def get_unet_key_map(config_name="kolors", unet_config=None, cache_dir=KEY_MAP_CACHE_DIR):
+    if unet_config is None:
+        unet_config = UNET_CONFIGS[config_name]
+    fingerprint = get_config_fingerprint(unet_config)
+    if fingerprint in key_map_memory_cache:
+        return key_map_memory_cache[fingerprint]
+    cache_path = os.path.join(cache_dir, f"{config_name}_{fingerprint}.json")
+    if os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            key_map = json.load(f)
+    else:
+        key_map = comfy.utils.unet_to_diffusers(unet_config)
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(key_map, f, indent=0, sort_keys=True)
+    key_map_memory_cache[fingerprint] = key_map
+    return key_map
+
+# build the conversion plan from headers only
+# source_path: ldm checkpoint, reference_path: diffusers unet which defines output keys and shapes
+# keys the ldm checkpoint doesn't provide (e.g. kolors encoder_hid_proj) are taken from the reference
+def build_conversion_plan(source_path, reference_path, config_name="kolors", prefix=LDM_UNET_PREFIX):
+    key_map = get_unet_key_map(config_name)
+    source = LazyStateDict(source_path)
+    reference = LazyStateDict(reference_path)
+
+    entries = []
+    report = {
+        "converted": 0,
+        "from_reference": [],
+        "shape_mismatch": [],
+        "missing": [],
+        "unused_source_keys": 0,
+    }
+    used_source_keys = set()
+    for key in reference.keys():
+        shape = reference.shape(key)
+        dtype = TORCH_TO_SAFETENSORS_DTYPES[reference.dtype_of(key)]
+        ldm_key = key_map.get(key)
+        source_key = f"{prefix}{ldm_key}" if ldm_key is not None else None
+        if source_key is not None and source_key in source:
+            used_source_keys.add(source_key)
+            if source.shape(source_key) != shape:
+                report["shape_mismatch"].append({
+                    "key": key, "source_key": source_key,
+                    "shape": list(shape), "source_shape": list(source.shape(source_key))
+                })
+                entries.append({"key": key, "from": "reference", "source_key": key, "shape": list(shape), "dtype": dtype})
+                continue
+            entries.append({"key": key, "from": "source", "source_key": source_key, "shape": list(shape), "dtype": dtype})
+            report["converted"] += 1
+        else:
+            if source_key is not None:
+                report["missing"].append(key)
+            else:
+                report["from_reference"].append(key)
+            entries.append({"key": key, "from": "reference", "source_key": key, "shape": list(shape), "dtype": dtype})
+    report["unused_source_keys"] = len([key for key in source.keys() if key.startswith(prefix) and key not in used_source_keys])
+    return {
+        "config": config_name,
+        "source_path": source_path,
+        "reference_path": reference_path,
+        "metadata": reference.metadata(),
+        "entries": entries,
+        "report": report,
+    }
+
+def format_plan_report(plan):
+    report = plan["report"]
+    lines = [
+        f"config: {plan['config']}",
+        f"source: {plan['source_path']}",
+        f"reference: {plan['reference_path']}",
+        f"converted from source: {report['converted']}",
+        f"taken from reference (not in key map): {len(report['from_reference'])}",
+        f"missing in source (taken from reference): {len(report['missing'])}",
+        f"shape mismatch (taken from reference): {len(report['shape_mismatch'])}",
+        f"unused source unet keys: {report['unused_source_keys']}",
+    ]
+    for key in report["from_reference"]:
+        lines.append(f"  reference: {key}")
+    for key in report["missing"]:
+        lines.append(f"  missing: {key}")
+    for item in report["shape_mismatch"]:
+        lines.append(f"  shape mismatch: {item['key']} {item['shape']} <- {item['source_key']} {item['source_shape']}")
+    return "\n".join(lines)
+
+# write the converted unet tensor by tensor
+def apply_conversion_plan(plan, output_path, dtype=None):
+    source = LazyStateDict(plan["source_path"])
+    reference = LazyStateDict(plan["reference_path"])
+    tensor_infos = {}
+    for entry in plan["entries"]:
+        entry_dtype = SAFETENSORS_DTYPES[entry["dtype"]]
+        if dtype is not None and entry_dtype.is_floating_point:
+            entry_dtype = dtype
+        tensor_infos[entry["key"]] = (entry_dtype, tuple(entry["shape"]))
+    with SafetensorsStreamWriter(output_path, tensor_infos, plan["metadata"]) as writer:
+        for entry in plan["entries"]:
+            state_dict = source if entry["from"] == "source" else reference
+            target_dtype = tensor_infos[entry["key"]][0]
+            writer.write(entry["key"], state_dict.get_tensor(entry["source_key"], dtype=target_dtype))
+    source.close()
+    reference.close()
@@ -0,0 +1,101 @@
+import os
+import secrets
+import subprocess
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+# client side of train_daemon.py, only stdlib imports so the ui stays light
+# messages are dicts: job {"type": "job", "script", "args"}, replies {"type": "log" | "done" | "error"}
+
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = int(os.environ.get("TRAIN_DAEMON_PORT", 7870))
+# the connection unpickles what it receives, so the key must be secret:
+# TRAIN_DAEMON_AUTHKEY, or a random key the daemon writes on first start to a file only the user can read
+DAEMON_AUTHKEY_ENV = "TRAIN_DAEMON_AUTHKEY"
+
+def get_authkey_path():
+    if os.name == "nt" and os.environ.get("APPDATA"):
+        config_dir = os.environ["APPDATA"]
+    else:
+        config_dir = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(config_dir, "t2itrainer", "train_daemon_authkey")
+
+# the key of the running daemon, None when there is neither the env var nor the key file
+def get_authkey():
+    if os.environ.get(DAEMON_AUTHKEY_ENV):
+        return os.environ[DAEMON_AUTHKEY_ENV].encode("utf-8")
+    path = get_authkey_path()
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        authkey = f.read()
+    return authkey if len(authkey) > 0 else None
+
+# daemon side, creates the key file (0600) on first start
+# returns None when the key file can't be written or other users can read it
+def load_or_create_authkey():
+    authkey = get_authkey()
+    path = get_authkey_path()
+    if authkey is not None:
+        if not os.environ.get(DAEMON_AUTHKEY_ENV) and os.name != "nt" and os.stat(path).st_mode & 0o077:
+            print(f"{path} is readable by other users, run: chmod 600 {path}")
+            return None
+        return authkey
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as e:
+        print(f"can't create the daemon key file {path}: {e}")
+        return None
+    authkey = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    return authkey
+
+def connect(host=DAEMON_HOST, port=DAEMON_PORT, authkey=None):
+    authkey = authkey or get_authkey()
+    if authkey is None:
+        raise ConnectionRefusedError(f"no daemon key, set {DAEMON_AUTHKEY_ENV} or start train_daemon.py once")
+    return Client((host, port), authkey=authkey)
+
+def daemon_available(host=DAEMON_HOST, port=DAEMON_PORT, authkey=None):
+    try:
+        conn = connect(host, port, authkey)
+    except (OSError, AuthenticationError):
+        return False
+    try:
+        conn.send({"type": "ping"})
+        return conn.recv().get("type") == "pong"
+    except (OSError, EOFError):
+        return False
+    finally:
+        conn.close()
+
+# send one job and yield its output lines until it ends
+# the daemon runs jobs one at a time, a second ui request waits until the current job is done
+# result: optional dict, receives the returncode of the job
+def run_daemon_job(script, script_args, result=None, host=DAEMON_HOST, port=DAEMON_PORT, authkey=None):
+    conn = connect(host, port, authkey)
+    try:
+        conn.send({"type": "job", "script": script, "args": [str(arg) for arg in script_args]})
+        while True:
+            message = conn.recv()
+            if message["type"] == "log":
+                yield message["text"]
+            elif message["type"] == "done":
+                if result is not None:
+                    result["returncode"] = message["returncode"]
+                yield f"{script} finished with return code {message['returncode']}"
+                return
+            elif message["type"] == "error":
+                raise RuntimeError(message["text"])
+    finally:
+        conn.close()
+
+# run the training script in the daemon when it is up, otherwise in a new process like before
+# args: [python, script, *script_args]
+def call_training_script(args):
+    if daemon_available():
+        yield from run_daemon_job(args[1], args[2:])
+    else:
+        subprocess.call(args)
@@ -0,0 +1,137 @@
+import json
+import os
+import random
+from hashlib import md5
+
+import torch
+from tqdm import tqdm
+
+from utils.image_utils_kolors import PAIR_PROMPTS, collate_pairs, expand_pair_embeddings
+from utils.safetensors_utils import LazyStateDict, SafetensorsStreamWriter
+
+# reference model predictions for dpo training
+# every unique pair gets reference_slots (timestep, noise seed) draws from a seeded schedule.
+# the frozen unet (adapters disabled) predicts the noise of the winner and loser latents for
+# each draw once, the predictions are streamed to one safetensors file next to the latent pack
+# and the training step reads them back instead of running the reference forward.
+# keys: pos.{row}.{slot} / neg.{row}.{slot}, the file is rebuilt when its signature changes.
+
+REFERENCE_VERSION = 1
+
+# (timesteps_to, noise seed) of a draw, timesteps_to in [1, max_denoising_steps) like the training step
+def get_reference_schedule(row, slot, seed, max_denoising_steps):
+    rng = random.Random(f"{seed}:{row}:{slot}")
+    return rng.randint(1, max_denoising_steps - 1), rng.randint(0, 2**31 - 1)
+
+def get_reference_noise(shape, noise_seed):
+    return torch.randn(shape, generator=torch.Generator().manual_seed(noise_seed))
+
+# unique pairs of the dataset, the repeats of a pair share its predictions
+# returns the dataset index of each unique pair and the pair row of each dataset index
+def get_reference_rows(dataset):
+    row_ids = {}
+    rows = []
+    dataset_rows = []
+    for index in range(len(dataset)):
+        key = (tuple(dataset.latent_indices[index]), tuple(dataset.embed_indices[index].tolist()))
+        if key not in row_ids:
+            row_ids[key] = len(rows)
+            rows.append(index)
+        dataset_rows.append(row_ids[key])
+    return rows, dataset_rows
+
+# timesteps the noise is added at (max_denoising_steps schedule) and the unet is called with (train schedule)
+def get_timestep_tables(noise_scheduler, max_denoising_steps, device):
+    noise_scheduler.set_timesteps(max_denoising_steps, device=device)
+    noise_timesteps = noise_scheduler.timesteps.clone()
+    noise_scheduler.set_timesteps(noise_scheduler.config.num_train_timesteps, device=device)
+    model_timesteps = noise_scheduler.timesteps.clone()
+    return noise_timesteps, model_timesteps
+
+# noise and per sample timesteps of a batch from its (row, slot) draws, the same in precompute and training
+def get_scheduled_inputs(rows, slots, seed, shape, timestep_tables, max_denoising_steps, device):
+    noise_timesteps, model_timesteps = timestep_tables
+    num_train_timesteps = len(model_timesteps)
+    schedules = [get_reference_schedule(row, slot, seed, max_denoising_steps) for row, slot in zip(rows, slots)]
+    noise = torch.stack([get_reference_noise(shape, noise_seed) for _, noise_seed in schedules]).to(device)
+    steps = [timesteps_to for timesteps_to, _ in schedules]
+    noise_timestep = noise_timesteps[steps]
+    model_timestep = model_timesteps[[int(step * num_train_timesteps / max_denoising_steps) for step in steps]]
+    return noise, noise_timestep, model_timestep
+
+# changes with the latents, the prompt embeddings, the unet and the schedule
+def get_reference_signature(dataset, unet_fingerprint, reference_slots, seed, max_denoising_steps, dtype):
+    pack = LazyStateDict(dataset.pack_path)
+    pack_signature = (pack.metadata() or {}).get("signature")
+    pack.close()
+    npz_paths = sorted(set(datarow[f"{prefix}_npz_path"] for datarow in dataset.datarows for prefix in PAIR_PROMPTS))
+    npz_files = [[path, os.path.getsize(path), os.path.getmtime(path)] for path in npz_paths]
+    rows, _ = get_reference_rows(dataset)
+    return md5(json.dumps([
+        REFERENCE_VERSION, pack_signature, npz_files, unet_fingerprint,
+        reference_slots, seed, max_denoising_steps, str(dtype), len(rows)
+    ]).encode("utf-8")).hexdigest()
+
+# the cache when it matches the signature, None otherwise
+def load_reference_cache(path, signature):
+    if not os.path.exists(path):
+        return None
+    try:
+        cache = LazyStateDict(path)
+    except ValueError:
+        return None
+    if (cache.metadata() or {}).get("signature") != signature:
+        cache.close()
+        return None
+    return cache
+
+# predict_fn(noised_latents, timesteps, prompt_embeds, pooled_prompt_embeds, time_ids) -> noise prediction
+# of the reference model, called with winners and losers of up to batch_size draws at once
+@torch.no_grad()
+def precompute_reference(predict_fn, noise_scheduler, dataset, embedding_table, path, signature,
+                         reference_slots, seed, timestep_tables, max_denoising_steps, batch_size, dtype, device):
+    rows, _ = get_reference_rows(dataset)
+    pack = LazyStateDict(dataset.pack_path)
+    # draws of consecutive rows with the same latent size run together, the file is written in key order
+    tensor_infos = {}
+    batches = []
+    for row, index in enumerate(rows):
+        shape = pack.shape(f"latent.{dataset.latent_indices[index][0]}")
+        for slot in range(reference_slots):
+            tensor_infos[f"pos.{row}.{slot}"] = (dtype, shape)
+            tensor_infos[f"neg.{row}.{slot}"] = (dtype, shape)
+            if len(batches) > 0 and batches[-1][0] == shape and len(batches[-1][1]) < batch_size:
+                batches[-1][1].append((row, index, slot))
+            else:
+                batches.append((shape, [(row, index, slot)]))
+    pack.close()
+    print(f"Precompute reference predictions: {len(rows)} pairs x {reference_slots} slots")
+    # the writer only moves the file to path once it is complete
+    with SafetensorsStreamWriter(path, tensor_infos, metadata={"signature": signature, "reference_slots": reference_slots}) as writer:
+        for shape, draws in tqdm(batches):
+            batch = collate_pairs([dataset[index] for _, index, _ in draws])
+            batch = expand_pair_embeddings(batch, embedding_table)
+            noise, noise_timestep, model_timestep = get_scheduled_inputs(
+                [row for row, _, _ in draws], [slot for _, _, slot in draws], seed, shape,
+                timestep_tables, max_denoising_steps, device
+            )
+            pos_noised_latents = noise_scheduler.add_noise(batch["pos_latents"].to(device), noise, noise_timestep)
+            neg_noised_latents = noise_scheduler.add_noise(batch["neg_latents"].to(device), noise, noise_timestep)
+            noise_pred = predict_fn(
+                torch.cat([pos_noised_latents, neg_noised_latents]).to(dtype),
+                torch.cat([model_timestep, model_timestep]),
+                torch.cat([batch["pos_prompt_embeds"], batch["neg_prompt_embeds"]]),
+                torch.cat([batch["pos_pooled_prompt_embeds"], batch["neg_pooled_prompt_embeds"]]),
+                torch.cat([batch["pos_time_ids"], batch["neg_time_ids"]]).to(device),
+            ).to(dtype)
+            pos_pred, neg_pred = noise_pred.chunk(2)
+            for j, (row, _, slot) in enumerate(draws):
+                writer.write(f"pos.{row}.{slot}", pos_pred[j])
+                writer.write(f"neg.{row}.{slot}", neg_pred[j])
+            del noise_pred, pos_pred, neg_pred
+
+# stacked winner and loser predictions of a batch
+def get_reference_predictions(cache, rows, slots, device):
+    pos_pred = torch.stack([cache.get_tensor(f"pos.{row}.{slot}") for row, slot in zip(rows, slots)])
+    neg_pred = torch.stack([cache.get_tensor(f"neg.{row}.{slot}") for row, slot in zip(rows, slots)])
+    return pos_pred.to(device), neg_pred.to(device)
@@ -0,0 +1,113 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from hashlib import md5
+
+# dataset file listing shared by the trainers and data scripts, stdlib only
+# replaces glob.glob(f"{input_dir}/**", recursive=True): directories are listed with os.scandir
+# on a thread pool, and a snapshot of every directory listing with its mtime is kept in
+# cache/inventory. the next scan only lists directories whose mtime changed, the others
+# cost one stat, which matters on network filesystems with many files.
+# like glob, hidden files and directories (".name") are skipped and symlinks are followed.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INVENTORY_DIR = os.path.join(REPO_DIR, "cache", "inventory")
+INVENTORY_VERSION = 1
+
+# a directory changed within this many seconds of its listing could change again
+# with the same mtime, it is listed again on the next scan
+MTIME_GRACE_SECONDS = 2
+
+IMAGE_EXTS = [".jpg", ".jpeg", ".png", ".webp"]
+
+def get_snapshot_path(root, inventory_dir=INVENTORY_DIR):
+    root_hash = md5(os.path.abspath(root).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(inventory_dir, f"{root_hash}.json")
+
+def load_snapshot(snapshot_path, root):
+    if snapshot_path is None or not os.path.exists(snapshot_path):
+        return {}
+    try:
+        with open(snapshot_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if snapshot.get("version") != INVENTORY_VERSION or snapshot.get("root") != os.path.abspath(root):
+        return {}
+    return snapshot["dirs"]
+
+def save_snapshot(snapshot_path, root, dirs):
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    tmp_path = f"{snapshot_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": INVENTORY_VERSION, "root": os.path.abspath(root), "dirs": dirs}, f)
+    os.replace(tmp_path, snapshot_path)
+
+# listing of one directory, the cached one when its mtime is unchanged
+# returns None when the directory can't be read
+def list_directory(path, cached=None):
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    if cached is not None and cached["mtime_ns"] == mtime_ns:
+        return cached
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+    except OSError:
+        return None
+    if time.time_ns() - mtime_ns < MTIME_GRACE_SECONDS * 1e9:
+        mtime_ns = None
+    return {"mtime_ns": mtime_ns, "files": sorted(files), "dirs": sorted(subdirs)}
+
+# relative dir path ("" for root) -> listing
+def scan_directory(root, max_workers=16, snapshot_path=None):
+    old_dirs = load_snapshot(snapshot_path, root)
+    dirs = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(list_directory, root, old_dirs.get("")): ""}
+        while len(futures) > 0:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                rel_dir = futures.pop(future)
+                listing = future.result()
+                if listing is None:
+                    continue
+                dirs[rel_dir] = listing
+                for name in listing["dirs"]:
+                    sub_dir = os.path.join(rel_dir, name) if rel_dir else name
+                    futures[executor.submit(list_directory, os.path.join(root, sub_dir), old_dirs.get(sub_dir))] = sub_dir
+    if snapshot_path is not None:
+        save_snapshot(snapshot_path, root, dirs)
+    return dirs
+
+# all files under root, optionally filtered by extension (case insensitive)
+# paths are joined the same way glob joins them, so they match image_path in existing metadata
+def scan_files(root, exts=None, max_workers=16, use_snapshot=True):
+    if not os.path.isdir(root):
+        return []
+    snapshot_path = get_snapshot_path(root) if use_snapshot else None
+    dirs = scan_directory(root, max_workers=max_workers, snapshot_path=snapshot_path)
+    if exts is not None:
+        exts = [ext.lower() for ext in exts]
+    files = []
+    for rel_dir in sorted(dirs):
+        dir_path = os.path.join(root, rel_dir) if rel_dir else root
+        for name in dirs[rel_dir]["files"]:
+            if exts is None or os.path.splitext(name)[-1].lower() in exts:
+                files.append(os.path.join(dir_path, name))
+    return files
@@ -0,0 +1,58 @@
+import json
+import os
+
+# append only journal of a generation job, stdlib only
+# one json line per finished stage of an item: {"key": ..., "stage": ..., **fields}
+# a rerun skips what the journal records as done instead of checking every output file,
+# a line torn by a crash is ignored and that stage runs again.
+# to regenerate items, delete their output files and the journal.
+
+class GenerationJournal():
+    def __init__(self, path):
+        self.path = path
+        journal_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(journal_dir, exist_ok=True)
+        # key -> stage -> fields
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    key = record.pop("key")
+                    stage = record.pop("stage")
+                    self.records.setdefault(key, {})[stage] = record
+        self.file = open(path, "a", encoding="utf-8")
+        # start new records on a fresh line after a torn one
+        if self.file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.file.write("\n")
+
+    def is_done(self, key, stage):
+        return stage in self.records.get(key, {})
+
+    def get(self, key, stage):
+        return self.records.get(key, {}).get(stage)
+
+    def mark(self, key, stage, **fields):
+        self.records.setdefault(key, {})[stage] = fields
+        self.file.write(json.dumps({"key": key, "stage": stage, **fields}, ensure_ascii=False) + "\n")
+
+    # call after each batch, the journal must not claim outputs which are not on disk
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -13,9 +13,16 @@ from utils.utils import (
     get_md5_by_path
 )
 import glob
+import shutil
 from utils.dist_utils import flush
+from utils.cache_registry import (
+    CacheRegistry, TEXT, LATENT, CENTER_CROP_POLICY,
+    hash_text, get_bucket_config, get_text_key, get_latent_key
+)
 import numpy as np
 import pandas as pd
+from hashlib import md5
+from utils.safetensors_utils import LazyStateDict, SafetensorsStreamWriter
 
 
 # BASE_RESOLUTION = 1024
@@ -298,14 +305,172 @@ class CachedPairsDataset(Dataset):
             "main_pooled_prompt_embed": main_pooled_prompt_embed,
         }
 
+# pos / neg / main prompt of each pairs datarow
+PAIR_PROMPTS = ["pos", "neg", "main"]
+
+# unique pos and neg latent files of the pairs datarows, returns the paths and latent_path -> index in the pack
+def get_pair_latent_index(datarows):
+    latent_paths = []
+    latent_index = {}
+    for datarow in datarows:
+        for prefix in ["pos", "neg"]:
+            latent_path = datarow[f"{prefix}_latent_path"]
+            if latent_path not in latent_index:
+                latent_index[latent_path] = len(latent_paths)
+                latent_paths.append(latent_path)
+    return latent_paths, latent_index
+
+# changes when a latent file is added, removed or rewritten
+def get_pair_pack_signature(latent_paths):
+    return md5(json.dumps(
+        [[path, os.path.getsize(path), os.path.getmtime(path)] for path in latent_paths]
+    ).encode("utf-8")).hexdigest()
+
+# signature of an existing pack, None when it is missing or unreadable
+def read_pair_pack_signature(pack_path):
+    if not os.path.exists(pack_path):
+        return None
+    try:
+        pack = LazyStateDict(pack_path)
+        pack_signature = (pack.metadata() or {}).get("signature")
+        pack.close()
+    except ValueError:
+        pack_signature = None
+    return pack_signature
+
+# packs the pos and neg latents of the pairs datarows into one safetensors file
+# rebuilt when its signature changes. the latents are streamed to the file one at a time and it only
+# replaces pack_path once complete. call it on the main process and wait_for_everyone before
+# the other ranks build a SharedPairsDataset on the same pack_path
+def pack_pair_latents(datarows, pack_path):
+    latent_paths, latent_index = get_pair_latent_index(datarows)
+    signature = get_pair_pack_signature(latent_paths)
+    if read_pair_pack_signature(pack_path) == signature:
+        return latent_index
+    print(f"Packing {len(latent_paths)} latents to {pack_path}")
+    # shapes and dtypes first, the header of the streamed file is written up front
+    tensor_infos = {}
+    for i, latent_path in enumerate(tqdm(latent_paths)):
+        latent_dict = torch.load(latent_path)
+        tensor_infos[f"latent.{i}"] = (latent_dict["latent"].dtype, tuple(latent_dict["latent"].shape))
+        tensor_infos[f"time_id.{i}"] = (latent_dict["time_id"].dtype, tuple(latent_dict["time_id"].shape))
+        del latent_dict
+    with SafetensorsStreamWriter(pack_path, tensor_infos, metadata={"signature": signature}) as writer:
+        for i, latent_path in enumerate(tqdm(latent_paths)):
+            latent_dict = torch.load(latent_path)
+            writer.write(f"latent.{i}", latent_dict["latent"])
+            writer.write(f"time_id.{i}", latent_dict["time_id"])
+            del latent_dict
+    return latent_index
+
+##input: datarows -> output: latents and indices into the shared embeddings
+# the pos, neg and main embeddings are the same for most rows, they are loaded once and kept as
+# one table, rows only carry indices into it. latents are read from the packed file, so a sample
+# costs two small reads instead of five torch.load calls.
+# use collate_pairs as collate_fn and expand_pair_embeddings on the device in the training loop
+class SharedPairsDataset(Dataset):
+    def __init__(self, datarows, pack_path, conditional_dropout_percent=0.1):
+        self.datarows = datarows
+        self.pack_path = pack_path
+        self.conditional_dropout_percent = conditional_dropout_percent
+        embedding_index = {}
+        prompt_embeds = []
+        pooled_prompt_embeds = []
+        for datarow in datarows:
+            for prefix in PAIR_PROMPTS:
+                npz_path = datarow[f"{prefix}_npz_path"]
+                if npz_path not in embedding_index:
+                    npz = torch.load(npz_path)
+                    embedding_index[npz_path] = len(prompt_embeds)
+                    prompt_embeds.append(npz["prompt_embed"])
+                    pooled_prompt_embeds.append(npz["pooled_prompt_embed"])
+        # empty embedding for conditional_dropout, last entry of the table
+        self.empty_index = None
+        if conditional_dropout_percent > 0:
+            embedding = get_empty_embedding()
+            self.empty_index = len(prompt_embeds)
+            prompt_embeds.append(embedding["prompt_embed"])
+            pooled_prompt_embeds.append(embedding["pooled_prompt_embed"])
+        self.prompt_embeds = torch.stack(prompt_embeds)
+        self.pooled_prompt_embeds = torch.stack(pooled_prompt_embeds)
+        self.embed_indices = torch.tensor(
+            [[embedding_index[datarow[f"{prefix}_npz_path"]] for prefix in PAIR_PROMPTS] for datarow in datarows],
+            dtype=torch.long
+        )
+        # the pack is built by pack_pair_latents on the main process before the dataset is created
+        latent_paths, latent_index = get_pair_latent_index(datarows)
+        if read_pair_pack_signature(pack_path) != get_pair_pack_signature(latent_paths):
+            raise ValueError(f"{pack_path} is missing or out of date, run pack_pair_latents first")
+        self.latent_indices = [(latent_index[datarow["pos_latent_path"]], latent_index[datarow["neg_latent_path"]]) for datarow in datarows]
+        # opened on first access, so the dataset can still be pickled for dataloader workers
+        self.pack = None
+
+    def __len__(self):
+        return len(self.datarows)
+
+    def __getitem__(self, index):
+        if self.pack is None:
+            self.pack = LazyStateDict(self.pack_path)
+        pos_index, neg_index = self.latent_indices[index]
+        embed_indices = self.embed_indices[index].clone()
+        # conditional_dropout on pos and neg, main is kept
+        for i in range(2):
+            if random.random() < self.conditional_dropout_percent:
+                embed_indices[i] = self.empty_index
+        return {
+            "pos_latent": self.pack.get_tensor(f"latent.{pos_index}"),
+            "pos_time_id": self.pack.get_tensor(f"time_id.{pos_index}"),
+            "neg_latent": self.pack.get_tensor(f"latent.{neg_index}"),
+            "neg_time_id": self.pack.get_tensor(f"time_id.{neg_index}"),
+            "embed_indices": embed_indices,
+            "index": index,
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pack"] = None
+        return state
+
+def collate_pairs(examples):
+    return {
+        "pos_latents": torch.stack([example["pos_latent"] for example in examples]),
+        "pos_time_ids": torch.stack([example["pos_time_id"] for example in examples]),
+        "neg_latents": torch.stack([example["neg_latent"] for example in examples]),
+        "neg_time_ids": torch.stack([example["neg_time_id"] for example in examples]),
+        "embed_indices": torch.stack([example["embed_indices"] for example in examples]),
+        "indices": torch.tensor([example["index"] for example in examples], dtype=torch.long),
+    }
+
+# embedding_table: (prompt_embeds, pooled_prompt_embeds) of SharedPairsDataset, moved to the device once
+# adds pos / neg / main prompt_embeds and pooled_prompt_embeds to the batch, gathered on the table device
+def expand_pair_embeddings(batch, embedding_table):
+    prompt_embeds, pooled_prompt_embeds = embedding_table
+    embed_indices = batch["embed_indices"].to(prompt_embeds.device)
+    for i, prefix in enumerate(PAIR_PROMPTS):
+        batch[f"{prefix}_prompt_embeds"] = prompt_embeds[embed_indices[:, i]]
+        batch[f"{prefix}_pooled_prompt_embeds"] = pooled_prompt_embeds[embed_indices[:, i]]
+    return batch
+
 # main idea is store all tensor related in .npz file
 # other information stored in .json
 @torch.no_grad()
-def create_metadata_cache(tokenizers,text_encoders,vae,image_files,recreate_cache=False, metadata_path="metadata_kolors.json", resolution_config="1024"):
+# encoder_fingerprint, vae_fingerprint: when given, embeddings and latents are shared through the cache registry
+def create_metadata_cache(tokenizers,text_encoders,vae,image_files,recreate_cache=False, metadata_path="metadata_kolors.json", resolution_config="1024",
+                          encoder_fingerprint=None, vae_fingerprint=None, trainer="kolors_lora"):
     datarows = []
     embedding_objects = []
     resolutions = resolution_config.split(",")
     resolutions = [int(resolution) for resolution in resolutions]
+    registry = None
+    text_key = None
+    latent_keys = {}
+    if encoder_fingerprint is not None and vae_fingerprint is not None:
+        registry = CacheRegistry()
+        text_key = get_text_key(encoder_fingerprint)
+        for resolution in resolutions:
+            bucket_config = get_bucket_config(resolution, RESOLUTION_CONFIG[resolution])
+            registry.register_cache(encoder_fingerprint, vae_fingerprint, bucket_config, CENTER_CROP_POLICY, source=metadata_path, trainer=trainer)
+            latent_keys[resolution] = get_latent_key(vae_fingerprint, bucket_config, CENTER_CROP_POLICY)
     for image_file in tqdm(image_files):
         file_name = os.path.basename(image_file)
         folder_path = os.path.dirname(image_file)
@@ -313,9 +478,12 @@ def create_metadata_cache(tokenizers,text_encoders,vae,image_files,recreate_cach
         # for resolution in resolutions:
         json_obj = create_embedding(
             tokenizers,text_encoders,folder_path,file_name,
-            resolutions=resolutions,recreate_cache=recreate_cache)
+            resolutions=resolutions,recreate_cache=recreate_cache,
+            registry=registry,text_key=text_key,encoder_fingerprint=encoder_fingerprint)
         
         embedding_objects.append(json_obj)
+    if registry is not None:
+        registry.commit()
     
     # move glm to cpu to reduce vram memory
     text_encoders[0].to("cpu")
@@ -325,8 +493,11 @@ def create_metadata_cache(tokenizers,text_encoders,vae,image_files,recreate_cach
     print("Cache latent")
     for json_obj in tqdm(embedding_objects):
         for resolution in resolutions:
-            full_obj = cache_file(vae,json_obj,resolution=resolution,recreate_cache=recreate_cache)
+            full_obj = cache_file(vae,json_obj,resolution=resolution,recreate_cache=recreate_cache,
+                                  registry=registry,latent_key=latent_keys.get(resolution),vae_fingerprint=vae_fingerprint)
             datarows.append(full_obj)
+    if registry is not None:
+        registry.close()
     # Serializing json
     json_object = json.dumps(datarows, indent=4)
     
@@ -336,8 +507,30 @@ def create_metadata_cache(tokenizers,text_encoders,vae,image_files,recreate_cach
     
     return datarows
 
+# fingerprint of the model a cache file was written with, None for files written before stamping
+def get_cache_fingerprint(path, key):
+    try:
+        return torch.load(path).get(key)
+    except:
+        return None
+
+# only files stamped by another model are stale, unstamped files are kept
+def is_stale_fingerprint(cache_fingerprint, fingerprint):
+    return fingerprint is not None and cache_fingerprint is not None and cache_fingerprint != fingerprint
+
+# rows whose embedding or latent was written by another text encoder / vae than the current one
+# returns the image paths to cache again and the rows of the other images
+def split_stale_datarows(datarows, encoder_fingerprint, vae_fingerprint):
+    stale_images = set()
+    for datarow in datarows:
+        if datarow.get("encoder_fingerprint", encoder_fingerprint) != encoder_fingerprint or \
+            datarow.get("vae_fingerprint", vae_fingerprint) != vae_fingerprint:
+            stale_images.add(datarow["image_path"])
+    valid_datarows = [datarow for datarow in datarows if datarow["image_path"] not in stale_images]
+    return sorted(stale_images), valid_datarows
+
 @torch.no_grad()
-def create_embedding(tokenizers,text_encoders,folder_path,file,cache_ext=".npkolors",resolutions=None,recreate_cache=False):
+def create_embedding(tokenizers,text_encoders,folder_path,file,cache_ext=".npkolors",resolutions=None,recreate_cache=False,registry=None,text_key=None,encoder_fingerprint=None):
     # get filename and ext from file
     filename, _ = os.path.splitext(file)
     image_path = os.path.join(folder_path, file)
@@ -375,14 +568,35 @@ def create_embedding(tokenizers,text_encoders,folder_path,file,cache_ext=".npkol
     npz_path = f'{file_path}{cache_ext}'
     json_obj["npz_path"] = npz_path
     
+    text_hash = hash_text(content)
+    cache_fingerprint = None
     if not recreate_cache and os.path.exists(npz_path):
+        cache_fingerprint = get_cache_fingerprint(npz_path, "encoder_fingerprint")
+    if not recreate_cache and os.path.exists(npz_path) and not is_stale_fingerprint(cache_fingerprint, encoder_fingerprint):
         if 'npz_path_md5' not in json_obj:
             json_obj["npz_path_md5"] = get_md5_by_path(npz_path)
+        if cache_fingerprint is not None:
+            json_obj["encoder_fingerprint"] = cache_fingerprint
+        if registry is not None:
+            registry.register(text_key, TEXT, text_hash, npz_path)
         return json_obj
     
-    prompt_embeds, pooled_prompt_embeds = compute_text_embeddings(text_encoders,tokenizers,content,device=text_encoders[0].device)
-    prompt_embed = prompt_embeds.squeeze(0)
-    pooled_prompt_embed = pooled_prompt_embeds.squeeze(0)
+    # the same caption may be encoded already by another trainer or data script
+    cached_npz = None
+    if registry is not None and not recreate_cache:
+        source_path = registry.find(text_key, text_hash, exclude_path=npz_path)
+        if source_path is not None:
+            try:
+                cached_npz = torch.load(source_path)
+            except:
+                print(f"Failed to load {source_path}")
+    if cached_npz is not None:
+        prompt_embed = cached_npz["prompt_embed"]
+        pooled_prompt_embed = cached_npz["pooled_prompt_embed"]
+    else:
+        prompt_embeds, pooled_prompt_embeds = compute_text_embeddings(text_encoders,tokenizers,content,device=text_encoders[0].device)
+        prompt_embed = prompt_embeds.squeeze(0)
+        pooled_prompt_embed = pooled_prompt_embeds.squeeze(0)
     
     try:
         image = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
@@ -403,15 +617,20 @@ def create_embedding(tokenizers,text_encoders,folder_path,file,cache_ext=".npkol
         "pooled_prompt_embed": pooled_prompt_embed.cpu(),
         "time_id": time_id.cpu()
     }
+    if encoder_fingerprint is not None:
+        npz_dict["encoder_fingerprint"] = encoder_fingerprint
+        json_obj["encoder_fingerprint"] = encoder_fingerprint
     
     # save latent to cache file
     torch.save(npz_dict, npz_path)
+    if registry is not None:
+        registry.register(text_key, TEXT, text_hash, npz_path)
     return json_obj
 
 # based on image_path, caption_path, caption create json object
 # write tensor related to npz file
 @torch.no_grad()
-def cache_file(vae,json_obj,resolution=1024,cache_ext=".npkolors",latent_ext=".nplatent",recreate_cache=False):
+def cache_file(vae,json_obj,resolution=1024,cache_ext=".npkolors",latent_ext=".nplatent",recreate_cache=False,registry=None,latent_key=None,vae_fingerprint=None):
     npz_path = json_obj["npz_path"]
     
     
@@ -479,34 +698,54 @@ def cache_file(vae,json_obj,resolution=1024,cache_ext=".npkolors",latent_ext=".n
     
     time_id = torch.tensor(list(original_size + crops_coords_top_left + target_size)).to(vae.device, dtype=vae.dtype)
 
-    # skip if already cached
+    # skip if already cached by the same vae
+    cache_fingerprint = None
     if os.path.exists(latent_cache_path) and not recreate_cache:
+        cache_fingerprint = get_cache_fingerprint(latent_cache_path, "vae_fingerprint")
+    if os.path.exists(latent_cache_path) and not recreate_cache and not is_stale_fingerprint(cache_fingerprint, vae_fingerprint):
         if 'latent_path_md5' not in json_obj:
             json_obj['latent_path_md5'] = get_md5_by_path(latent_cache_path)
             json_obj['npz_path_md5'] = get_md5_by_path(npz_path)
+        if cache_fingerprint is not None:
+            json_obj["vae_fingerprint"] = cache_fingerprint
+        if registry is not None:
+            registry.register(latent_key, LATENT, json_obj['image_path_md5'], latent_cache_path)
         return json_obj
     
-    train_transforms = transforms.Compose([transforms.ToTensor(), transforms.Normalize([0.5], [0.5])])
-    image = train_transforms(image)
-    
-    # create tensor latent
-    pixel_values = []
-    pixel_values.append(image)
-    pixel_values = torch.stack(pixel_values).to(vae.device)
-    del image
-    
-    with torch.no_grad():
-        #contiguous_format = (contiguous memory block), unsqueeze(0) adds bsz 1 dimension, else error: but got weight of shape [128] and input of shape [128, 512, 512]
-        latent = vae.encode(pixel_values).latent_dist.sample().squeeze(0)
-        # .squeeze(0) #squeeze to remove bsz dimension
-        latent = latent * vae.config.scaling_factor
-        del pixel_values
-        # print(latent.shape) torch.Size([4, 144, 112])
-
-    latent_dict = {
-        'latent': latent.cpu()
-    }
-    torch.save(latent_dict, latent_cache_path)
+    # the same image may be encoded already with the same vae, buckets and crop
+    source_path = None
+    if registry is not None and not recreate_cache:
+        source_path = registry.find(latent_key, json_obj['image_path_md5'], exclude_path=latent_cache_path)
+    if source_path is not None:
+        shutil.copyfile(source_path, latent_cache_path)
+    else:
+        train_transforms = transforms.Compose([transforms.ToTensor(), transforms.Normalize([0.5], [0.5])])
+        image = train_transforms(image)
+        
+        # create tensor latent
+        pixel_values = []
+        pixel_values.append(image)
+        pixel_values = torch.stack(pixel_values).to(vae.device)
+        del image
+        
+        with torch.no_grad():
+            #contiguous_format = (contiguous memory block), unsqueeze(0) adds bsz 1 dimension, else error: but got weight of shape [128] and input of shape [128, 512, 512]
+            latent = vae.encode(pixel_values).latent_dist.sample().squeeze(0)
+            # .squeeze(0) #squeeze to remove bsz dimension
+            latent = latent * vae.config.scaling_factor
+            del pixel_values
+            # print(latent.shape) torch.Size([4, 144, 112])
+
+        latent_dict = {
+            'latent': latent.cpu()
+        }
+        if vae_fingerprint is not None:
+            latent_dict['vae_fingerprint'] = vae_fingerprint
+        torch.save(latent_dict, latent_cache_path)
+    if vae_fingerprint is not None:
+        json_obj['vae_fingerprint'] = vae_fingerprint
+    if registry is not None:
+        registry.register(latent_key, LATENT, json_obj['image_path_md5'], latent_cache_path)
     # latent_dict['latent'] = latent.cpu()
     npz_dict['time_id'] = time_id.cpu()
     npz_dict['latent_path'] = latent_cache_path
@@ -514,6 +753,8 @@ def cache_file(vae,json_obj,resolution=1024,cache_ext=".npkolors",latent_ext=".n
     # save latent to cache file
     torch.save(npz_dict, npz_path)
     json_obj['npz_path_md5'] = get_md5_by_path(npz_path)
+    if registry is not None:
+        registry.refresh(npz_path)
     del npz_dict
     flush()
     return json_obj
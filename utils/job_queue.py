@@ -0,0 +1,205 @@
+import json
+import os
+import sqlite3
+import subprocess
+import time
+
+# persistent queue of training jobs, stdlib only
+# a job is a config json in the format ui.py save_config writes, stored as a snapshot so the
+# config file can be overwritten by the ui after queueing. the queue lives in sqlite, so
+# jobs can be added while the runner is working and a crash leaves the state on disk.
+
+# keys of the ui config which are not training script arguments
+QUEUE_ONLY_KEYS = ["script", "config_path", "memory_gb"]
+DEFAULT_SCRIPT = "train_kolors_lora_ui.py"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# jobs with the same key share the latent/embedding cache of the dataset
+# the base model is included so the daemon keeps the same weights resident for the whole group
+def get_group_key(config):
+    keys = ["script", "train_data_dir", "resolution", "pretrained_model_name_or_path", "model_path", "vae_path"]
+    return json.dumps([str(config.get(key) or "") for key in keys])
+
+# same conversion as ui.py run
+def config_to_args(config):
+    args = []
+    for key, value in config.items():
+        if key in QUEUE_ONLY_KEYS or value is None:
+            continue
+        if isinstance(value, bool):
+            if value == True:
+                args.append(f"--{key}")
+        else:
+            args.append(f"--{key}")
+            args.append(str(value))
+    return args
+
+# trainers name checkpoints f"{save_name}-{global_step}" in output_dir, save_name may contain "-"
+# returns the directory name of the newest checkpoint, None when there is none
+def get_latest_checkpoint(config):
+    output_dir = config.get("output_dir")
+    save_name = config.get("save_name")
+    if not output_dir or not save_name or not os.path.isdir(output_dir):
+        return None
+    latest = None
+    latest_step = -1
+    for name in os.listdir(output_dir):
+        prefix, _, step = name.rpartition("-")
+        if prefix == save_name and step.isdigit() and os.path.isdir(os.path.join(output_dir, name)) and int(step) > latest_step:
+            latest, latest_step = name, int(step)
+    return latest
+
+def has_checkpoint(config):
+    return get_latest_checkpoint(config) is not None
+
+# jobs on the same dataset write the same cache files and metadata json, they never run at the same time
+def get_data_dir_key(config):
+    train_data_dir = config.get("train_data_dir") or ""
+    return os.path.normcase(os.path.abspath(train_data_dir)) if train_data_dir else ""
+
+# free memory in MB per gpu from nvidia-smi, None when it isn't available
+def get_free_gpu_memory():
+    try:
+        result = subprocess.run(
+            ["nvidia-smi", "--query-gpu=memory.free", "--format=csv,noheader,nounits"],
+            capture_output=True, text=True, timeout=10
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    return [int(line.strip()) for line in result.stdout.splitlines() if line.strip() != ""]
+
+class JobQueue():
+    def __init__(self, db_path="queue/queue.db"):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        self.log_dir = os.path.join(db_dir, "logs")
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "config TEXT NOT NULL, "
+            "config_path TEXT, "
+            "group_key TEXT NOT NULL, "
+            "status TEXT NOT NULL, "
+            "returncode INTEGER, "
+            "attempts INTEGER DEFAULT 0, "
+            "log_path TEXT, "
+            "created_at REAL, "
+            "started_at REAL, "
+            "finished_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON jobs (status)")
+        self.conn.commit()
+
+    def add(self, config, config_path=None):
+        config = dict(config)
+        config.setdefault("script", DEFAULT_SCRIPT)
+        cursor = self.conn.execute(
+            "INSERT INTO jobs (config, config_path, group_key, status, created_at) VALUES (?, ?, ?, ?, ?)",
+            (json.dumps(config), config_path, get_group_key(config), PENDING, time.time())
+        )
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def add_file(self, config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return self.add(config, config_path)
+
+    def get(self, job_id):
+        row = self.conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return self.to_job(row)
+
+    def to_job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["config"] = json.loads(job["config"])
+        return job
+
+    def jobs(self, status=None):
+        if status is None:
+            rows = self.conn.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        else:
+            rows = self.conn.execute("SELECT * FROM jobs WHERE status=? ORDER BY id", (status,)).fetchall()
+        return [self.to_job(row) for row in rows]
+
+    # pending jobs in run order: groups by their oldest job, jobs of a group back to back
+    # prefer_group: the group which just finished, continue it while it has pending jobs
+    # exclude_data_dirs: get_data_dir_key of the running jobs, their datasets are busy
+    def pending(self, prefer_group=None, exclude_data_dirs=()):
+        jobs = [job for job in self.jobs(PENDING) if get_data_dir_key(job["config"]) not in exclude_data_dirs]
+        group_order = {}
+        for job in jobs:
+            group_order.setdefault(job["group_key"], job["id"])
+        jobs.sort(key=lambda job: (job["group_key"] != prefer_group, group_order[job["group_key"]], job["id"]))
+        return jobs
+
+    def start(self, job_id):
+        os.makedirs(self.log_dir, exist_ok=True)
+        log_path = os.path.join(self.log_dir, f"job_{job_id}.log")
+        self.conn.execute(
+            "UPDATE jobs SET status=?, started_at=?, finished_at=NULL, returncode=NULL, attempts=attempts+1, log_path=? WHERE id=?",
+            (RUNNING, time.time(), log_path, job_id)
+        )
+        self.conn.commit()
+        return log_path
+
+    def finish(self, job_id, returncode):
+        self.conn.execute(
+            "UPDATE jobs SET status=?, returncode=?, finished_at=? WHERE id=?",
+            (DONE if returncode == 0 else FAILED, returncode, time.time(), job_id)
+        )
+        self.conn.commit()
+
+    def update_config(self, job_id, config):
+        self.conn.execute("UPDATE jobs SET config=? WHERE id=?", (json.dumps(config), job_id))
+        self.conn.commit()
+
+    # jobs left running by a crashed runner go back to pending
+    # when the trainer already saved a checkpoint, continue from it instead of starting over
+    def recover(self):
+        recovered = []
+        for job in self.jobs(RUNNING):
+            config = job["config"]
+            latest_checkpoint = get_latest_checkpoint(config)
+            if not config.get("resume_from_checkpoint") and latest_checkpoint is not None:
+                # the directory name, the trainers resume from output_dir/basename(resume_from_checkpoint)
+                config["resume_from_checkpoint"] = latest_checkpoint
+                self.update_config(job["id"], config)
+            self.conn.execute("UPDATE jobs SET status=? WHERE id=?", (PENDING, job["id"]))
+            recovered.append(job["id"])
+        self.conn.commit()
+        return recovered
+
+    def retry_failed(self):
+        cursor = self.conn.execute("UPDATE jobs SET status=? WHERE status=?", (PENDING, FAILED))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def remove(self, job_ids):
+        self.conn.executemany("DELETE FROM jobs WHERE id=? AND status!=?", [(job_id, RUNNING) for job_id in job_ids])
+        self.conn.commit()
+
+    def clear_done(self):
+        cursor = self.conn.execute("DELETE FROM jobs WHERE status=?", (DONE,))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,51 @@
+import torch
+from peft.tuners.lora import LoraLayer
+
+# per sample lora scale for peft lora layers
+# peft reads module.scaling[adapter] in every forward, a forward pre hook replaces it with
+# one scale per batch element shaped to broadcast over the layer output. branches which
+# only differ in the lora scale (slider positive / negative) then run as one batch
+# instead of calling unet.set_adapters between forwards.
+#
+#   with SampleLoraScales(unet, [2] * batch_size + [-2] * batch_size):
+#       noise_pred = unet(...)
+#       accelerator.backward(loss)
+#
+# keep backward inside the block when gradient checkpointing recomputes the forward.
+
+class SampleLoraScales():
+    def __init__(self, model, scales, adapter_name="default"):
+        self.model = model
+        self.scales = torch.as_tensor(scales, dtype=torch.float32)
+        self.adapter_name = adapter_name
+        # module -> scaling before the block
+        self.org_scaling = {}
+        self.handles = []
+
+    def __enter__(self):
+        for module in self.model.modules():
+            if not isinstance(module, LoraLayer) or self.adapter_name not in module.scaling:
+                continue
+            self.org_scaling[module] = module.scaling[self.adapter_name]
+            # scaling of the adapter at scale 1, lora_alpha / r
+            module.set_scale(self.adapter_name, 1.0)
+            base_scaling = module.scaling[self.adapter_name]
+            self.handles.append(module.register_forward_pre_hook(self.get_hook(base_scaling)))
+        return self
+
+    def get_hook(self, base_scaling):
+        def hook(module, args):
+            x = args[0]
+            if x.shape[0] != self.scales.shape[0]:
+                raise ValueError(f"{self.scales.shape[0]} lora scales for a batch of {x.shape[0]}")
+            scales = self.scales.to(x.device).reshape([-1] + [1] * (x.dim() - 1))
+            module.scaling[self.adapter_name] = scales * base_scaling
+        return hook
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for handle in self.handles:
+            handle.remove()
+        for module, scaling in self.org_scaling.items():
+            module.scaling[self.adapter_name] = scaling
+        self.handles = []
+        self.org_scaling = {}
@@ -0,0 +1,142 @@
+# Thanks to Kwai/kolors for the open source weight and comfyanonymous/ComfyUI for unet mapping code
+# streaming unet merge, tensors are read lazily with safe_open, merged in bounded size chunks
+# and written to the output safetensors incrementally, so only one chunk is resident at a time
+
+import torch
+from safetensors import safe_open
+from utils.safetensors_utils import SAFETENSORS_DTYPES, SafetensorsStreamWriter
+from utils.convert_utils import SDXL_UNET_CONFIG, LDM_UNET_PREFIX, get_unet_key_map
+
+
+# block_ratios: {diffusers key prefix: multiplier}, e.g. {"down_blocks.0": 0.5, "mid_block": 0}
+# the longest matching prefix wins, keys without a match use 1.0
+def get_block_ratio(key, block_ratios):
+    if not block_ratios:
+        return 1.0
+    ratio = 1.0
+    matched_length = -1
+    for prefix, value in block_ratios.items():
+        if (key == prefix or key.startswith(prefix + ".")) and len(prefix) > matched_length:
+            ratio = value
+            matched_length = len(prefix)
+    return ratio
+
+# find the key in model keys, either the same diffusers key or the mapped ldm key
+def resolve_key(key, model_keys, mapping, prefix=LDM_UNET_PREFIX):
+    if key in model_keys:
+        return key
+    if key in mapping:
+        ldm_key = f"{prefix}{mapping[key]}"
+        if ldm_key in model_keys:
+            return ldm_key
+    return None
+
+# split keys into chunks with at most chunk_bytes of fp32 data
+def chunk_keys(keys, numels, chunk_bytes):
+    chunk = []
+    chunk_size = 0
+    for key in keys:
+        size = numels[key] * 4
+        if len(chunk) > 0 and chunk_size + size > chunk_bytes:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(key)
+        chunk_size += size
+    if len(chunk) > 0:
+        yield chunk
+
+def numel(shape):
+    count = 1
+    for dim in shape:
+        count *= dim
+    return count
+
+# merged = base * (1 - sum(weight_i * block_ratio)) + sum(model_i * weight_i * block_ratio)
+# base_path: diffusers format unet, defines output keys, shapes and metadata
+# models: list of (path, weight), diffusers format or ldm (sdxl checkpoint) format
+# block_ratios: per block multiplier applied to every model weight, see get_block_ratio
+def stream_merge(base_path, models, output_path, block_ratios=None, perturbed_ratio=0,
+                 chunk_size_mb=512, dtype=torch.float16, device="cpu", unet_config=SDXL_UNET_CONFIG):
+    mapping = get_unet_key_map("sdxl", unet_config)
+    base = safe_open(base_path, 'pt', device="cpu")
+    base_keys = list(base.keys())
+
+    tensor_infos = {}
+    numels = {}
+    merge_dtypes = {}
+    for key in base_keys:
+        tensor_slice = base.get_slice(key)
+        shape = tuple(tensor_slice.get_shape())
+        base_dtype = SAFETENSORS_DTYPES[tensor_slice.get_dtype()]
+        merge_dtypes[key] = base_dtype.is_floating_point
+        tensor_infos[key] = (dtype if base_dtype.is_floating_point else base_dtype, shape)
+        numels[key] = numel(shape)
+
+    # resolve source keys once from the headers
+    sources = []
+    stats = {"merged": 0, "copied": 0, "shape_mismatch": 0}
+    for model_path, weight in models:
+        model = safe_open(model_path, 'pt', device="cpu")
+        model_keys = set(model.keys())
+        source_keys = {}
+        for key in base_keys:
+            if not merge_dtypes[key]:
+                continue
+            source_key = resolve_key(key, model_keys, mapping)
+            if source_key is None:
+                continue
+            source_shape = tuple(model.get_slice(source_key).get_shape())
+            if source_shape != tensor_infos[key][1]:
+                print("\nshape mismatch:")
+                print(source_key, source_shape)
+                print(key, tensor_infos[key][1])
+                stats["shape_mismatch"] += 1
+                continue
+            source_keys[key] = source_key
+        sources.append((model, weight, source_keys))
+
+    print("Merge begin")
+    chunk_bytes = chunk_size_mb * 1024 * 1024
+    with SafetensorsStreamWriter(output_path, tensor_infos, base.metadata()) as writer:
+        for chunk in chunk_keys(base_keys, numels, chunk_bytes):
+            merge_keys = [key for key in chunk if any(key in source_keys for _, _, source_keys in sources)]
+            merged = {}
+            if len(merge_keys) > 0:
+                sizes = [numels[key] for key in merge_keys]
+                size_tensor = torch.tensor(sizes, device=device)
+                coefs = []
+                base_coef = torch.ones(len(merge_keys), device=device)
+                for model, weight, source_keys in sources:
+                    coef = torch.tensor([weight * get_block_ratio(key, block_ratios) if key in source_keys else 0.0 for key in merge_keys], device=device)
+                    base_coef -= coef
+                    coefs.append(coef)
+                # the whole chunk is merged in fp32 with one fused op per model
+                acc = torch.cat([base.get_tensor(key).to(device, torch.float32).reshape(-1) for key in merge_keys])
+                acc.mul_(torch.repeat_interleave(base_coef, size_tensor))
+                for (model, weight, source_keys), coef in zip(sources, coefs):
+                    if not coef.any():
+                        continue
+                    other = torch.cat([
+                        model.get_tensor(source_keys[key]).to(device, torch.float32).reshape(-1) if key in source_keys
+                        else torch.zeros(numels[key], device=device)
+                        for key in merge_keys
+                    ])
+                    acc.addcmul_(other, torch.repeat_interleave(coef, size_tensor))
+                    del other
+                merged = dict(zip(merge_keys, torch.split(acc, sizes)))
+            for key in chunk:
+                if key in merged:
+                    weight = merged[key].view(tensor_infos[key][1])
+                    stats["merged"] += 1
+                    if perturbed_ratio > 0:
+                        # perturbed model
+                        # code referenced from https://www.reddit.com/r/StableDiffusion/comments/1dfuicw/perturbed_sd3_experiment/
+                        weight = weight + torch.randn_like(weight) * weight.std() * perturbed_ratio
+                    writer.write(key, weight.to(tensor_infos[key][0]))
+                else:
+                    stats["copied"] += 1
+                    writer.write(key, base.get_tensor(key).to(tensor_infos[key][0]))
+            del merged
+    print("Merge End")
+    return stats
@@ -0,0 +1,112 @@
+import json
+import os
+import struct
+from hashlib import md5
+
+# cheap content fingerprint of model weight files, stdlib only
+# safetensors: keys, dtypes and shapes from the header plus the head and middle bytes of sampled tensors
+# other formats (.bin): file size plus evenly spaced chunks of the file
+# reads a few MB per file instead of hashing GBs, and unlike names/sizes it changes when
+# e.g. the stock kolors vae is replaced by the fp16 fix vae of the same size.
+
+# bump when the sampling changes, old stamps then count as a different model
+FINGERPRINT_VERSION = 1
+SAMPLE_TENSORS = 32
+SAMPLE_BYTES = 64 * 1024
+SAMPLE_CHUNKS = 32
+
+WEIGHT_EXTS = [".safetensors", ".bin"]
+
+# (path, size, mtime_ns) -> fingerprint
+fingerprint_cache = {}
+
+def read_safetensors_header(f):
+    header_size = struct.unpack("<Q", f.read(8))[0]
+    if header_size > 100 * 1024 * 1024:
+        raise ValueError("safetensors header too large")
+    return header_size, json.loads(f.read(header_size))
+
+def hash_safetensors(path, hasher):
+    with open(path, "rb") as f:
+        header_size, header = read_safetensors_header(f)
+        # metadata and offsets are left out, the same weights saved by another tool still match
+        header.pop("__metadata__", None)
+        keys = sorted(header.keys())
+        hasher.update(json.dumps([[key, header[key]["dtype"], header[key]["shape"]] for key in keys]).encode("utf-8"))
+        data_start = 8 + header_size
+        step = max(1, len(keys) // SAMPLE_TENSORS)
+        for key in keys[::step][:SAMPLE_TENSORS]:
+            start, end = header[key]["data_offsets"]
+            length = end - start
+            for offset in [0, length // 2]:
+                f.seek(data_start + start + offset)
+                hasher.update(f.read(min(SAMPLE_BYTES, length - offset)))
+
+def hash_file_samples(path, hasher):
+    size = os.path.getsize(path)
+    hasher.update(str(size).encode("utf-8"))
+    with open(path, "rb") as f:
+        for i in range(SAMPLE_CHUNKS):
+            f.seek(size * i // SAMPLE_CHUNKS)
+            hasher.update(f.read(SAMPLE_BYTES))
+
+def get_file_fingerprint(path):
+    stat = os.stat(path)
+    cache_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if cache_key in fingerprint_cache:
+        return fingerprint_cache[cache_key]
+    hasher = md5(f"v{FINGERPRINT_VERSION}".encode("utf-8"))
+    if path.endswith(".safetensors"):
+        try:
+            hash_safetensors(path, hasher)
+        except (ValueError, KeyError, struct.error):
+            hash_file_samples(path, hasher)
+    else:
+        hash_file_samples(path, hasher)
+    fingerprint = hasher.hexdigest()[:16]
+    fingerprint_cache[cache_key] = fingerprint
+    return fingerprint
+
+# fingerprint of a model split over several files (e.g. sharded text encoder)
+# fallback_name is used when there are no local files, e.g. a hub repo id
+def get_model_fingerprint(paths, fallback_name=""):
+    if len(paths) == 0:
+        return md5(f"name:{fallback_name}".encode("utf-8")).hexdigest()[:16]
+    hasher = md5()
+    for path in sorted(paths, key=os.path.basename):
+        hasher.update(f"{os.path.basename(path)}:{get_file_fingerprint(path)}".encode("utf-8"))
+    return hasher.hexdigest()[:16]
+
+# weight files of the kolors text encoder, vae and unet, empty when loading from a hub repo id
+def get_text_encoder_files(pretrained_model_name_or_path):
+    folder = os.path.join(pretrained_model_name_or_path, "text_encoder")
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if os.path.splitext(f)[-1] in WEIGHT_EXTS)
+
+def get_vae_files(pretrained_model_name_or_path, vae_path=None):
+    if vae_path:
+        return [vae_path]
+    folder = os.path.join(pretrained_model_name_or_path, "vae")
+    for weight_file in ["diffusion_pytorch_model.fp16.safetensors", "diffusion_pytorch_model.safetensors"]:
+        if os.path.exists(os.path.join(folder, weight_file)):
+            return [os.path.join(folder, weight_file)]
+    return []
+
+def get_unet_files(pretrained_model_name_or_path, model_path=None):
+    if model_path:
+        return [model_path]
+    folder = os.path.join(pretrained_model_name_or_path, "unet")
+    for weight_file in ["diffusion_pytorch_model.fp16.safetensors", "diffusion_pytorch_model.safetensors"]:
+        if os.path.exists(os.path.join(folder, weight_file)):
+            return [os.path.join(folder, weight_file)]
+    return []
+
+def get_encoder_fingerprint(pretrained_model_name_or_path):
+    return get_model_fingerprint(get_text_encoder_files(pretrained_model_name_or_path), pretrained_model_name_or_path)
+
+def get_vae_fingerprint(pretrained_model_name_or_path, vae_path=None):
+    return get_model_fingerprint(get_vae_files(pretrained_model_name_or_path, vae_path), vae_path or pretrained_model_name_or_path)
+
+def get_unet_fingerprint(pretrained_model_name_or_path, model_path=None):
+    return get_model_fingerprint(get_unet_files(pretrained_model_name_or_path, model_path), model_path or pretrained_model_name_or_path)
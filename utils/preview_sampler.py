@@ -0,0 +1,222 @@
+import os
+import queue
+import threading
+from collections import deque
+
+import torch
+from peft.tuners.tuners_utils import BaseTunerLayer
+from peft.utils import get_peft_model_state_dict, set_peft_model_state_dict
+
+from utils.dpm_solver import DPM_Solver, NoiseScheduleVP, model_wrapper
+
+# preview images during training, sampled with the lora of the last checkpoint
+# the checkpoint lora is copied into a second adapter of the live unet, the base weights are shared.
+# a worker thread runs the multistep dpm-solver++ of utils/dpm_solver.py and writes the images.
+# its unet calls and vae decodes are handed to the training loop, which runs at most one of them
+# per training step, between the training forwards. so the models are only used from the training
+# thread, the gpu memory of a preview never adds to a training step, and training goes on while a
+# preview is sampled. a failed preview is logged and dropped, it never stops the training.
+#
+#   preview_sampler.submit(checkpoint_name)   # after accelerator.save_state
+#   preview_sampler.step()                    # once per training step
+#   preview_sampler.close()                   # after training, finishes the queued previews
+
+PREVIEW_ADAPTER = "preview"
+PREVIEW_PROMPT_SEPARATOR = "|"
+
+# a text file with one prompt per line, or prompts separated by |
+def read_preview_prompts(preview_prompts):
+    if os.path.isfile(preview_prompts):
+        with open(preview_prompts, "r", encoding="utf-8") as f:
+            prompts = f.read().splitlines()
+    else:
+        prompts = preview_prompts.split(PREVIEW_PROMPT_SEPARATOR)
+    return [prompt.strip() for prompt in prompts if prompt.strip() != ""]
+
+# embeddings of the preview prompts, None when the cache is of other prompts or another text encoder
+def load_preview_embeddings(path, prompts, negative_prompt, encoder_fingerprint):
+    if not os.path.exists(path):
+        return None
+    embeddings = torch.load(path)
+    if embeddings.get("prompts") != prompts or embeddings.get("negative_prompt") != negative_prompt:
+        return None
+    if embeddings.get("encoder_fingerprint") != encoder_fingerprint:
+        return None
+    return embeddings
+
+# prompts and negative prompt in one text encoder forward
+def create_preview_embeddings(pipe, path, prompts, negative_prompt, encoder_fingerprint):
+    prompt_embeds, pooled_prompt_embeds = pipe.encode_prompts(prompts + [negative_prompt])
+    embeddings = {
+        "prompts": prompts,
+        "negative_prompt": negative_prompt,
+        "encoder_fingerprint": encoder_fingerprint,
+        "prompt_embeds": prompt_embeds[:len(prompts)].cpu(),
+        "pooled_prompt_embeds": pooled_prompt_embeds[:len(prompts)].cpu(),
+        "negative_prompt_embed": prompt_embeds[len(prompts)].cpu(),
+        "negative_pooled_prompt_embed": pooled_prompt_embeds[len(prompts)].cpu(),
+    }
+    torch.save(embeddings, path)
+    return embeddings
+
+# makes adapter_name the active adapter of the peft layers, peft also moves requires_grad to it
+def set_active_adapter(model, adapter_name):
+    for module in model.modules():
+        if isinstance(module, BaseTunerLayer):
+            module.set_adapter(adapter_name)
+
+class PreviewSampler():
+    # pipe: kolors pipeline around the live unet, the unet has the PREVIEW_ADAPTER next to the trained one
+    def __init__(self, pipe, noise_scheduler, embeddings, output_dir, steps=12, guidance_scale=5.0,
+                 resolution=1024, batch_size=1, seed=0, adapter_name="default"):
+        self.pipe = pipe
+        self.embeddings = embeddings
+        self.output_dir = output_dir
+        self.steps = steps
+        self.guidance_scale = guidance_scale
+        self.resolution = resolution
+        self.batch_size = batch_size
+        self.seed = seed
+        self.adapter_name = adapter_name
+        self.num_train_timesteps = noise_scheduler.config.num_train_timesteps
+        self.noise_schedule = NoiseScheduleVP(schedule="discrete", alphas_cumprod=noise_scheduler.alphas_cumprod.float().cpu())
+        # (checkpoint name, lora state dict on cpu) waiting for the sampler
+        self.pending = deque()
+        # worker -> training thread: ("unet", (latents, timesteps, cond)) or ("decode", (latent,))
+        self.requests = queue.Queue()
+        # result of the request, or the exception it raised
+        self.responses = queue.Queue()
+        self.thread = None
+        self.name = None
+        self.error = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    # snapshot of the trained lora, sampled once the previous previews are done
+    def submit(self, name):
+        state_dict = get_peft_model_state_dict(self.pipe.unet, adapter_name=self.adapter_name)
+        state_dict = {key: value.detach().to("cpu", copy=True) for key, value in state_dict.items()}
+        self.pending.append((name, state_dict))
+
+    def is_busy(self):
+        return self.thread is not None or len(self.pending) > 0
+
+    # runs the pending request of the worker, if there is one, without waiting for it
+    def step(self):
+        if self.thread is not None and not self.thread.is_alive():
+            if self.error is not None:
+                print(f"preview {self.name} failed, skipped: {self.error!r}")
+            self.drop()
+        if self.thread is None and len(self.pending) > 0:
+            self.start(*self.pending.popleft())
+        if self.thread is None:
+            return
+        try:
+            kind, args = self.requests.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            if kind == "unet":
+                result = self.predict_noise(*args)
+            else:
+                result = self.decode(*args)
+        except Exception as e:
+            # the worker raises it and ends, the preview is dropped on a later step
+            result = e
+        self.responses.put(result)
+
+    # the worker has ended, forget its preview and anything it left in the queues
+    def drop(self):
+        self.thread = None
+        self.error = None
+        for q in [self.requests, self.responses]:
+            while not q.empty():
+                q.get_nowait()
+
+    # finishes the queued previews, blocking
+    def close(self):
+        while self.is_busy():
+            if self.thread is not None:
+                self.thread.join(timeout=0.01)
+            self.step()
+
+    def start(self, name, state_dict):
+        set_peft_model_state_dict(self.pipe.unet, state_dict, adapter_name=PREVIEW_ADAPTER)
+        del state_dict
+        self.name = name
+        self.thread = threading.Thread(target=self.run, args=(name,), daemon=True)
+        self.thread.start()
+
+    # worker side, hands the call to the training thread and waits for it
+    def call(self, kind, *args):
+        self.requests.put((kind, args))
+        result = self.responses.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    @torch.no_grad()
+    def predict_noise(self, latents, timesteps, cond):
+        unet = self.pipe.unet
+        embeddings = self.embeddings
+        device = unet.device
+        # cond indexes the prompt table, the negative prompt is the last row
+        prompt_embeds = torch.cat([embeddings["prompt_embeds"], embeddings["negative_prompt_embed"].unsqueeze(0)])
+        pooled_prompt_embeds = torch.cat([embeddings["pooled_prompt_embeds"], embeddings["negative_pooled_prompt_embed"].unsqueeze(0)])
+        cond = cond.cpu()
+        time_ids = torch.tensor([self.resolution, self.resolution, 0, 0, self.resolution, self.resolution]).repeat(len(cond), 1)
+        set_active_adapter(unet, PREVIEW_ADAPTER)
+        try:
+            noise_pred = unet(
+                latents.to(device, dtype=unet.dtype),
+                timesteps.to(device),
+                encoder_hidden_states=prompt_embeds[cond].to(device, dtype=unet.dtype),
+                added_cond_kwargs={
+                    "text_embeds": pooled_prompt_embeds[cond].to(device, dtype=unet.dtype),
+                    "time_ids": time_ids.to(device, dtype=unet.dtype),
+                },
+                return_dict=False,
+            )[0]
+        finally:
+            set_active_adapter(unet, self.adapter_name)
+        return noise_pred.float()
+
+    # one image at a time, the decoded image goes back to the worker on cpu
+    @torch.no_grad()
+    def decode(self, latent):
+        vae = self.pipe.vae
+        latent = latent.unsqueeze(0).to(vae.device, dtype=vae.dtype) / vae.config.scaling_factor
+        image = vae.decode(latent, return_dict=False)[0]
+        return image.float().cpu()
+
+    # worker thread: solver and image writes, every unet call and vae decode goes through the training thread
+    def run(self, name):
+        try:
+            num_prompts = len(self.embeddings["prompts"])
+            negative_index = num_prompts
+            def model(x, t_input, cond):
+                # model_wrapper scales the continuous time to [0, 1000), the kolors unet takes [0, num_train_timesteps)
+                return self.call("unet", x, t_input * self.num_train_timesteps / 1000, cond).to(x.device)
+            for batch_start in range(0, num_prompts, self.batch_size):
+                indices = torch.arange(batch_start, min(batch_start + self.batch_size, num_prompts))
+                model_fn = model_wrapper(
+                    model,
+                    self.noise_schedule,
+                    model_type="noise",
+                    guidance_type="classifier-free",
+                    condition=indices,
+                    unconditional_condition=torch.full_like(indices, negative_index),
+                    guidance_scale=self.guidance_scale,
+                )
+                solver = DPM_Solver(model_fn, self.noise_schedule, algorithm_type="dpmsolver++")
+                # the same noise for every checkpoint, the previews of a prompt stay comparable
+                generator = torch.Generator().manual_seed(self.seed + batch_start)
+                latent_size = self.resolution // self.pipe.vae_scale_factor
+                x = torch.randn((len(indices), 4, latent_size, latent_size), generator=generator).to(self.pipe.vae.device)
+                latents = solver.sample(x, steps=self.steps, order=2, skip_type="time_uniform", method="multistep", lower_order_final=True)
+                for i, latent in enumerate(latents):
+                    image = self.call("decode", latent)
+                    image = self.pipe.image_processor.postprocess(image, output_type="pil")[0]
+                    image.save(os.path.join(self.output_dir, f"{name}_{batch_start + i}.webp"))
+                del x, latents
+        except Exception as e:
+            self.error = e
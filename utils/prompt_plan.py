@@ -0,0 +1,106 @@
+import json
+import os
+import random
+from hashlib import md5
+
+# prompt plan of prepare_multi_prompt_data.py, stdlib only
+# the combinations of the prompt lists are never materialized: a combination is decoded from
+# its index in the cartesian product (mixed radix), and a seeded sample of indices is drawn
+# from range(total) when only part of the product is wanted.
+# the plan is written once to a jsonl manifest, one line per prompt, which the text encoding
+# and rendering stream in batches instead of writing and globbing one .txt per prompt.
+
+MANIFEST_VERSION = 1
+
+def count_combinations(lists):
+    total = 1
+    for items in lists:
+        total *= len(items)
+    return total
+
+# combination at index of itertools.product(*lists), last list varies fastest like product
+def get_combination(lists, index):
+    combination = []
+    for items in reversed(lists):
+        index, item_index = divmod(index, len(items))
+        combination.append(items[item_index])
+    return tuple(reversed(combination))
+
+# indices of the product in order, a sorted seeded sample of max_count of them when given
+def iter_combination_indices(total, max_count=None, seed=0):
+    if max_count is None or max_count >= total:
+        return iter(range(total))
+    # sampling from a range doesn't build the range
+    return iter(sorted(random.Random(seed).sample(range(total), max_count)))
+
+def randomly_drop_tokens(tokens, drop_probability, rng):
+    return tuple(token for token in tokens if rng.random() > drop_probability)
+
+def hash_prompt(prompt):
+    return md5(prompt.encode("utf-8")).hexdigest()
+
+# prompts of one generation config, lazily
+# every random choice is seeded by (seed, character, index), the plan doesn't depend on the order it is consumed in
+def iter_prompt_plan(dir_name, characters, lists, pos_prompt, seed, max_per_character=None, drop_probability=0.3):
+    total = count_combinations(lists)
+    for character in characters:
+        for index in iter_combination_indices(total, max_per_character, seed=f"{seed}:{character}"):
+            rng = random.Random(f"{seed}:{character}:{index}")
+            desc_prompt = ', '.join(randomly_drop_tokens(get_combination(lists, index), drop_probability, rng))
+            prompt = f"{pos_prompt}, {character}, {desc_prompt}"
+            yield {
+                "dir_name": dir_name,
+                "character": character,
+                "index": index,
+                "prompt": prompt,
+                "prompt_hash": hash_prompt(prompt),
+            }
+
+def get_plan_signature(plan_config):
+    return md5(json.dumps(plan_config, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def read_manifest_signature(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            return None
+    if header.get("version") != MANIFEST_VERSION:
+        return None
+    return header.get("signature")
+
+# writes the manifest unless one of the same plan exists, returns the number of prompts in it
+# the first line is a header with the plan signature, then one json line per prompt
+def write_manifest(manifest_path, signature, items):
+    if read_manifest_signature(manifest_path) == signature:
+        return None
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"version": MANIFEST_VERSION, "signature": signature}) + "\n")
+        for item in items:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, manifest_path)
+    return count
+
+def iter_manifest(manifest_path):
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        f.readline()
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+# lists of up to batch_size items, without reading the whole manifest
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
@@ -0,0 +1,195 @@
+import json
+import mmap
+import os
+import struct
+from collections.abc import Mapping
+import torch
+import comfy.utils
+
+# safetensors dtype string <-> torch dtype
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+TORCH_TO_SAFETENSORS_DTYPES = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+
+def dtype_size(dtype):
+    return torch.empty((), dtype=dtype).element_size()
+
+# write a safetensors file tensor by tensor
+# the header is computed up front from key -> (dtype, shape), so tensors never need to be held together in memory
+# tensors must be written in the same order as tensor_infos
+# the file is written to path.tmp and only moved to path once every tensor is written,
+# an exception or an incomplete write never leaves a truncated file at path
+class SafetensorsStreamWriter():
+    def __init__(self, path, tensor_infos, metadata=None):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.keys = list(tensor_infos.keys())
+        self.tensor_infos = tensor_infos
+        header = {}
+        if metadata is not None:
+            header["__metadata__"] = {str(k): str(v) for k, v in metadata.items()}
+        offset = 0
+        for key in self.keys:
+            dtype, shape = tensor_infos[key]
+            nbytes = dtype_size(dtype)
+            for dim in shape:
+                nbytes *= dim
+            header[key] = {
+                "dtype": TORCH_TO_SAFETENSORS_DTYPES[dtype],
+                "shape": list(shape),
+                "data_offsets": [offset, offset + nbytes],
+            }
+            offset += nbytes
+        self.total_bytes = offset
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        # pad header to 8 bytes alignment like safetensors does
+        header_bytes += b" " * ((8 - len(header_bytes) % 8) % 8)
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(struct.pack("<Q", len(header_bytes)))
+        self.file.write(header_bytes)
+        self.index = 0
+
+    def write(self, key, tensor):
+        if self.index >= len(self.keys) or self.keys[self.index] != key:
+            raise ValueError(f"{key} written out of order, expected {self.keys[self.index] if self.index < len(self.keys) else None}")
+        dtype, shape = self.tensor_infos[key]
+        if tensor.dtype != dtype or tuple(tensor.shape) != tuple(shape):
+            raise ValueError(f"{key} expected {dtype} {tuple(shape)}, got {tensor.dtype} {tuple(tensor.shape)}")
+        data = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy()
+        self.file.write(data.data)
+        self.index += 1
+
+    def close(self):
+        self.file.close()
+        if self.index != len(self.keys):
+            self.discard()
+            raise ValueError(f"{self.path} incomplete, {self.index}/{len(self.keys)} tensors written")
+        os.replace(self.tmp_path, self.path)
+
+    # drops the partial file
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+            return
+        self.close()
+
+# read only view of a safetensors file
+# keys, shapes and dtypes come from the header, payloads are mmapped and only read when a tensor is requested
+# it behaves like a read only dict, so it can be passed to load_model_dict_into_meta directly
+class LazyStateDict(Mapping):
+    def __init__(self, path, dtype=None, device=None, keys=None, _shared=None):
+        self.path = path
+        self.dtype = dtype
+        self.device = device
+        if _shared is None:
+            header_bytes = comfy.utils.safetensors_header(path)
+            if header_bytes is None:
+                raise ValueError(f"{path} header too large or invalid")
+            header = json.loads(header_bytes)
+            self._metadata = header.pop("__metadata__", None)
+            self._header = header
+            # tensor payload starts after the 8 bytes header length and the header itself
+            self._data_offset = 8 + len(header_bytes)
+            self._mmap = None
+        else:
+            self._header, self._metadata, self._data_offset, self._mmap = _shared
+        if keys is None:
+            keys = list(self._header.keys())
+        self._keys = keys
+        self._key_set = set(keys)
+
+    def _get_mmap(self):
+        if self._mmap is None:
+            with open(self.path, "rb") as f:
+                # copy on write mapping, writable for torch.frombuffer but never written back
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self._mmap
+
+    def metadata(self):
+        return self._metadata
+
+    def shape(self, key):
+        return tuple(self._header[key]["shape"])
+
+    def dtype_of(self, key):
+        return SAFETENSORS_DTYPES[self._header[key]["dtype"]]
+
+    def nbytes(self, key):
+        start, end = self._header[key]["data_offsets"]
+        return end - start
+
+    def total_bytes(self):
+        return sum(self.nbytes(key) for key in self._keys)
+
+    # load one tensor, directly in the target dtype and device
+    def get_tensor(self, key, dtype=None, device=None):
+        if dtype is None:
+            dtype = self.dtype
+        if device is None:
+            device = self.device
+        info = self._header[key]
+        tensor_dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        shape = info["shape"]
+        start, end = info["data_offsets"]
+        if end == start:
+            tensor = torch.empty(shape, dtype=tensor_dtype)
+        else:
+            tensor = torch.frombuffer(self._get_mmap(), dtype=tensor_dtype,
+                                      count=(end - start) // dtype_size(tensor_dtype),
+                                      offset=self._data_offset + start).reshape(shape)
+        if dtype is not None and dtype != tensor_dtype and tensor_dtype.is_floating_point:
+            tensor = tensor.to(device=device, dtype=dtype)
+        elif device is not None and torch.device(device).type != "cpu":
+            tensor = tensor.to(device=device)
+        else:
+            # detach from the mmap so the tensor stays valid after the view is closed
+            tensor = tensor.clone()
+        return tensor
+
+    # view limited to keys with prefix or the given keys, sharing the same mmap
+    def subset(self, keys=None, prefix=None):
+        if keys is None:
+            keys = self._keys
+        keys = [key for key in keys if key in self._header]
+        if prefix is not None:
+            keys = [key for key in keys if key.startswith(prefix)]
+        shared = (self._header, self._metadata, self._data_offset, self._get_mmap())
+        return LazyStateDict(self.path, dtype=self.dtype, device=self.device, keys=keys, _shared=shared)
+
+    def __getitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+        return self.get_tensor(key)
+
+    def __contains__(self, key):
+        return key in self._key_set
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    # subsets share the mmap, close the view they were created from after using them
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
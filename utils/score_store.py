@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import time
+from hashlib import md5
+
+# local score store for aesthetic / mps scores
+# rows are keyed by (image content md5, scorer id, prompt hash) so renamed or moved images keep their
+# scores and scores from different models never overwrite each other
+
+def get_image_hash(image_path, chunk_size=1024 * 1024):
+    hasher = md5()
+    with open(image_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+# scorers conditioned on a prompt (mps) score an (image, prompt) pair, the prompt hash is part of the
+# key so a changed caption or the same image under another caption is scored again.
+# unconditioned scorers (aesthetic) use ''
+def get_prompt_hash(prompt):
+    if prompt is None:
+        return ""
+    return md5(prompt.encode('utf-8')).hexdigest()
+
+class ScoreStore():
+    def __init__(self, db_path="scores.db"):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "image_hash TEXT NOT NULL, "
+            "scorer_id TEXT NOT NULL, "
+            "prompt_hash TEXT NOT NULL DEFAULT '', "
+            "score REAL NOT NULL, "
+            "image_path TEXT, "
+            "updated_at REAL, "
+            "PRIMARY KEY (image_hash, scorer_id, prompt_hash))"
+        )
+        self.migrate()
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_scorer_score ON scores (scorer_id, score)")
+        self.conn.commit()
+        # image_path -> (mtime, size, hash), avoid rehashing the same file in one run
+        self.hash_cache = {}
+
+    # stores without prompt_hash kept the prompt hash in the scorer id as "scorer:hash", split it out
+    def migrate(self):
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(scores)").fetchall()]
+        if "prompt_hash" in columns:
+            return
+        self.conn.execute("DROP INDEX IF EXISTS idx_scorer_score")
+        self.conn.execute("ALTER TABLE scores RENAME TO scores_old")
+        self.conn.execute(
+            "CREATE TABLE scores ("
+            "image_hash TEXT NOT NULL, "
+            "scorer_id TEXT NOT NULL, "
+            "prompt_hash TEXT NOT NULL DEFAULT '', "
+            "score REAL NOT NULL, "
+            "image_path TEXT, "
+            "updated_at REAL, "
+            "PRIMARY KEY (image_hash, scorer_id, prompt_hash))"
+        )
+        rows = self.conn.execute("SELECT image_hash, scorer_id, score, image_path, updated_at FROM scores_old").fetchall()
+        migrated = []
+        for image_hash, scorer_id, score, image_path, updated_at in rows:
+            scorer_name, _, prompt_hash = scorer_id.partition(":")
+            migrated.append((image_hash, scorer_name, prompt_hash, score, image_path, updated_at))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO scores (image_hash, scorer_id, prompt_hash, score, image_path, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            migrated
+        )
+        self.conn.execute("DROP TABLE scores_old")
+        self.conn.commit()
+
+    def hash(self, image_path):
+        stat = os.stat(image_path)
+        cached = self.hash_cache.get(image_path)
+        if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return cached[2]
+        image_hash = get_image_hash(image_path)
+        self.hash_cache[image_path] = (stat.st_mtime, stat.st_size, image_hash)
+        return image_hash
+
+    # rows: list of (image_hash, score, image_path)
+    def upsert(self, scorer_id, rows, prompt_hash=""):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT INTO scores (image_hash, scorer_id, prompt_hash, score, image_path, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(image_hash, scorer_id, prompt_hash) DO UPDATE SET "
+            "score=excluded.score, image_path=excluded.image_path, updated_at=excluded.updated_at",
+            [(image_hash, scorer_id, prompt_hash, float(score), image_path, now) for image_hash, score, image_path in rows]
+        )
+        self.conn.commit()
+
+    # convenience for scoring jobs, hash the images then upsert
+    def upsert_paths(self, scorer_id, image_paths, scores, prompt_hash=""):
+        rows = [(self.hash(image_path), score, image_path) for image_path, score in zip(image_paths, scores)]
+        self.upsert(scorer_id, rows, prompt_hash=prompt_hash)
+
+    def get(self, scorer_id, image_hash, prompt_hash=""):
+        row = self.conn.execute(
+            "SELECT score FROM scores WHERE image_hash=? AND scorer_id=? AND prompt_hash=?", (image_hash, scorer_id, prompt_hash)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    # return {image_hash: score} for hashes already scored by scorer_id under prompt_hash
+    def get_many(self, scorer_id, image_hashes, prompt_hash="", chunk_size=500):
+        image_hashes = list(image_hashes)
+        result = {}
+        for i in range(0, len(image_hashes), chunk_size):
+            chunk = image_hashes[i:i + chunk_size]
+            placeholders = ",".join(["?"] * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT image_hash, score FROM scores WHERE scorer_id=? AND prompt_hash=? AND image_hash IN ({placeholders})",
+                [scorer_id, prompt_hash] + chunk
+            ).fetchall()
+            result.update(dict(rows))
+        return result
+
+    # lookup by path, return {image_path: score} for scored images
+    def get_paths(self, scorer_id, image_paths, prompt_hash=""):
+        path_hashes = {image_path: self.hash(image_path) for image_path in image_paths}
+        scores = self.get_many(scorer_id, path_hashes.values(), prompt_hash=prompt_hash)
+        return {image_path: scores[image_hash] for image_path, image_hash in path_hashes.items() if image_hash in scores}
+
+    # return image paths not yet scored by scorer_id
+    def filter_unscored(self, scorer_id, image_paths, prompt_hash=""):
+        scored = self.get_paths(scorer_id, image_paths, prompt_hash=prompt_hash)
+        return [image_path for image_path in image_paths if image_path not in scored]
+
+    # return list of (image_path, score) in score range, the last recorded path is returned
+    # prompt conditioned scorers return every scored (image, prompt) pair unless prompt_hash is given
+    def query(self, scorer_id, min_score=None, max_score=None, prompt_hash=None):
+        sql = "SELECT image_path, score FROM scores WHERE scorer_id=?"
+        params = [scorer_id]
+        if prompt_hash is not None:
+            sql += " AND prompt_hash=?"
+            params.append(prompt_hash)
+        if min_score is not None:
+            sql += " AND score >= ?"
+            params.append(min_score)
+        if max_score is not None:
+            sql += " AND score < ?"
+            params.append(max_score)
+        sql += " ORDER BY score DESC"
+        return self.conn.execute(sql, params).fetchall()
+
+    def scorers(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT scorer_id FROM scores").fetchall()]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
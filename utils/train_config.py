@@ -0,0 +1,77 @@
+import os
+
+# light weight config checks, only stdlib imports here
+# the trainers run this before importing torch/diffusers so a bad path fails in milliseconds
+# ui.py runs it before launching the training process
+
+SUPPORTED_RESOLUTIONS = ["512", "1024", "2048"]
+
+def is_repo_id(name):
+    # huggingface repo id like Kwai-Kolors/Kolors
+    return name.count("/") == 1 and not os.path.isabs(name) and ":" not in name and not name.startswith(".")
+
+# config: dict or argparse.Namespace, return list of error messages
+def validate_train_config(config):
+    if not isinstance(config, dict):
+        config = vars(config)
+    errors = []
+
+    pretrained_model_name_or_path = config.get("pretrained_model_name_or_path")
+    if not pretrained_model_name_or_path:
+        errors.append("pretrained_model_name_or_path is required")
+    elif not os.path.exists(pretrained_model_name_or_path) and not is_repo_id(pretrained_model_name_or_path):
+        errors.append(f"pretrained_model_name_or_path not found: {pretrained_model_name_or_path}")
+
+    train_data_dir = config.get("train_data_dir")
+    if not train_data_dir:
+        errors.append("train_data_dir is required")
+    elif not os.path.isdir(train_data_dir):
+        errors.append(f"train_data_dir not found: {train_data_dir}")
+
+    for key in ["model_path", "vae_path"]:
+        path = config.get(key)
+        if path and not os.path.isfile(path):
+            errors.append(f"{key} not found: {path}")
+    vae_path = config.get("vae_path")
+    if vae_path and not vae_path.endswith(".safetensors"):
+        errors.append("vae_path need to be a single file ends with .safetensors")
+
+    output_dir = config.get("output_dir")
+    if not output_dir:
+        errors.append("output_dir is required")
+
+    resolution = config.get("resolution")
+    if resolution is not None and str(resolution) not in SUPPORTED_RESOLUTIONS:
+        errors.append(f"resolution {resolution} not supported, choose from {SUPPORTED_RESOLUTIONS}")
+
+    validation_ratio = config.get("validation_ratio")
+    if validation_ratio is not None and not (0 <= float(validation_ratio) < 1):
+        errors.append(f"validation_ratio should be in [0, 1), got {validation_ratio}")
+
+    for key in ["train_batch_size", "gradient_accumulation_steps", "num_train_epochs", "repeats", "rank", "validation_timesteps", "validation_batch_size"]:
+        value = config.get(key)
+        if value is not None and int(value) < 1:
+            errors.append(f"{key} should be >= 1, got {value}")
+    return errors
+
+# config: dict or argparse.Namespace, return list of messages for settings the trainer works around
+def get_train_config_warnings(config):
+    if not isinstance(config, dict):
+        config = vars(config)
+    warnings = []
+    # trainers resume from output_dir/basename(resume_from_checkpoint), a missing one starts a new run
+    output_dir = config.get("output_dir")
+    resume_from_checkpoint = config.get("resume_from_checkpoint")
+    if resume_from_checkpoint and resume_from_checkpoint != "latest" and output_dir:
+        checkpoint_dir = os.path.join(output_dir, os.path.basename(os.path.normpath(resume_from_checkpoint)))
+        if not os.path.isdir(checkpoint_dir):
+            warnings.append(f"resume_from_checkpoint not found: {checkpoint_dir}, starting a new training run")
+    return warnings
+
+# the trainers' __main__ and train_daemon.py run the same check
+def check_train_config(config):
+    for warning in get_train_config_warnings(config):
+        print(f"Warning: {warning}")
+    config_errors = validate_train_config(config)
+    if len(config_errors) > 0:
+        raise ValueError("Invalid training config:\n" + "\n".join(config_errors))
@@ -0,0 +1,88 @@
+from collections import defaultdict
+from hashlib import md5
+
+import torch
+
+# validation loss of the kolors lora trainer
+# the validation set is loaded once and kept in memory. every sample gets a fixed bank of
+# (timestep, noise) draws, one timestep from each of num_buckets equal ranges of the schedule,
+# seeded by the image path. the loss of a checkpoint is then measured on the same inputs every
+# epoch and every run, without seeding or restoring the global rngs. the draws of samples with
+# the same latent size run batched, and the loss is also reported per timestep range.
+
+def get_sample_seed(datarow, seed):
+    return int(md5(f"{seed}:{datarow['image_path']}".encode("utf-8")).hexdigest()[:8], 16)
+
+# bucket ranges of the train timesteps, [start, end)
+def get_timestep_buckets(num_train_timesteps, num_buckets):
+    bounds = [round(i * num_train_timesteps / num_buckets) for i in range(num_buckets + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(num_buckets)]
+
+class ValidationEngine():
+    def __init__(self, datarows, noise_scheduler, num_buckets=4, batch_size=4, seed=0):
+        self.noise_scheduler = noise_scheduler
+        self.batch_size = batch_size
+        self.buckets = get_timestep_buckets(noise_scheduler.config.num_train_timesteps, num_buckets)
+        # the same fields as CachedImageDataset, read directly so building the set doesn't draw from the global rng
+        self.samples = []
+        for datarow in datarows:
+            cached_npz = torch.load(datarow['npz_path'])
+            cached_latent = torch.load(datarow['latent_path'])
+            latent = cached_latent['latent']
+            generator = torch.Generator().manual_seed(get_sample_seed(datarow, seed))
+            timesteps = torch.cat([torch.randint(start, end, (1,), generator=generator) for start, end in self.buckets])
+            noise = torch.randn((len(self.buckets), *latent.shape), generator=generator)
+            self.samples.append({
+                "latent": latent,
+                "prompt_embed": cached_npz['prompt_embed'],
+                "pooled_prompt_embed": cached_npz['pooled_prompt_embed'],
+                "time_id": cached_npz['time_id'],
+                "timesteps": timesteps,
+                "noise": noise,
+            })
+        # (sample, draw) pairs grouped by latent size, up to batch_size per unet call
+        pairs_by_size = defaultdict(list)
+        for i, sample in enumerate(self.samples):
+            for j in range(len(self.buckets)):
+                pairs_by_size[tuple(sample["latent"].shape)].append((i, j))
+        self.batches = []
+        for pairs in pairs_by_size.values():
+            for batch_start in range(0, len(pairs), batch_size):
+                self.batches.append(pairs[batch_start:batch_start + batch_size])
+
+    def __len__(self):
+        return len(self.samples)
+
+    # loss_fn(model_pred, target, timesteps) -> loss per sample
+    # returns the mean loss and the mean loss of each timestep bucket
+    @torch.no_grad()
+    def evaluate(self, unet, loss_fn, device, dtype):
+        bucket_losses = torch.zeros(len(self.buckets), dtype=torch.float64)
+        bucket_counts = torch.zeros(len(self.buckets), dtype=torch.float64)
+        for pairs in self.batches:
+            samples = [self.samples[i] for i, _ in pairs]
+            slots = torch.tensor([j for _, j in pairs])
+            latents = torch.stack([sample["latent"] for sample in samples]).to(device)
+            noise = torch.stack([sample["noise"][j] for sample, (_, j) in zip(samples, pairs)]).to(device)
+            timesteps = torch.stack([sample["timesteps"][j] for sample, (_, j) in zip(samples, pairs)]).to(device)
+            noisy_model_input = self.noise_scheduler.add_noise(latents, noise, timesteps)
+            model_pred = unet(
+                noisy_model_input,
+                timesteps,
+                torch.stack([sample["prompt_embed"] for sample in samples]).to(device),
+                added_cond_kwargs={
+                    "text_embeds": torch.stack([sample["pooled_prompt_embed"] for sample in samples]).to(device),
+                    "time_ids": torch.stack([sample["time_id"] for sample in samples]).to(device, dtype=dtype),
+                },
+                return_dict=False,
+            )[0]
+            loss = loss_fn(model_pred, noise, timesteps).detach().double().cpu()
+            bucket_losses.index_add_(0, slots, loss)
+            bucket_counts.index_add_(0, slots, torch.ones_like(loss))
+            del latents, noise, timesteps, noisy_model_input, model_pred, loss
+        avg_loss = (bucket_losses.sum() / bucket_counts.sum()).item()
+        bucket_avg_losses = {
+            f"{start}-{end}": (bucket_losses[k] / bucket_counts[k]).item()
+            for k, (start, end) in enumerate(self.buckets) if bucket_counts[k] > 0
+        }
+        return avg_loss, bucket_avg_losses